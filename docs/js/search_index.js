@@ -0,0 +1,110 @@
+// Generated by project-guide/build_search_index.py - do not edit.
+// Prefix-sharded search: a query fetches docs/search/<first two chars>.json only.
+(function () {
+  var script = document.currentScript;
+  var base = script ? script.src.replace(/js\/search_index\.js.*$/, '') : '';
+  var shards = {};
+  var manifest = null;
+
+  function getJSON(url) {
+    return fetch(url).then(function (r) { return r.ok ? r.json() : null; });
+  }
+
+  function shardKey(term, length) {
+    return term.slice(0, length).split('').map(function (c) {
+      return /[a-z0-9_]/.test(c) ? c : '-' + c.charCodeAt(0).toString(16);
+    }).join('');
+  }
+
+  function loadShard(key) {
+    if (!(key in shards)) {
+      shards[key] = manifest.then(function (m) {
+        return m && m.shards.indexOf(key) >= 0 ? getJSON(base + 'search/' + key + '.json') : null;
+      });
+    }
+    return shards[key];
+  }
+
+  // 'map find': terms starting with the first word, full names containing the others.
+  // 'Common::Map', 'Map.find', 'Map#check': terms starting with the last segment, and the
+  // namespace segments right before the name starting with the earlier ones.
+  function search(query, limit) {
+    var qualified = /::|#|\./.test(query);
+    var words = query.toLowerCase().split(/\s+|::|#|\./).filter(Boolean);
+    if (!words.length) return Promise.resolve([]);
+    var target = qualified ? words[words.length - 1] : words[0];
+    var others = qualified ? words.slice(0, -1) : words.slice(1);
+
+    function matches(full) {
+      if (!qualified) return others.every(function (w) { return full.indexOf(w) >= 0; });
+      var segments = full.split(/::|#|\./), offset = segments.length - 1 - others.length;
+      return offset >= 0 && others.every(function (w, i) { return segments[offset + i].indexOf(w) === 0; });
+    }
+
+    manifest = manifest || getJSON(base + 'search/manifest.json');
+    return manifest.then(function (m) {
+      return loadShard(shardKey(target, m ? m.prefix : 2)).then(function (shard) {
+        if (!shard) return [];
+        var seen = {}, results = [];
+        Object.keys(shard.terms).forEach(function (term) {
+          if (term.indexOf(target) !== 0) return;
+          shard.terms[term].forEach(function (row) {
+            if (seen[row]) return;
+            var entry = shard.rows[row];
+            if (matches(entry[1].toLowerCase())) {
+              seen[row] = true;
+              var name = entry[0].toLowerCase();
+              var rank = name === target ? 0 : name.indexOf(target) === 0 ? 1 : 2;
+              results.push({name: entry[0], fullName: entry[1], kind: entry[2],
+                            url: base + entry[3], rank: rank});
+            }
+          });
+        });
+        results.sort(function (a, b) { return a.rank - b.rank || a.name.length - b.name.length; });
+        return results.slice(0, limit || 50);
+      });
+    });
+  }
+
+  window.LichSearch = {search: search};
+
+  function attach() {
+    var holder = document.getElementById('search');
+    if (!holder || document.getElementById('lich-search-input')) return;
+    var input = document.createElement('input');
+    input.id = 'lich-search-input';
+    input.type = 'search';
+    input.placeholder = 'Search classes, methods, constants';
+    input.style.cssText = 'margin-right:8px;padding:3px 6px;width:16em';
+    var list = document.createElement('ul');
+    list.id = 'lich-search-results';
+    list.style.cssText = 'position:absolute;z-index:10;background:#fff;border:1px solid #ccc;' +
+                         'list-style:none;margin:0;padding:0;max-height:60vh;overflow:auto;display:none';
+    holder.insertBefore(list, holder.firstChild);
+    holder.insertBefore(input, holder.firstChild);
+    var pending = 0;
+    input.addEventListener('input', function () {
+      var ticket = ++pending;
+      search(input.value, 50).then(function (results) {
+        if (ticket !== pending) return;
+        list.innerHTML = '';
+        results.forEach(function (r) {
+          var li = document.createElement('li'), a = document.createElement('a');
+          a.href = r.url;
+          a.textContent = r.fullName;
+          a.title = r.kind;
+          li.style.padding = '2px 6px';
+          li.appendChild(a);
+          list.appendChild(li);
+        });
+        list.style.display = results.length ? 'block' : 'none';
+      });
+    });
+  }
+
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', attach);
+  } else {
+    attach();
+  }
+})();
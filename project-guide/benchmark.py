@@ -0,0 +1,518 @@
+"""
+Throughput benchmark for guide.py that never touches the real API.
+
+Starts a local OpenAI-compatible stub (configurable latency, tokens/sec and
+429 rate), generates a synthetic Ruby corpus shaped like src/lib - many small
+files plus a few huge global_defs.rb-style ones - and times process_directory
+followed by generate_documentation for every output format.
+
+    python benchmark.py --scale 1 --concurrency 8 --latency 0.2 --tps 400
+    python benchmark.py --json bench.json
+    python benchmark.py --batch                   # through /v1/files and /v1/batches
+    python benchmark.py --compare bench.json      # exit 1 on a regression
+"""
+import os
+import sys
+import json
+import random
+import re
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import logging
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+
+# ----------------------------------------------------------------------
+#  Fake OpenAI-compatible server
+# ----------------------------------------------------------------------
+class FakeOpenAIServer:
+    """
+    Minimal /v1/chat/completions endpoint that answers guide.py's prompts.
+
+    Anchored prompts ('L<n>  ' lines) get one '@@ L<n>' block per anchor;
+    anything else gets the prompt's ruby block echoed back with a comment.
+    Each answer costs latency + completion_tokens / tps seconds, and a
+    fraction rate_429 of requests is refused with a Retry-After header.
+
+    /v1/files and /v1/batches cover guide.py --batch: an uploaded batch is
+    'validating' when created and 'completed' on the first retrieve, with
+    every request answered as above (no latency, no 429s).
+
+    Args:
+        latency: Seconds before the first token
+        tps: Completion tokens generated per second
+        rate_429: Probability of answering 429 Too Many Requests
+        retry_after: Value of the Retry-After header on 429 answers
+        seed: Seed for the 429 draw, so runs are reproducible
+    """
+
+    def __init__(self, latency=0.1, tps=500.0, rate_429=0.0, retry_after=0.1, seed=0):
+        self.latency = latency
+        self.tps = tps
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = 0
+        self.throttled = 0
+        self.batched = 0
+        self.completion_tokens = 0
+        self._files = {}
+        self._batches = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                parts = self.path.split('?', 1)[0].strip('/').split('/')
+                if parts[-3:-1] == ['v1', 'batches'] and parts[-1] in fake._batches:
+                    self._send_json(200, fake._finish_batch(parts[-1]))
+                elif parts[-4:-2] == ['v1', 'files'] and parts[-1] == 'content' and parts[-2] in fake._files:
+                    data = fake._files[parts[-2]]['content']
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self._send_json(404, {'error': {'message': f"unknown path {self.path}"}})
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path.endswith('/files'):
+                    self._send_json(200, fake._store_file(self.headers.get('Content-Type', ''), raw))
+                    return
+                body = json.loads(raw)
+                if self.path.endswith('/batches'):
+                    if body.get('input_file_id') not in fake._files:
+                        self._send_json(404, {'error': {'message': f"no file {body.get('input_file_id')}"}})
+                    else:
+                        self._send_json(200, fake._create_batch(body))
+                    return
+                if not self.path.endswith('/chat/completions'):
+                    self._send_json(404, {'error': {'message': f"unknown path {self.path}"}})
+                    return
+                with fake._lock:
+                    throttled = fake._random.random() < fake.rate_429
+                    if throttled:
+                        fake.throttled += 1
+                if throttled:
+                    self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit'}},
+                                    {'Retry-After': str(fake.retry_after)})
+                    return
+
+                completion = fake.complete(body)
+                with fake._lock:
+                    fake.calls += 1
+                time.sleep(fake.latency)
+                text = completion['choices'][0]['message']['content']
+                usage = completion['usage']
+                if body.get('stream'):
+                    self._stream(body['model'], text, usage['completion_tokens'], usage)
+                else:
+                    time.sleep(usage['completion_tokens'] / fake.tps)
+                    self._send_json(200, completion)
+
+            def _send_json(self, status, payload, headers=None):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, model, text, tokens, usage):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                pieces = max(1, min(20, tokens))
+                step = -(-len(text) // pieces)
+                try:
+                    for i in range(0, len(text), step):
+                        chunk = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'model': model,
+                                 'created': int(time.time()),
+                                 'choices': [{'index': 0, 'delta': {'content': text[i:i + step]},
+                                              'finish_reason': None}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                        self.wfile.flush()
+                        time.sleep(tokens / fake.tps / pieces)
+                    final = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'model': model,
+                             'created': int(time.time()), 'choices': [], 'usage': usage}
+                    self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode('utf-8'))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client stopped reading early (stop_at_fence)
+                self.close_connection = True
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def complete(self, body):
+        """The chat.completion object answering one request body"""
+        text = self.answer(body['messages'][-1]['content'])
+        tokens = max(1, len(text) // 4)
+        prompt_tokens = sum(len(m.get('content') or '') for m in body['messages']) // 4
+        with self._lock:
+            self.completion_tokens += tokens
+        return {
+            'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': text}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': tokens,
+                      'total_tokens': prompt_tokens + tokens},
+        }
+
+    def _store_file(self, content_type, raw, purpose='batch', filename='upload.jsonl'):
+        """Keep an upload (multipart form or raw bytes) and return its file object"""
+        content = raw
+        if content_type.startswith('multipart/'):
+            form = BytesParser(policy=policy.HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + raw)
+            for part in form.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if name == 'file':
+                    content = part.get_payload(decode=True)
+                    filename = part.get_filename() or filename
+                elif name == 'purpose':
+                    purpose = part.get_content().strip()
+        with self._lock:
+            file_id = f"file-bench-{len(self._files) + 1}"
+            self._files[file_id] = {
+                'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                'filename': filename, 'purpose': purpose, 'status': 'processed', 'content': content,
+            }
+        return {key: value for key, value in self._files[file_id].items() if key != 'content'}
+
+    def _create_batch(self, body):
+        with self._lock:
+            batch_id = f"batch_bench_{len(self._batches) + 1}"
+            self._batches[batch_id] = {
+                'id': batch_id, 'object': 'batch', 'endpoint': body.get('endpoint', '/v1/chat/completions'),
+                'input_file_id': body['input_file_id'], 'completion_window': body.get('completion_window', '24h'),
+                'status': 'validating', 'created_at': int(time.time()), 'output_file_id': None,
+                'error_file_id': None, 'errors': None,
+                'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            }
+            return dict(self._batches[batch_id])
+
+    def _finish_batch(self, batch_id):
+        """Answer every request of a batch on its first retrieve and return the batch object"""
+        batch = self._batches[batch_id]
+        if batch['status'] == 'validating':
+            lines = self._files[batch['input_file_id']]['content'].decode('utf-8').splitlines()
+            requests = [json.loads(line) for line in lines if line.strip()]
+            output = [json.dumps({
+                'id': f"batch_req_{i}", 'custom_id': request['custom_id'], 'error': None,
+                'response': {'status_code': 200, 'request_id': f"req_{i}", 'body': self.complete(request['body'])},
+            }) for i, request in enumerate(requests)]
+            output_file = self._store_file('', ('\n'.join(output) + '\n').encode('utf-8'),
+                                           purpose='batch_output', filename=f"{batch_id}_output.jsonl")
+            with self._lock:
+                self.batched += len(requests)
+                batch.update(status='completed', output_file_id=output_file['id'], completed_at=int(time.time()),
+                             request_counts={'total': len(requests), 'completed': len(requests), 'failed': 0})
+        return dict(batch)
+
+    @staticmethod
+    def answer(prompt):
+        """The canned reply guide.py would accept for this prompt"""
+        anchors = re.findall(r'^L(\d+)  (.*)$', prompt, re.M)
+        if anchors:
+            blocks = []
+            for line, declaration in anchors:
+                blocks.append(f"@@ L{line}\n"
+                              f"Handles `{declaration.strip()[:60]}` for the synthetic benchmark corpus.\n"
+                              f"@return [Object] the computed result\n"
+                              f"@example\n  benchmark_example({line})")
+            return '\n\n'.join(blocks)
+        code = re.search(r'```ruby\n(.*?)\n```', prompt, re.S)
+        source = code.group(1) if code else ''
+        return f"```ruby\n# Annotated by the benchmark server\n{source}\n```"
+
+
+# ----------------------------------------------------------------------
+#  Synthetic corpus
+# ----------------------------------------------------------------------
+_NOUNS = ['room', 'item', 'spell', 'script', 'npc', 'loot', 'stance', 'buffer', 'hook', 'setting',
+          'account', 'feat', 'armor', 'weapon', 'shield', 'cman', 'warcry', 'map', 'claim', 'xml']
+_VERBS = ['find', 'parse', 'update', 'load', 'save', 'check', 'cast', 'fetch', 'apply', 'reset']
+
+
+def _ruby_method(rng, name, indent):
+    """One Ruby method with a body mixing the constructs the scanner must handle"""
+    pad = ' ' * indent
+    params = rng.sample(['id', 'name', 'value', 'target', 'opts = {}', 'quiet = false', '*args', '&block'],
+                        rng.randint(0, 3))
+    lines = []
+    if rng.random() < 0.4:
+        lines.append(f"{pad}# {name.replace('_', ' ').capitalize()} for the current character.")
+    lines.append(f"{pad}def {name}" + (f"({', '.join(params)})" if params else ''))
+    for _ in range(rng.randint(2, 14)):
+        noun = rng.choice(_NOUNS)
+        roll = rng.random()
+        if roll < 0.25:
+            lines.append(f"{pad}  if @{noun} && @{noun} =~ /^{noun}s? (\\w+)/")
+            lines.append(f"{pad}    result = \"#{{$1}} #{{@{noun}.inspect}}\"")
+            lines.append(f"{pad}  end")
+        elif roll < 0.4:
+            lines.append(f"{pad}  @{noun}s.each do |{noun}|")
+            lines.append(f"{pad}    next unless {noun}.respond_to?(:{rng.choice(_VERBS)})")
+            lines.append(f"{pad}    respond \"{noun}: #{{{noun}}}\"")
+            lines.append(f"{pad}  end")
+        elif roll < 0.5:
+            lines.append(f"{pad}  case {noun}")
+            lines.append(f"{pad}  when String then {noun}.strip")
+            lines.append(f"{pad}  when Integer then {noun}.to_s")
+            lines.append(f"{pad}  end")
+        elif roll < 0.55:
+            lines.append(f"{pad}  message = <<~TEXT")
+            lines.append(f"{pad}    The {noun} end is not a keyword here.")
+            lines.append(f"{pad}  TEXT")
+        else:
+            lines.append(f"{pad}  {noun} = {rng.choice(_VERBS)}_{noun}({rng.randint(0, 99)}) unless {noun}")
+    lines.append(f"{pad}end")
+    return lines
+
+
+def _ruby_file(rng, stem, target_lines, top_level=False):
+    """A module/class file (or a global_defs-style file of top-level defs) of about target_lines lines"""
+    lines = ['# frozen_string_literal: true', '']
+    indent = 0
+    closers = []
+    if not top_level:
+        class_name = ''.join(part.capitalize() for part in stem.split('_'))
+        lines += ['module Lich', '  module Common', f"    # Synthetic {class_name} for benchmarking.",
+                  f"    class {class_name}"]
+        indent, closers = 6, ['    end', '  end', 'end']
+        lines.append(f"{' ' * indent}attr_accessor :{rng.choice(_NOUNS)}, :{rng.choice(_NOUNS)}")
+        lines.append('')
+    count = 0
+    while len(lines) < target_lines:
+        name = f"{rng.choice(_VERBS)}_{rng.choice(_NOUNS)}_{count}"
+        if not top_level and rng.random() < 0.15:
+            name = f"self.{name}"
+        lines += _ruby_method(rng, name, indent)
+        lines.append('')
+        count += 1
+    return '\n'.join(lines + closers) + '\n'
+
+
+def generate_corpus(root, scale=1.0, seed=0):
+    """
+    Write a synthetic Ruby corpus modeled on src/lib into root.
+
+    At scale 1 that is 88 small files (median ~130 lines, long tail to
+    ~1500) and 2 huge files of top-level defs (~3700 lines each).
+
+    Args:
+        root: Directory to fill (created if needed)
+        scale: Multiplier on the number of files
+        seed: Seed for every random choice, so corpora are reproducible
+
+    Returns:
+        Total number of lines written
+    """
+    rng = random.Random(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    total = 0
+    for i in range(max(1, round(88 * scale))):
+        stem = f"{rng.choice(_NOUNS)}_{i}"
+        size = min(1600, max(30, int(rng.lognormvariate(4.9, 0.8))))
+        package = root / rng.choice(['common', 'gemstone', 'util', 'gemstone/psms'])
+        package.mkdir(parents=True, exist_ok=True)
+        text = _ruby_file(rng, stem, size)
+        (package / f"{stem}.rb").write_text(text, encoding='utf-8')
+        total += text.count('\n')
+    for i in range(max(1, round(2 * scale))):
+        text = _ruby_file(rng, f"global_defs_{i}", 3700, top_level=True)
+        (root / f"global_defs_{i}.rb").write_text(text, encoding='utf-8')
+        total += text.count('\n')
+    return total
+
+
+# ----------------------------------------------------------------------
+#  Measurements
+# ----------------------------------------------------------------------
+def _io_counters():
+    """Bytes read and written by this process so far (Linux /proc, else zeros)"""
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _measure(phase, server, action):
+    """Run action() and return its wall time, calls, I/O volume and peak RSS"""
+    calls, throttled = server.calls, server.throttled
+    read_before, written_before = _io_counters()
+    started = time.perf_counter()
+    action()
+    wall = time.perf_counter() - started
+    read_after, written_after = _io_counters()
+    calls = server.calls - calls
+    return {
+        'phase': phase,
+        'wall_s': round(wall, 3),
+        'calls': calls,
+        'calls_per_s': round(calls / wall, 2) if wall > 0 else 0.0,
+        'throttled': server.throttled - throttled,
+        'read_mb': round((read_after - read_before) / 1e6, 2),
+        'written_mb': round((written_after - written_before) / 1e6, 2),
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+    }
+
+
+def run_benchmark(scale=1.0, seed=0, concurrency=4, latency=0.1, tps=500.0, rate_429=0.0,
+                  formats=('yard', 'markdown', 'annotated'), generator_options=None, keep=None, batch=False):
+    """
+    Benchmark one full run against the fake server.
+
+    Args:
+        generator_options: Extra Lich5DocumentationGenerator keyword arguments
+        batch: Analyze through the Batch API (process_batch) instead of live calls
+        keep: Directory to keep the corpus and output in (a temporary one otherwise)
+
+    Returns:
+        A report dict with the corpus shape and one entry per phase
+    """
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    from guide import Lich5DocumentationGenerator
+
+    workdir = Path(keep) if keep else Path(tempfile.mkdtemp(prefix='lich5-bench-'))
+    server = FakeOpenAIServer(latency=latency, tps=tps, rate_429=rate_429, seed=seed).start()
+    try:
+        corpus = workdir / 'corpus'
+        lines = generate_corpus(corpus, scale=scale, seed=seed)
+        # Keep results and caches out of the project's documentation/ tree
+        generator = Lich5DocumentationGenerator(input_dir=corpus, concurrency=concurrency, use_cache=False,
+                                                base_url=server.base_url, output_dir=workdir / 'output',
+                                                cache_dir=workdir / 'cache', **(generator_options or {}))
+
+        if batch:
+            phases = [_measure('process_batch', server,
+                               lambda: generator.process_batch(','.join(formats), poll_interval=0))]
+        else:
+            phases = [_measure('process_directory', server, generator.process_directory)]
+        for fmt in formats:
+            phases.append(_measure(f"generate_{fmt}", server, lambda fmt=fmt: generator.generate_documentation(fmt)))
+        return {
+            'corpus': {'files': len(list(corpus.rglob('*.rb'))), 'lines': lines, 'scale': scale, 'seed': seed},
+            'server': {'latency': latency, 'tps': tps, 'rate_429': rate_429},
+            'concurrency': concurrency,
+            'batched_requests': server.batched,
+            'completion_tokens': server.completion_tokens,
+            'phases': phases,
+            'total_wall_s': round(sum(p['wall_s'] for p in phases), 3),
+        }
+    finally:
+        server.stop()
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare_reports(report, baseline, tolerance):
+    """Phases whose wall time grew by more than tolerance (a fraction) over the baseline"""
+    before = {p['phase']: p for p in baseline['phases']}
+    regressions = []
+    for phase in report['phases']:
+        old = before.get(phase['phase'])
+        if old and old['wall_s'] > 0 and phase['wall_s'] > old['wall_s'] * (1 + tolerance):
+            regressions.append((phase['phase'], old['wall_s'], phase['wall_s']))
+    return regressions
+
+
+def print_report(report):
+    corpus = report['corpus']
+    print(f"Corpus: {corpus['files']} files, {corpus['lines']} lines (scale {corpus['scale']}, seed {corpus['seed']})")
+    print(f"{'phase':<22}{'wall s':>9}{'calls':>8}{'calls/s':>9}{'429s':>6}{'read MB':>9}{'write MB':>10}{'RSS MB':>8}")
+    for p in report['phases']:
+        print(f"{p['phase']:<22}{p['wall_s']:>9.2f}{p['calls']:>8}{p['calls_per_s']:>9.1f}{p['throttled']:>6}"
+              f"{p['read_mb']:>9.2f}{p['written_mb']:>10.2f}{p['peak_rss_mb']:>8.1f}")
+    if report.get('batched_requests'):
+        print(f"Batched requests: {report['batched_requests']}")
+    print(f"Total wall time: {report['total_wall_s']:.2f}s, {report['completion_tokens']} completion tokens")
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark guide.py against a local fake OpenAI server')
+    parser.add_argument('--scale', help='Corpus size relative to src/lib', type=float, default=1.0)
+    parser.add_argument('--seed', help='Seed for the corpus and the 429 draws', type=int, default=0)
+    parser.add_argument('--concurrency', help='Files analyzed in parallel', type=int, default=4)
+    parser.add_argument('--latency', help='Fake server seconds before the first token', type=float, default=0.1)
+    parser.add_argument('--tps', help='Fake server completion tokens per second', type=float, default=500.0)
+    parser.add_argument('--rate-429', help='Fraction of requests refused with 429', type=float, default=0.0)
+    parser.add_argument('--format', help='Formats to generate after analysis (comma-separated)',
+                        default='yard,markdown,annotated')
+    parser.add_argument('--stream', help='Benchmark the streaming code path', action='store_true')
+    parser.add_argument('--batch', help='Benchmark the Batch API code path (guide.py --batch)', action='store_true')
+    parser.add_argument('--keep', help='Keep corpus and output in this directory', default=None)
+    parser.add_argument('--json', help='Write the report to this file', default=None)
+    parser.add_argument('--compare', help='Baseline report to check for regressions', default=None)
+    parser.add_argument('--tolerance', help='Allowed wall-time growth over the baseline', type=float, default=0.15)
+    parser.add_argument('--verbose', help='Show guide.py log output', action='store_true')
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(Path(__file__).parent))
+    import guide  # noqa: F401 - configures logging on import
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    report = run_benchmark(scale=args.scale, seed=args.seed, concurrency=args.concurrency,
+                           latency=args.latency, tps=args.tps, rate_429=args.rate_429,
+                           formats=[fmt.strip() for fmt in args.format.split(',') if fmt.strip()],
+                           generator_options={'stream': args.stream}, keep=args.keep, batch=args.batch)
+    print_report(report)
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2), encoding='utf-8')
+    if args.compare:
+        regressions = compare_reports(report, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for phase, old, new in regressions:
+            print(f"REGRESSION: {phase} took {new:.2f}s, baseline {old:.2f}s")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+Build a prefix-sharded search index for the YARD site in docs/.
+
+Every class, module, method and constant is read from the generated pages
+(class_list.html, method_list.html and the <dt id="...-constant"> entries of
+each namespace page) and split into search terms: the lower-cased name plus
+its camelCase / snake_case words. Terms are grouped by their first two
+characters into small JSON shards under docs/search/, so the browser only
+fetches the shard for what is being typed instead of the 367 KB method list.
+
+    python build_search_index.py                  # index ../docs
+    python build_search_index.py --inject         # also add the search box to every page
+"""
+import re
+import json
+import html
+import logging
+from pathlib import Path
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Characters of a term prefix that appear verbatim in shard file names
+_SAFE_KEY_CHAR = re.compile(r'[a-z0-9_]')
+
+_LIST_LINK = re.compile(r'<a href="([^"]+)" title="([^"]+) \((module|class|method)\)">([^<]*)</a>')
+_CONSTANT = re.compile(r'<dt id="([^"]+)-constant"')
+_WORD = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+
+def shard_key(term, prefix_length=2):
+    """File-name-safe shard key for a term (search_index.js computes the same)"""
+    return ''.join(c if _SAFE_KEY_CHAR.match(c) else f"-{ord(c):x}" for c in term[:prefix_length])
+
+
+def search_terms(name):
+    """The lower-cased name plus each of its camelCase / snake_case words"""
+    terms = {name.lower()}
+    terms.update(word.lower() for word in _WORD.findall(name) if len(word) > 1)
+    return terms
+
+
+def collect_entries(docs_dir):
+    """
+    Read every documented object from a YARD site.
+
+    Returns:
+        List of [name, full name, kind, url] rows, with urls relative to docs_dir
+    """
+    docs_dir = Path(docs_dir)
+    entries = []
+    for list_page in ('class_list.html', 'method_list.html'):
+        text = (docs_dir / list_page).read_text(encoding='utf-8')
+        for url, title, kind, label in _LIST_LINK.findall(text):
+            full_name = html.unescape(title)
+            name = html.unescape(label).lstrip('#.') if kind == 'method' else full_name.split('::')[-1]
+            entries.append([name, full_name, kind, html.unescape(url)])
+
+    for page in sorted(docs_dir.rglob('*.html')):
+        relative = page.relative_to(docs_dir).as_posix()
+        if relative.endswith('_list.html') or relative in ('index.html', '_index.html', 'frames.html'):
+            continue
+        namespace = '' if relative == 'top-level-namespace.html' else relative[:-len('.html')].replace('/', '::')
+        for constant in _CONSTANT.findall(page.read_text(encoding='utf-8')):
+            full_name = f"{namespace}::{constant}" if namespace else constant
+            entries.append([constant, full_name, 'constant', f"{relative}#{constant}-constant"])
+    return entries
+
+
+def build_shards(entries, prefix_length=2):
+    """
+    Group entries into shards keyed by term prefix.
+
+    Each shard is {"rows": [[name, full name, kind, url], ...], "terms": {term: [row, ...]}}
+    and holds every row any of its terms points at, so one fetch answers a query.
+    """
+    shards = {}
+    for entry in entries:
+        for term in sorted(search_terms(entry[0])):
+            shard = shards.setdefault(shard_key(term, prefix_length), {'rows': [], 'terms': {}, 'index': {}})
+            row = shard['index'].get(id(entry))
+            if row is None:
+                row = shard['index'][id(entry)] = len(shard['rows'])
+                shard['rows'].append(entry)
+            shard['terms'].setdefault(term, []).append(row)
+    for shard in shards.values():
+        del shard['index']
+    return shards
+
+
+def write_index(docs_dir, prefix_length=2):
+    """Write docs/search/*.json and docs/js/search_index.js; returns (entries, shards, bytes written)"""
+    docs_dir = Path(docs_dir)
+    entries = collect_entries(docs_dir)
+    shards = build_shards(entries, prefix_length)
+
+    out_dir = docs_dir / 'search'
+    out_dir.mkdir(exist_ok=True)
+    for stale in out_dir.glob('*.json'):
+        stale.unlink()
+
+    written = 0
+    for key, shard in shards.items():
+        data = json.dumps(shard, separators=(',', ':'))
+        (out_dir / f"{key}.json").write_text(data, encoding='utf-8')
+        written += len(data)
+    manifest = {'prefix': prefix_length, 'entries': len(entries), 'shards': sorted(shards)}
+    (out_dir / 'manifest.json').write_text(json.dumps(manifest, separators=(',', ':')), encoding='utf-8')
+
+    (docs_dir / 'js' / 'search_index.js').write_text(SEARCH_CLIENT, encoding='utf-8')
+    return len(entries), len(shards), written
+
+
+_APP_SCRIPT = re.compile(r'<script type="text/javascript" charset="utf-8" src="((?:\.\./)*)js/app\.js"></script>')
+
+
+def inject_search_box(docs_dir):
+    """Load search_index.js from every page that loads app.js, relative to the page (idempotent)"""
+    added = 0
+    for page in sorted(Path(docs_dir).rglob('*.html')):
+        text = page.read_text(encoding='utf-8')
+        anchor = _APP_SCRIPT.search(text)
+        if anchor is None or 'js/search_index.js' in text:
+            continue
+        tag = f'<script type="text/javascript" charset="utf-8" src="{anchor.group(1)}js/search_index.js"></script>'
+        page.write_text(text[:anchor.end()] + f"\n  {tag}" + text[anchor.end():], encoding='utf-8')
+        added += 1
+    logging.info(f"Added the search box to {added} pages")
+
+
+SEARCH_CLIENT = r"""// Generated by project-guide/build_search_index.py - do not edit.
+// Prefix-sharded search: a query fetches docs/search/<first two chars>.json only.
+(function () {
+  var script = document.currentScript;
+  var base = script ? script.src.replace(/js\/search_index\.js.*$/, '') : '';
+  var shards = {};
+  var manifest = null;
+
+  function getJSON(url) {
+    return fetch(url).then(function (r) { return r.ok ? r.json() : null; });
+  }
+
+  function shardKey(term, length) {
+    return term.slice(0, length).split('').map(function (c) {
+      return /[a-z0-9_]/.test(c) ? c : '-' + c.charCodeAt(0).toString(16);
+    }).join('');
+  }
+
+  function loadShard(key) {
+    if (!(key in shards)) {
+      shards[key] = manifest.then(function (m) {
+        return m && m.shards.indexOf(key) >= 0 ? getJSON(base + 'search/' + key + '.json') : null;
+      });
+    }
+    return shards[key];
+  }
+
+  // 'map find': terms starting with the first word, full names containing the others.
+  // 'Common::Map', 'Map.find', 'Map#check': terms starting with the last segment, and the
+  // namespace segments right before the name starting with the earlier ones.
+  function search(query, limit) {
+    var qualified = /::|#|\./.test(query);
+    var words = query.toLowerCase().split(/\s+|::|#|\./).filter(Boolean);
+    if (!words.length) return Promise.resolve([]);
+    var target = qualified ? words[words.length - 1] : words[0];
+    var others = qualified ? words.slice(0, -1) : words.slice(1);
+
+    function matches(full) {
+      if (!qualified) return others.every(function (w) { return full.indexOf(w) >= 0; });
+      var segments = full.split(/::|#|\./), offset = segments.length - 1 - others.length;
+      return offset >= 0 && others.every(function (w, i) { return segments[offset + i].indexOf(w) === 0; });
+    }
+
+    manifest = manifest || getJSON(base + 'search/manifest.json');
+    return manifest.then(function (m) {
+      return loadShard(shardKey(target, m ? m.prefix : 2)).then(function (shard) {
+        if (!shard) return [];
+        var seen = {}, results = [];
+        Object.keys(shard.terms).forEach(function (term) {
+          if (term.indexOf(target) !== 0) return;
+          shard.terms[term].forEach(function (row) {
+            if (seen[row]) return;
+            var entry = shard.rows[row];
+            if (matches(entry[1].toLowerCase())) {
+              seen[row] = true;
+              var name = entry[0].toLowerCase();
+              var rank = name === target ? 0 : name.indexOf(target) === 0 ? 1 : 2;
+              results.push({name: entry[0], fullName: entry[1], kind: entry[2],
+                            url: base + entry[3], rank: rank});
+            }
+          });
+        });
+        results.sort(function (a, b) { return a.rank - b.rank || a.name.length - b.name.length; });
+        return results.slice(0, limit || 50);
+      });
+    });
+  }
+
+  window.LichSearch = {search: search};
+
+  function attach() {
+    var holder = document.getElementById('search');
+    if (!holder || document.getElementById('lich-search-input')) return;
+    var input = document.createElement('input');
+    input.id = 'lich-search-input';
+    input.type = 'search';
+    input.placeholder = 'Search classes, methods, constants';
+    input.style.cssText = 'margin-right:8px;padding:3px 6px;width:16em';
+    var list = document.createElement('ul');
+    list.id = 'lich-search-results';
+    list.style.cssText = 'position:absolute;z-index:10;background:#fff;border:1px solid #ccc;' +
+                         'list-style:none;margin:0;padding:0;max-height:60vh;overflow:auto;display:none';
+    holder.insertBefore(list, holder.firstChild);
+    holder.insertBefore(input, holder.firstChild);
+    var pending = 0;
+    input.addEventListener('input', function () {
+      var ticket = ++pending;
+      search(input.value, 50).then(function (results) {
+        if (ticket !== pending) return;
+        list.innerHTML = '';
+        results.forEach(function (r) {
+          var li = document.createElement('li'), a = document.createElement('a');
+          a.href = r.url;
+          a.textContent = r.fullName;
+          a.title = r.kind;
+          li.style.padding = '2px 6px';
+          li.appendChild(a);
+          list.appendChild(li);
+        });
+        list.style.display = results.length ? 'block' : 'none';
+      });
+    });
+  }
+
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', attach);
+  } else {
+    attach();
+  }
+})();
+"""
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the prefix-sharded search index for the YARD site')
+    parser.add_argument('--docs', help='YARD site directory',
+                        default=str(Path(__file__).parent.parent / 'docs'))
+    parser.add_argument('--prefix', help='Characters of each term used as its shard key', type=int, default=2)
+    parser.add_argument('--inject', help='Add the search box to every page of the site', action='store_true')
+    args = parser.parse_args()
+
+    entries, shards, written = write_index(args.docs, args.prefix)
+    logging.info(f"Indexed {entries} objects into {shards} shards "
+                 f"({written / 1024:.0f} KB total, {written / max(shards, 1) / 1024:.1f} KB per shard on average)")
+    if args.inject:
+        inject_search_box(args.docs)
+
+
+if __name__ == "__main__":
+    main()
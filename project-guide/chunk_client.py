@@ -0,0 +1,78 @@
+"""
+Thin client for a resident `guide.py --serve` chunk server.
+
+Reads a code snippet from stdin (or --input), sends it over the server's Unix
+socket and prints the YARD documentation. It imports nothing beyond the
+standard library, so editor integrations pay only for the model call:
+
+    python guide.py --serve &                        # once, keeps the client warm
+    python chunk_client.py < snippet.rb              # documentation on stdout
+    python chunk_client.py --file cman.rb --json     # full reply, including timing
+    python chunk_client.py --stats
+"""
+import os
+import sys
+import json
+import socket
+import tempfile
+from pathlib import Path
+
+# Must match DEFAULT_CHUNK_SOCKET in guide.py
+DEFAULT_SOCKET = Path(tempfile.gettempdir()) / f"lich5-guide-{os.getuid() if hasattr(os, 'getuid') else 0}.sock"
+
+
+def request(payload, path=DEFAULT_SOCKET, timeout=600):
+    """
+    Send one request to the chunk server and return its decoded reply.
+
+    Args:
+        payload: {"code": ..., "file": ...} or {"op": "stats"}
+        path: Server socket
+        timeout: Seconds to wait for the reply (model calls can be slow)
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+        sock.sendall((json.dumps(payload) + '\n').encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        data = b''
+        while not data.endswith(b'\n'):
+            part = sock.recv(65536)
+            if not part:
+                break
+            data += part
+    return json.loads(data)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Document a code chunk through a running guide.py --serve')
+    parser.add_argument('--socket', help='Server socket', default=str(DEFAULT_SOCKET))
+    parser.add_argument('--file', help='Name to document the chunk under (default: derived from its content)')
+    parser.add_argument('--input', help='Read the chunk from this file instead of stdin')
+    parser.add_argument('--json', help='Print the full JSON reply', action='store_true')
+    parser.add_argument('--stats', help='Print server counters and exit', action='store_true')
+    args = parser.parse_args()
+
+    if args.stats:
+        payload = {'op': 'stats'}
+    else:
+        code = Path(args.input).read_text(encoding='utf-8') if args.input else sys.stdin.read()
+        payload = {'code': code, 'file': args.file}
+
+    try:
+        reply = request(payload, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sys.exit(f"No chunk server on {args.socket}; start one with: python guide.py --serve")
+
+    if args.json or args.stats:
+        print(json.dumps(reply, indent=2))
+    elif 'error' in reply:
+        sys.exit(reply['error'])
+    else:
+        print(reply['doc'])
+
+
+if __name__ == "__main__":
+    main()
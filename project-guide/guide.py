@@ -1,61 +1,1961 @@
 import os
 import logging
 import json
+import html
 import re
+import hashlib
+import tempfile
+import random
+import socketserver
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from bisect import bisect_left
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
 from pathlib import Path
-from datetime import datetime
-import openai
+from datetime import datetime, timezone
 
-# import anthropic
+# Model SDKs (openai, anthropic) are imported by their backend on first use
+
+try:
+    import tiktoken
+except ImportError:  # optional: token counts fall back to a character estimate
+    tiktoken = None
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Where `guide.py --serve` listens and chunk_client.py connects by default
+DEFAULT_CHUNK_SOCKET = Path(tempfile.gettempdir()) / f"lich5-guide-{os.getuid() if hasattr(os, 'getuid') else 0}.sock"
+
+# Output formats generate_documentation understands, in the order 'all' emits them
+OUTPUT_FORMATS = ('yard', 'markdown', 'annotated', 'html')
+
+
+def parse_output_formats(value):
+    """Turn 'yard,markdown' / 'all' / a list into a de-duplicated list of formats"""
+    items = value.split(',') if isinstance(value, str) else list(value)
+    formats = []
+    for item in (i.strip().lower() for i in items):
+        for fmt in (OUTPUT_FORMATS if item == 'all' else (item,)):
+            if fmt and fmt not in formats:
+                formats.append(fmt)
+    return formats
+
+
+class ResponseCache:
+    """
+    Disk-backed cache of model responses keyed on the full request.
+
+    Entries live in ``<root>/<key[:2]>/<key>.json``. Reads refresh an entry's
+    mtime, so eviction by oldest mtime is least-recently-used. Entries older
+    than max_age_days are treated as misses and removed; once the cache grows
+    past max_bytes the least recently used entries are dropped until it is
+    back under 90% of the limit.
+    """
+
+    def __init__(self, root, max_bytes=512 * 1024 * 1024, max_age_days=30):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None            # summed on first write; the directory is created by the first put too
+
+    @staticmethod
+    def key(model, system_prompt, messages, max_tokens, temperature):
+        """Stable hash of every request parameter that affects the completion"""
+        payload = json.dumps([model, system_prompt, messages, max_tokens, temperature],
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.root / key[:2] / f"{key}.json"
+
+    def _entries(self):
+        return self.root.glob('*/*.json')
+
+    def _known_size(self):
+        # Caller holds _lock
+        if self._size is None:
+            self._size = sum(p.stat().st_size for p in self._entries())
+        return self._size
+
+    def __contains__(self, key):
+        return self._path(key).exists()
+
+    def get(self, key):
+        """Return the cached response text for key, or None"""
+        path = self._path(key)
+        try:
+            stat = path.stat()
+            if time.time() - stat.st_mtime > self.max_age:
+                self._remove(path)
+                raise FileNotFoundError(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                text = json.load(f)['response']
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return text
+
+    def put(self, key, text):
+        """Store a response and evict old entries if the size limit is exceeded"""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps({'response': text})
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size = self._known_size() + path.stat().st_size
+            over_limit = self._size > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except OSError:
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size -= size
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under 90% of max_bytes"""
+        now = time.time()
+        entries = []
+        for path in self._entries():
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.max_age:
+                self._remove(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        target = int(self.max_bytes * 0.9)
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+        with self._lock:
+            self._size = total
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self._known_size()}
+
+
+class FenceWatcher:
+    """
+    Follows a streamed response and notices when its first fenced block closes.
+
+    Text is fed as it arrives; only complete lines are inspected, each once,
+    so watching a response costs time linear in its length.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+        self._pending = ''
+        self._open = False
+
+    def feed(self, text):
+        """Add streamed text; returns True once the closing fence has been seen"""
+        self.parts.append(text)
+        self._pending += text
+        *lines, self._pending = self._pending.split('\n')
+        for line in lines:
+            if line.strip().startswith('```'):
+                if self._open:
+                    self.closed = True
+                    break
+                self._open = True
+        return self.closed
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+def retry_after_seconds(error):
+    """Server-requested wait from a Retry-After(-ms) header, or None"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+# ----------------------------------------------------------------------
+#  Model backends – each imports its SDK on first use
+# ----------------------------------------------------------------------
+TokenUsage = namedtuple('TokenUsage', 'prompt_tokens completion_tokens')
+
+
+class ModelBackend:
+    """
+    What the generator needs from a model API.
+
+    complete() returns (text, usage, finish_reason); usage exposes
+    prompt_tokens / completion_tokens and finish_reason is 'length' when the
+    answer hit max_tokens. stream() yields (delta, usage, finish_reason) as
+    they arrive. Nothing is imported or connected until the first call, so
+    runs that never reach the model need neither the SDK nor an API key.
+    """
+
+    name = 'base'
+    default_routes = None        # DEFAULT_ROUTES overrides naming this backend's models
+    supports_batch = False
+
+    @property
+    def client(self):
+        raise RuntimeError(f"The {self.name} backend has no OpenAI client (needed for --batch)")
+
+    def complete(self, model, messages, max_tokens, temperature):
+        raise NotImplementedError
+
+    def stream(self, model, messages, max_tokens, temperature):
+        yield self.complete(model, messages, max_tokens, temperature)
+
+    def retryable_errors(self):
+        """Errors worth another attempt; anything else (bad request, auth) fails at once"""
+        return ()
+
+    def is_throttle(self, error):
+        """True when error means the provider is rate limiting us"""
+        return False
+
+
+def _http_client_options(sdk, http_keepalive):
+    """SDK client options keeping idle connections open for http_keepalive seconds"""
+    if not http_keepalive:
+        return {}
+    limits = sdk.DEFAULT_CONNECTION_LIMITS
+    return {'http_client': sdk.DefaultHttpxClient(limits=type(limits)(
+        max_connections=limits.max_connections,
+        max_keepalive_connections=limits.max_keepalive_connections,
+        keepalive_expiry=http_keepalive,
+    ))}
+
+
+class OpenAIBackend(ModelBackend):
+    """
+    OpenAI Chat Completions, or any compatible endpoint given as base_url.
+
+    Args:
+        base_url: Alternative OpenAI-compatible endpoint
+        api_key: Key to use instead of OPENAI_API_KEY
+        http_keepalive: Seconds idle connections stay open for reuse
+    """
+
+    name = 'openai'
+    supports_batch = True
+
+    def __init__(self, base_url=None, api_key=None, http_keepalive=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.http_keepalive = http_keepalive
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def sdk(self):
+        import openai
+        return openai
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                # Retries are handled by _with_retries, which also adapts concurrency
+                options = {'max_retries': 0, **_http_client_options(self.sdk, self.http_keepalive)}
+                if self.base_url:
+                    options['base_url'] = self.base_url
+                if self.api_key:
+                    options['api_key'] = self.api_key
+                self._client = self.sdk.OpenAI(**options)
+            return self._client
+
+    def complete(self, model, messages, max_tokens, temperature):
+        resp = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+        )
+        choice = resp.choices[0]
+        return choice.message.content, getattr(resp, 'usage', None), getattr(choice, 'finish_reason', None)
+
+    def stream(self, model, messages, max_tokens, temperature):
+        stream = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            for event in stream:
+                usage = getattr(event, 'usage', None)
+                if not event.choices:
+                    if usage:
+                        yield None, usage, None
+                    continue
+                choice = event.choices[0]
+                yield choice.delta.content, usage, getattr(choice, 'finish_reason', None)
+        finally:
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+
+    def retryable_errors(self):
+        return (self.sdk.RateLimitError, self.sdk.APIConnectionError, self.sdk.InternalServerError)
+
+    def is_throttle(self, error):
+        return isinstance(error, self.sdk.RateLimitError)
+
+
+class LocalBackend(OpenAIBackend):
+    """An OpenAI-compatible server on this machine (llama.cpp, vLLM, Ollama, LM Studio); no API key needed"""
+
+    name = 'local'
+    supports_batch = False
+
+    def __init__(self, base_url=None, api_key=None, http_keepalive=None):
+        super().__init__(base_url or 'http://127.0.0.1:8080/v1', api_key or 'local', http_keepalive)
+
+
+ANTHROPIC_ROUTES = {
+    'analysis': [
+        (2000, [('claude-haiku-4-5', 4096), ('claude-haiku-4-5', 8192), ('claude-sonnet-4-5', 8192)]),
+        (None, [('claude-haiku-4-5', 8192), ('claude-sonnet-4-5', 16384)]),
+    ],
+    'annotation': [
+        (None, [('claude-haiku-4-5', 4096), ('claude-haiku-4-5', 8192), ('claude-sonnet-4-5', 8192)]),
+    ],
+}
+
+
+class AnthropicBackend(OpenAIBackend):
+    """Anthropic Messages API; system messages are passed in the separate system field"""
+
+    name = 'anthropic'
+    default_routes = ANTHROPIC_ROUTES
+    supports_batch = False
+
+    @property
+    def sdk(self):
+        import anthropic
+        return anthropic
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                options = {'max_retries': 0, **_http_client_options(self.sdk, self.http_keepalive)}
+                if self.base_url:
+                    options['base_url'] = self.base_url
+                if self.api_key:
+                    options['api_key'] = self.api_key
+                self._client = self.sdk.Anthropic(**options)
+            return self._client
+
+    @staticmethod
+    def _request(model, messages, max_tokens, temperature):
+        system = '\n\n'.join(m['content'] for m in messages if m['role'] == 'system')
+        request = {'model': model, 'max_tokens': max_tokens, 'temperature': temperature,
+                   'messages': [m for m in messages if m['role'] != 'system']}
+        if system:
+            request['system'] = system
+        return request
+
+    @staticmethod
+    def _finish_reason(stop_reason):
+        return 'length' if stop_reason == 'max_tokens' else 'stop'
+
+    def complete(self, model, messages, max_tokens, temperature):
+        resp = self.client.messages.create(**self._request(model, messages, max_tokens, temperature))
+        text = ''.join(getattr(block, 'text', '') for block in resp.content)
+        usage = TokenUsage(resp.usage.input_tokens, resp.usage.output_tokens)
+        return text, usage, self._finish_reason(resp.stop_reason)
+
+    def stream(self, model, messages, max_tokens, temperature):
+        stream = self.client.messages.create(**self._request(model, messages, max_tokens, temperature), stream=True)
+        input_tokens = None
+        try:
+            for event in stream:
+                if event.type == 'message_start':
+                    input_tokens = event.message.usage.input_tokens
+                elif event.type == 'content_block_delta':
+                    yield getattr(event.delta, 'text', None), None, None
+                elif event.type == 'message_delta':
+                    yield (None, TokenUsage(input_tokens, event.usage.output_tokens),
+                           self._finish_reason(event.delta.stop_reason))
+        finally:
+            close = getattr(stream, 'close', None)
+            if close:
+                close()
+
+
+class ReplayBackend(ModelBackend):
+    """
+    Answers from a fixture written by RecordingBackend, looked up by request.
+
+    Makes runs reproducible offline and shows the pipeline's own throughput
+    with the model taken out. A request that was never recorded raises
+    LookupError, which is not retried.
+    """
+
+    name = 'replay'
+
+    def __init__(self, fixture):
+        self.fixture = Path(fixture)
+        self._answers = None
+        self._lock = threading.Lock()
+
+    def complete(self, model, messages, max_tokens, temperature):
+        with self._lock:
+            if self._answers is None:
+                with open(self.fixture, 'r', encoding='utf-8') as f:
+                    self._answers = {entry['key']: entry for entry in map(json.loads, f)}
+        entry = self._answers.get(ResponseCache.key(model, None, messages, max_tokens, temperature))
+        if entry is None:
+            raise LookupError(f"No answer recorded in {self.fixture} for this {model} request")
+        return entry['text'], TokenUsage(*(entry.get('usage') or (None, None))), entry.get('finish_reason')
+
+
+class RecordingBackend(ModelBackend):
+    """Pass calls to another backend and append every answer to a fixture for ReplayBackend"""
+
+    def __init__(self, backend, fixture):
+        self.backend = backend
+        self.fixture = Path(fixture)
+        self.name = f"{backend.name} (recording to {self.fixture})"
+        self.default_routes = backend.default_routes
+        self._lock = threading.Lock()
+
+    def _record(self, model, messages, max_tokens, temperature, text, usage, finish_reason):
+        entry = {'key': ResponseCache.key(model, None, messages, max_tokens, temperature), 'text': text,
+                 'finish_reason': finish_reason,
+                 'usage': [getattr(usage, 'prompt_tokens', None), getattr(usage, 'completion_tokens', None)]}
+        with self._lock:
+            with open(self.fixture, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def complete(self, model, messages, max_tokens, temperature):
+        result = self.backend.complete(model, messages, max_tokens, temperature)
+        self._record(model, messages, max_tokens, temperature, *result)
+        return result
+
+    def stream(self, model, messages, max_tokens, temperature):
+        parts, usage, finish_reason = [], None, None
+        for delta, event_usage, event_finish in self.backend.stream(model, messages, max_tokens, temperature):
+            parts.append(delta or '')
+            usage = event_usage or usage
+            finish_reason = event_finish or finish_reason
+            yield delta, event_usage, event_finish
+        # Only complete streams are recorded; one stopped early has no full answer
+        self._record(model, messages, max_tokens, temperature, ''.join(parts), usage, finish_reason)
+
+    def retryable_errors(self):
+        return self.backend.retryable_errors()
+
+    def is_throttle(self, error):
+        return self.backend.is_throttle(error)
+
+
+MODEL_BACKENDS = {'openai': OpenAIBackend, 'anthropic': AnthropicBackend, 'local': LocalBackend}
+
+
+def make_backend(name='openai', base_url=None, http_keepalive=None, fixture=None, record=None):
+    """
+    Build a backend by name: openai, anthropic, local, or replay (which needs fixture).
+
+    Args:
+        record: Fixture file every answer is appended to, for later replay
+    """
+    if name == 'replay':
+        if not fixture:
+            raise ValueError("the replay backend needs a fixture file")
+        backend = ReplayBackend(fixture)
+    else:
+        backend = MODEL_BACKENDS[name](base_url=base_url, http_keepalive=http_keepalive)
+    return RecordingBackend(backend, record) if record else backend
+
+
+class AdaptiveLimiter:
+    """
+    AIMD cap on in-flight model calls.
+
+    Every success adds 1/limit (about +1 per round of calls) unless latency
+    has drifted above latency_factor times the best observed average; a 429
+    halves the limit, at most once per cooldown so one burst counts once.
+
+    Args:
+        limit: Starting and maximum number of concurrent calls
+        minimum: Floor the limit never drops below
+        latency_factor: Latency growth over baseline that stops further increases
+        cooldown: Seconds after a decrease during which further 429s do not decrease again
+    """
+
+    def __init__(self, limit, minimum=1, latency_factor=2.0, cooldown=5.0):
+        self.maximum = max(minimum, limit)
+        self.minimum = minimum
+        self.limit = float(self.maximum)
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.throttled = 0
+        self._latency = None
+        self._baseline = None
+        self._last_decrease = float('-inf')
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def on_success(self, latency):
+        with self._cond:
+            self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            self._baseline = self._latency if self._baseline is None else min(self._baseline, self._latency)
+            if self._latency > self.latency_factor * self._baseline:
+                return
+            before = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            if int(self.limit) > before:
+                logging.info(f"Concurrency raised to {int(self.limit)}")
+                self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit / 2)
+            logging.warning(f"Rate limited; concurrency lowered to {int(self.limit)}")
+
+
+ModelRoute = namedtuple('ModelRoute', 'model max_tokens')
+
+# task -> [(largest source size in tokens or None, [first route, escalations...]), ...]
+DEFAULT_ROUTES = {
+    'analysis': [
+        (2000, [ModelRoute('gpt-4o-mini', 4096), ModelRoute('gpt-4o-mini', 8192), ModelRoute('gpt-4o', 8192)]),
+        (None, [ModelRoute('gpt-4o-mini', 8192), ModelRoute('gpt-4o', 16384)]),
+    ],
+    'annotation': [
+        (None, [ModelRoute('gpt-4o-mini', 4096), ModelRoute('gpt-4o-mini', 8192), ModelRoute('gpt-4o', 8192)]),
+    ],
+}
+
+
+class ModelRouter:
+    """
+    Picks the model and max_tokens for a request from its task and source size.
+
+    Each size tier lists a cheap first route followed by escalations, which
+    are tried in order when an answer is truncated or fails validation.
+    Routes can be overridden from a JSON file shaped like DEFAULT_ROUTES:
+    {"analysis": [[2000, [["gpt-4o-mini", 4096], ["gpt-4o", 8192]]], [null, ...]]}.
+    """
+
+    def __init__(self, routes=None):
+        self.routes = dict(DEFAULT_ROUTES)
+        for task, tiers in (routes or {}).items():
+            self.routes[task] = [(limit, [ModelRoute(*route) for route in ladder]) for limit, ladder in tiers]
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def ladder(self, task, source_tokens):
+        """Routes to try, cheapest first, for a task on source_tokens tokens of code"""
+        for limit, ladder in self.routes[task]:
+            if limit is None or source_tokens <= limit:
+                return ladder
+        return self.routes[task][-1][1]
+
+    def count(self, task, tier, outcome):
+        with self._lock:
+            key = (task, tier, outcome)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class RunTrace:
+    """
+    Timed spans of one run, exportable as a Chrome trace (chrome://tracing, Perfetto).
+
+    Spans nest per thread; note() attaches figures such as token counts or
+    bytes written to the innermost open span. A disabled trace records nothing.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield args
+            return
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(args)
+        started = time.perf_counter()
+        try:
+            yield args
+        finally:
+            ended = time.perf_counter()
+            stack.pop()
+            event = {
+                'name': name,
+                'ph': 'X',
+                'ts': round((started - self._origin) * 1e6),
+                'dur': round((ended - started) * 1e6),
+                'pid': os.getpid(),
+                'tid': threading.get_native_id(),
+                'args': args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def note(self, **args):
+        """Attach values to the innermost open span of the calling thread"""
+        stack = getattr(self._local, 'stack', None)
+        if self.enabled and stack:
+            stack[-1].update(args)
+
+    def summary(self):
+        """Count and total seconds per span name, slowest first"""
+        totals = {}
+        with self._lock:
+            events = list(self.events)
+        for event in events:
+            count, seconds = totals.get(event['name'], (0, 0.0))
+            totals[event['name']] = (count + 1, seconds + event['dur'] / 1e6)
+        return sorted(totals.items(), key=lambda item: -item[1][1])
+
+    def export(self, path):
+        """Write the recorded spans in Chrome trace event format"""
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event['ts'])
+        trace = {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'otherData': {name: {'count': count, 'seconds': round(seconds, 3)}
+                          for name, (count, seconds) in self.summary()},
+        }
+        Path(path).write_text(json.dumps(trace), encoding='utf-8')
+
+
+def traced(name):
+    """Run a generator method inside a span of self.trace"""
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.trace.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+# ----------------------------------------------------------------------
+#  Lightweight Ruby structure scanner
+# ----------------------------------------------------------------------
+RubyBlock = namedtuple('RubyBlock', 'kind name start end depth')
+RubyBlock.__doc__ = """A class/module/def found by scan_ruby_blocks (0-based, inclusive line range)"""
+
+_RUBY_SYMBOL_KINDS = ('class', 'module', 'def')
+_RUBY_ALWAYS_OPENERS = ('class', 'module', 'def', 'case', 'begin', 'do')
+_RUBY_STATEMENT_OPENERS = ('if', 'unless', 'while', 'until', 'for')
+_RUBY_LOOP_KEYWORDS = ('while', 'until', 'for')
+# Characters after which a keyword starts a new expression rather than
+# acting as a modifier (`x = if ...` opens a block, `foo if x` does not)
+_RUBY_EXPR_START = set(';=(,[{|&?:!+-*/<>%^~')
+_RUBY_PAIRS = {'(': ')', '[': ']', '{': '}', '<': '>'}
+_RUBY_HEREDOC = re.compile(r"<<([~-]?)(['\"`]?)([A-Za-z_]\w*)\2")
+_RUBY_METHOD_NAME = r"(?:self\.|[A-Za-z_]\w*\.)?(?:[A-Za-z_]\w*[?!=]?|\[\]=?|<=>|===?|=~|![=~]?|[<>]=?|<<|>>|[-+*/%&|^~]@?|\*\*)"
+_RUBY_DEF_NAME = re.compile(rf"\bdef\s+({_RUBY_METHOD_NAME})")
+# `def name(args) = expr` has no `end`; setters (`def name=(v)`) and operators (`def <=>(o)`) do
+_RUBY_ENDLESS_DEF = re.compile(rf"^\s*def\s+{_RUBY_METHOD_NAME}(?:\s*\([^)]*\)\s*|\s+)=(?![=~>])")
+_RUBY_SCOPE_NAME = re.compile(r"\b(class|module)\s+(<<\s*\w+|[A-Z][\w:]*)")
+
+
+def _scan_ruby_line(line, state):
+    """
+    Tokenize one line of Ruby, skipping strings, regexps and comments.
+
+    Returns (words, heredocs) where words is a list of (word, prev_char,
+    next_char) for every bare identifier outside literals. ``state`` carries an
+    unterminated literal across lines as [closer, opener, depth].
+    """
+    words = []
+    heredocs = []
+    i = 0
+    n = len(line)
+    prev = None            # last significant character outside literals
+
+    def starts_literal(i):
+        # A literal can start where an expression can, or after a space when
+        # the next character is not one (`when /re/` vs `a / b`)
+        if prev is None or prev in _RUBY_EXPR_START:
+            return True
+        return i > 0 and line[i - 1] in ' \t' and i + 1 < n and line[i + 1] not in ' \t='
+
+    def skip_interpolation(i):
+        # i points just past '#{'; returns the index after the matching '}'
+        depth = 1
+        while i < n:
+            c = line[i]
+            if c in '"\'`' or (c == '/' and line[:i].rstrip()[-1:] in ('(', ',', '~', '=')):
+                end, _ = skip_literal(i + 1, c, None, 1)
+                if end is None:
+                    return n
+                i = end
+                continue
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    return i + 1
+            i += 1
+        return n
+
+    def skip_literal(i, closer, opener, depth):
+        # Returns index after the literal, or None if it runs past EOL
+        interpolates = closer != "'"
+        while i < n:
+            c = line[i]
+            if c == '\\':
+                i += 2
+                continue
+            if interpolates and c == '#' and line.startswith('#{', i):
+                i = skip_interpolation(i + 2)
+                continue
+            if opener and c == opener:
+                depth += 1
+            elif c == closer:
+                depth -= 1
+                if depth == 0:
+                    return i + 1, depth
+            i += 1
+        return None, depth
+
+    if state:
+        closer, opener, depth = state
+        end, depth = skip_literal(0, closer, opener, depth)
+        if end is None:
+            state[2] = depth
+            return words, heredocs
+        state.clear()
+        i = end
+        prev = 'x'
+
+    while i < n:
+        c = line[i]
+        if c in ' \t\r':
+            i += 1
+            continue
+        if c == '#':
+            break
+        if c in '"\'`':
+            end, depth = skip_literal(i + 1, c, None, 1)
+            if end is None:
+                state.extend([c, None, depth])
+                break
+            i, prev = end, 'x'
+            continue
+        if c == '%' and i + 1 < n and starts_literal(i):
+            j = i + 1
+            if line[j] in 'qQwWiIrsx':
+                j += 1
+            if j < n and not line[j].isalnum() and line[j] != ' ':
+                opener = line[j]
+                closer = _RUBY_PAIRS.get(opener, opener)
+                end, depth = skip_literal(j + 1, closer, opener if closer != opener else None, 1)
+                if end is None:
+                    state.extend([closer, opener if closer != opener else None, depth])
+                    break
+                i, prev = end, 'x'
+                continue
+        if c == '/' and starts_literal(i):
+            end, depth = skip_literal(i + 1, '/', None, 1)
+            if end is None:
+                break
+            i, prev = end, 'x'
+            continue
+        if c == '<' and line.startswith('<<', i):
+            m = _RUBY_HEREDOC.match(line, i)
+            if m and (m.group(1) or m.group(2) or m.group(3).isupper()):
+                heredocs.append((m.group(3), bool(m.group(1))))
+                i, prev = m.end(), 'x'
+                continue
+        if c == '$' and i + 1 < n and not (line[i + 1].isalnum() or line[i + 1] == '_'):
+            i, prev = i + 2, 'x'                      # special global like $` or $!
+            continue
+        if c.isalpha() or c == '_' or c == '@' or c == '$':
+            j = i + 1
+            while j < n and (line[j].isalnum() or line[j] == '_'):
+                j += 1
+            if j < n and line[j] in '?!' and not line.startswith('!=', j):
+                j += 1
+            word = line[i:j]
+            next_char = line[j] if j < n else ''
+            if next_char == ':' and not line.startswith('::', j):
+                pass                                  # hash key `class:`
+            elif prev == ':' and line[i - 1] == ':' and line[max(i - 2, 0):i] != '::':
+                pass                                  # symbol `:end`
+            else:
+                words.append((word, prev, next_char))
+            i, prev = j, 'x'
+            continue
+        prev = c
+        i += 1
+
+    return words, heredocs
+
+
+def scan_ruby_blocks(code):
+    """
+    Scan Ruby source once and return (blocks, line_depths).
+
+    ``blocks`` lists every class/module/def with its 0-based inclusive line
+    range and nesting depth (number of enclosing class/module/def), in order
+    of their opening line. ``line_depths[i]`` is the number of open blocks of
+    any kind (if/do/case/...) at the start of line i, which tells callers
+    where the source can be cut without splitting a construct.
+
+    This is a heuristic lexer, not a parser: it understands strings, %-literals,
+    regexps, heredocs, =begin/=end and modifier ``if``/``unless``, which is
+    enough for the Lich5 sources.
+    """
+    lines = code.splitlines()
+    blocks = []
+    stack = []             # [kind, name, start, depth] of every open block
+    line_depths = []
+    state = []
+    heredoc_queue = []
+    in_embdoc = False
+    symbol_depth = 0
+
+    for lineno, line in enumerate(lines):
+        line_depths.append(len(stack))
+
+        if heredoc_queue:
+            terminator, squiggly = heredoc_queue[0]
+            if (line.strip() if squiggly else line.rstrip()) == terminator:
+                heredoc_queue.pop(0)
+            continue
+        if in_embdoc:
+            if line.startswith('=end'):
+                in_embdoc = False
+            continue
+        if not state and line.startswith('=begin'):
+            in_embdoc = True
+            continue
+        if not state and line.rstrip() == '__END__':
+            line_depths.extend([len(stack)] * (len(lines) - lineno - 1))
+            break
+
+        words, heredocs = _scan_ruby_line(line, state)
+        heredoc_queue.extend(heredocs)
+        loop_on_line = False
+
+        for word, prev, _next_char in words:
+            if prev == '.':
+                continue
+            opens = False
+            if word in _RUBY_ALWAYS_OPENERS:
+                if word == 'do' and loop_on_line:
+                    loop_on_line = False
+                    continue
+                if word == 'def' and _RUBY_ENDLESS_DEF.match(line):
+                    continue
+                opens = True
+            elif word in _RUBY_STATEMENT_OPENERS and (prev is None or prev in _RUBY_EXPR_START):
+                opens = True
+                loop_on_line = word in _RUBY_LOOP_KEYWORDS
+            elif word == 'end':
+                if not stack:
+                    continue
+                kind, name, start, depth = stack.pop()
+                if kind in _RUBY_SYMBOL_KINDS:
+                    symbol_depth -= 1
+                    blocks.append(RubyBlock(kind, name, start, lineno, depth))
+                continue
+
+            if not opens:
+                continue
+            name = None
+            if word == 'def':
+                m = _RUBY_DEF_NAME.search(line)
+                name = m.group(1) if m else '?'
+            elif word in ('class', 'module'):
+                m = _RUBY_SCOPE_NAME.search(line)
+                if not m:
+                    continue                      # e.g. `obj.class` slipped past
+                name = m.group(2)
+            stack.append([word, name, lineno, symbol_depth])
+            if word in _RUBY_SYMBOL_KINDS:
+                symbol_depth += 1
+
+    last = max(len(lines) - 1, 0)
+    while stack:
+        kind, name, start, depth = stack.pop()
+        if kind in _RUBY_SYMBOL_KINDS:
+            blocks.append(RubyBlock(kind, name, start, last, depth))
+
+    blocks.sort(key=lambda b: (b.start, b.depth))
+    return blocks, line_depths[:len(lines)]
+
+
+class RubySymbolIndex:
+    """
+    Class/module/def symbols of one Ruby source, built from a single scan.
+
+    Shared by the chunker, the missing-def restorer and output validation so
+    that each of them walks the file once instead of re-running regexes per
+    symbol.
+
+    Attributes:
+        lines: Source split into lines
+        symbols: RubyBlocks ordered by start line
+        line_depths: Open block count (any kind) at the start of each line
+        parent: Maps each symbol to its enclosing symbol (or None)
+        children: Maps each symbol, and None for the file itself, to its members
+    """
+
+    def __init__(self, code):
+        self.lines = code.splitlines()
+        self.symbols, self.line_depths = scan_ruby_blocks(code)
+        self._starts = [symbol.start for symbol in self.symbols]
+        self.parent = {}
+        self.children = {None: []}
+        open_symbols = []
+        for symbol in self.symbols:
+            while open_symbols and open_symbols[-1].end < symbol.start:
+                open_symbols.pop()
+            owner = open_symbols[-1] if open_symbols else None
+            self.parent[symbol] = owner
+            self.children[owner].append(symbol)
+            self.children[symbol] = []
+            open_symbols.append(symbol)
+
+    def defs(self):
+        """All def symbols in source order"""
+        return [symbol for symbol in self.symbols if symbol.kind == 'def']
+
+    def innermost(self, line_no):
+        """The deepest symbol whose range contains line_no, or None"""
+        i = bisect_left(self._starts, line_no + 1) - 1
+        symbol = self.symbols[i] if i >= 0 else None
+        while symbol is not None and symbol.end < line_no:
+            symbol = self.parent[symbol]
+        return symbol
+
+    def scope_of(self, line_no):
+        """Human-readable class/module chain enclosing line_no, e.g. 'module Lich > class Spell'"""
+        chain = []
+        symbol = self.innermost(line_no)
+        while symbol is not None:
+            if symbol.kind != 'def' and symbol.start < line_no:
+                chain.append(f"{symbol.kind} {symbol.name}")
+            symbol = self.parent[symbol]
+        return ' > '.join(reversed(chain))
+
+    def qualified_name(self, symbol):
+        """
+        (namespace, name) of a symbol as YARD would list it.
+
+        A class or module is its own namespace ('Lich::Common::GameObj'); a def
+        belongs to the enclosing namespace and is named '#name', or '.name' for
+        'self.' defs and defs inside `class << self`.
+        """
+        chain = []
+        singleton = False
+        parent = self.parent[symbol]
+        while parent is not None:
+            if parent.kind != 'def' and parent.name.startswith('<<'):
+                singleton = singleton or not chain
+            elif parent.kind != 'def':
+                chain.append(parent.name)
+            parent = self.parent[parent]
+        outer = '::'.join(reversed(chain))
+        if symbol.kind != 'def':
+            namespace = f"{outer}::{symbol.name}" if outer else symbol.name
+            return namespace, namespace
+        name = symbol.name.split('.', 1)[1] if '.' in symbol.name else symbol.name
+        return outer, ('.' if '.' in symbol.name or singleton else '#') + name
+
+    def comment_start(self, symbol, floor=0):
+        """First line of the comment block directly above symbol (symbol.start if none)"""
+        start = symbol.start
+        while start > floor and self.lines[start - 1].lstrip().startswith('#'):
+            start -= 1
+        return start
+
+    def source(self, symbol, with_comments=True):
+        """Lines of a symbol, optionally including its leading comment block"""
+        start = self.comment_start(symbol) if with_comments else symbol.start
+        return self.lines[start:symbol.end + 1]
+
+    def fingerprint(self, symbol):
+        """
+        Hash of what a symbol's documentation depends on.
+
+        That is its enclosing scope and declaration, plus the whole body for a
+        def (whitespace-insensitive). A class or module keeps its fingerprint
+        when only its methods change, so their edits never re-document it.
+        """
+        if symbol.kind == 'def':
+            text = '\n'.join(line.strip() for line in self.lines[symbol.start:symbol.end + 1])
+        else:
+            text = self.signature(symbol)
+        key = f"{self.scope_of(symbol.start)}\0{symbol.kind}\0{text}"
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def signature(self, symbol):
+        """Declaration text of a symbol, joined across lines until its parentheses close"""
+        parts = []
+        depth = 0
+        for line in self.lines[symbol.start:min(symbol.start + 10, symbol.end + 1)]:
+            code = line.split(' #', 1)[0]
+            parts.append(code.strip())
+            depth += code.count('(') - code.count(')')
+            if depth <= 0:
+                break
+        return ' '.join(parts)
+
+
+# ----------------------------------------------------------------------
+#  Deterministic YARD skeletons from Ruby signatures
+# ----------------------------------------------------------------------
+RubyParam = namedtuple('RubyParam', 'name kind default')
+RubyParam.__doc__ = """One def parameter; kind is req/opt/rest/keyreq/key/keyrest/block/forward"""
+
+_RUBY_LITERAL_TYPES = [
+    (re.compile(r'^nil$'), 'Object, nil'),
+    (re.compile(r'^(true|false)$'), 'Boolean'),
+    (re.compile(r'^-?\d[\d_]*$'), 'Integer'),
+    (re.compile(r'^-?\d[\d_]*\.\d+$'), 'Float'),
+    (re.compile(r'^(["\'].*["\']|%[qQ]?\W.*)$'), 'String'),
+    (re.compile(r'^:\w+[?!]?$'), 'Symbol'),
+    (re.compile(r'^(\[.*\]|%[wWiI]\W.*|Array\.new.*)$'), 'Array'),
+    (re.compile(r'^(\{.*\}|Hash\.new.*)$'), 'Hash'),
+    (re.compile(r'^/.*/[imxo]*$'), 'Regexp'),
+    (re.compile(r'^([A-Z]\w*(?:::[A-Z]\w*)*)\.new\b'), None),     # Foo.new -> Foo
+]
+
+
+def infer_ruby_type(default):
+    """Best-effort YARD type for a parameter default value"""
+    if default is None:
+        return 'Object'
+    default = default.strip()
+    for pattern, type_name in _RUBY_LITERAL_TYPES:
+        m = pattern.match(default)
+        if m:
+            return type_name or m.group(1)
+    return 'Object'
+
+
+def _split_ruby_args(text):
+    """Split a parameter list on commas that are not nested in brackets or strings"""
+    parts, depth, quote, current = [], 0, None, []
+    for c in text:
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            parts.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(c)
+    if ''.join(current).strip():
+        parts.append(''.join(current).strip())
+    return parts
+
+
+def parse_ruby_params(signature):
+    """
+    Parse the parameter list of a def signature (which may span several lines).
+
+    Handles defaults, required and optional keywords, ``*``/``**`` splats,
+    ``&block`` and ``...`` forwarding, with or without parentheses.
+    """
+    m = _RUBY_DEF_NAME.search(signature)
+    if not m:
+        return []
+    rest = signature[m.end():]
+    if rest.startswith('('):
+        depth = 0
+        for i, c in enumerate(rest):
+            depth += c == '('
+            depth -= c == ')'
+            if depth == 0:
+                break
+        arg_text = rest[1:i]
+    else:
+        arg_text = rest.split('#', 1)[0].split(';', 1)[0].strip()
+        if arg_text.startswith('='):
+            return []                              # endless def without params
+
+    params = []
+    for arg in _split_ruby_args(arg_text.replace('\n', ' ')):
+        if arg == '...':
+            params.append(RubyParam('...', 'forward', None))
+        elif arg.startswith('&'):
+            params.append(RubyParam(arg[1:] or 'block', 'block', None))
+        elif arg.startswith('**'):
+            params.append(RubyParam(arg[2:] or 'options', 'keyrest', None))
+        elif arg.startswith('*'):
+            params.append(RubyParam(arg[1:] or 'args', 'rest', None))
+        elif re.match(r'^\w+:', arg):
+            name, default = arg.split(':', 1)
+            default = default.strip()
+            params.append(RubyParam(name, 'key' if default else 'keyreq', default or None))
+        elif '=' in arg:
+            name, default = arg.split('=', 1)
+            params.append(RubyParam(name.strip(), 'opt', default.strip()))
+        else:
+            params.append(RubyParam(arg, 'req', None))
+    return params
+
+
+def yard_skeleton(symbol, params):
+    """
+    The YARD tags a symbol must carry, derived from its signature alone.
+
+    Returns (tag, name, type) triples; the model only supplies descriptions.
+    """
+    if symbol.kind != 'def':
+        return []
+    tags = []
+    for param in params:
+        if param.kind == 'forward':
+            continue
+        if param.kind == 'block':
+            tags.append(('param', param.name, 'Proc'))
+        elif param.kind == 'rest':
+            tags.append(('param', param.name, 'Array'))
+        elif param.kind == 'keyrest':
+            tags.append(('param', param.name, 'Hash'))
+        else:
+            tags.append(('param', param.name, infer_ruby_type(param.default)))
+    if symbol.name.split('.')[-1] != 'initialize':
+        tags.append(('return', None, 'Object'))
+    return tags
+
+
+def format_yard_skeleton(skeleton):
+    """Render skeleton triples as tag lines, e.g. '@param name [String]'"""
+    return [f"@{tag}{' ' + name if name else ''} [{type_name}]" for tag, name, type_name in skeleton]
+
+
+_YARD_TAG_ORDER = ['param', 'option', 'yield', 'yieldparam', 'yieldreturn', 'return', 'raise', 'example', 'note']
+_YARD_NAMED_TAGS = ('param', 'option', 'yieldparam')
+_YARD_TYPED_TAGS = ('return', 'raise', 'yieldreturn')
+
+YardTag = namedtuple('YardTag', 'tag name types text body raw')
+YardTag.__doc__ = """A parsed YARD tag; types keeps its brackets, body holds @example lines"""
+
+
+def parse_yard_tags(lines):
+    """
+    Split YARD text (comment markers already removed) into (summary, tags).
+
+    Continuation lines are folded into the preceding tag's text, except for
+    @example whose lines are kept verbatim in ``body``.
+    """
+    summary, raw_tags = [], []
+    for line in lines:
+        m = re.match(r'^@(\w+)\s*(.*)$', line.strip())
+        if m:
+            raw_tags.append((m.group(1), m.group(2), []))
+        elif raw_tags:
+            raw_tags[-1][2].append(line.rstrip())
+        else:
+            summary.append(line.rstrip())
+
+    tags = []
+    for tag, rest, more in raw_tags:
+        name, types, text = None, None, rest
+        if tag in _YARD_NAMED_TAGS:
+            m = re.match(r'^(?:(\[[^\]]*\])\s*)?([^\s\[]+)?\s*(\[[^\]]*\])?\s*(.*)$', rest)
+            name, types, text = m.group(2), m.group(1) or m.group(3), m.group(4)
+        elif tag in _YARD_TYPED_TAGS:
+            m = re.match(r'^(\[[^\]]*\])?\s*(.*)$', rest)
+            types, text = m.group(1), m.group(2)
+        if tag == 'example':
+            body = list(more)
+            while body and not body[-1].strip():
+                body.pop()
+        else:
+            body = []
+            text = ' '.join([text] + [x.strip() for x in more if x.strip()]).strip()
+        tags.append(YardTag(tag, name, types, text, body, rest))
+    return summary, tags
+
+
+def strip_comment_markers(lines):
+    """Remove the leading '#' (and one space) from comment lines"""
+    out = []
+    for line in lines:
+        text = line.lstrip()
+        if text.startswith('#'):
+            line = text[2:] if text.startswith('# ') else text[1:]
+        out.append(line)
+    return out
+
+
+def render_yard_block(skeleton, answer_lines):
+    """
+    Merge the model's prose for one symbol into its fixed tag skeleton.
+
+    ``answer_lines`` is the model's block: free text first, then YARD tags with
+    descriptions (types optional). @param tags always follow the signature –
+    unknown names are dropped and missing ones are emitted from the skeleton –
+    so tag structure is identical no matter how the model phrases things.
+    Returns comment lines without indentation.
+    """
+    summary, tags = parse_yard_tags(strip_comment_markers(answer_lines))
+
+    described = {}
+    others = []
+    for tag in tags:
+        if tag.tag in ('param', 'return'):
+            if tag.tag == 'param' and not tag.name:
+                continue
+            described[(tag.tag, tag.name)] = (tag.types, tag.text)
+        else:
+            others.append(tag)
+
+    body = []
+    for tag, name, type_name in skeleton:
+        model_type, description = described.get((tag, name), (None, ''))
+        label = f" {name}" if name else ''
+        body.append(f"@{tag}{label} {model_type or f'[{type_name}]'} {description}".rstrip())
+    if not any(tag == 'return' for tag, _, _ in skeleton) and ('return', None) in described:
+        model_type, description = described[('return', None)]
+        body.append(f"@return {model_type or '[Object]'} {description}".rstrip())
+
+    def rank(tag):
+        return _YARD_TAG_ORDER.index(tag.tag) if tag.tag in _YARD_TAG_ORDER else len(_YARD_TAG_ORDER)
+
+    for tag in sorted(others, key=rank):
+        if tag.tag == 'example':
+            body.append(f"@example {tag.text}".rstrip())
+            body.extend(tag.body)
+        else:
+            types = f"{tag.types} " if tag.types else ''
+            name = f"{tag.name} " if tag.name else ''
+            body.append(f"@{tag.tag} {name}{types}{tag.text}".rstrip())
+
+    while summary and not summary[-1].strip():
+        summary.pop()
+    lines = summary + ([''] if summary and body else []) + body
+    return [f"# {line}".rstrip() for line in lines]
+
+
+def yard_entries(raw_doc):
+    """
+    Pair each YARD comment block in raw_doc with the declaration below it.
+
+    Returns (declaration or None, comment lines) tuples. Fence markers are
+    ignored, so both the assembled format and older free-form answers work.
+    """
+    entries = []
+    block = []
+    for line in (raw_doc or '').splitlines():
+        text = line.strip()
+        if text.startswith('```'):
+            continue
+        if text.startswith('#'):
+            block.append(line)
+        elif not text:
+            if block:
+                block.append('')
+        elif block:
+            entries.append((text, block))
+            block = []
+    if block:
+        entries.append((None, block))
+    return entries
+
+
+# ----------------------------------------------------------------------
+#  Coverage of the YARD comments already in the source
+# ----------------------------------------------------------------------
+COVERAGE_TAGS = ('param', 'return', 'raise', 'example')
+
+SymbolCoverage = namedtuple('SymbolCoverage', 'symbol missing stale')
+SymbolCoverage.__doc__ = """Coverage of one symbol: missing and stale are tuples of 'summary' or tag names"""
+
+_RUBY_RAISE = re.compile(r'(?:^|[\s;(])(?:raise|fail)\b')
+
+
+def symbol_coverage(index, symbol):
+    """
+    Compare the comment block above a symbol with what its signature requires.
+
+    A def needs a summary, one @param per parameter, @return (except
+    initialize), @raise when its body raises, and an @example; a class or
+    module needs a summary. @param names that are no longer in the
+    signature are reported as stale.
+    """
+    comment = index.lines[index.comment_start(symbol):symbol.start]
+    summary, tags = parse_yard_tags(strip_comment_markers(comment))
+    missing = [] if any(line.strip() for line in summary) else ['summary']
+    stale = []
+    if symbol.kind == 'def':
+        skeleton = yard_skeleton(symbol, parse_ruby_params(index.signature(symbol)))
+        wanted = {name for tag, name, _ in skeleton if tag == 'param'}
+        documented = {tag.name for tag in tags if tag.tag == 'param' and tag.name}
+        present = {tag.tag for tag in tags}
+        if wanted - documented:
+            missing.append('param')
+        if documented - wanted:
+            stale.append('param')
+        if any(tag == 'return' for tag, _, _ in skeleton) and 'return' not in present:
+            missing.append('return')
+        body = (line.split('#', 1)[0] for line in index.lines[symbol.start + 1:symbol.end + 1])
+        if 'raise' not in present and any(_RUBY_RAISE.search(line) for line in body):
+            missing.append('raise')
+        if 'example' not in present:
+            missing.append('example')
+    return SymbolCoverage(symbol, tuple(missing), tuple(stale))
+
+
+def yard_coverage(code, index=None):
+    """SymbolCoverage for every class, module and def of one Ruby source"""
+    index = index or RubySymbolIndex(code)
+    return [symbol_coverage(index, symbol) for symbol in index.symbols]
+
+
+def _coverage_job(path):
+    """Per-file coverage counts and (line, name, missing, stale) of each incomplete symbol (runs in a worker process)"""
+    counts = {'symbols': 0, 'complete': 0, 'undocumented': 0, 'stale': 0, **{tag: 0 for tag in COVERAGE_TAGS}}
+    gaps = []
+    index = RubySymbolIndex(Path(path).read_text(encoding='utf-8', errors='replace'))
+    for entry in yard_coverage(None, index):
+        counts['symbols'] += 1
+        counts['complete'] += not entry.missing and not entry.stale
+        counts['undocumented'] += 'summary' in entry.missing
+        counts['stale'] += bool(entry.stale)
+        for tag in COVERAGE_TAGS:
+            counts[tag] += tag in entry.missing
+        if entry.missing or entry.stale:
+            namespace, name = index.qualified_name(entry.symbol)
+            name = name if entry.symbol.kind != 'def' else namespace + name
+            gaps.append((entry.symbol.start + 1, name, entry.missing, entry.stale))
+    return counts, gaps
+
+
+def scan_coverage(root, workers=None, details=False):
+    """
+    Coverage counts of every .rb file under root, summed per top-level module.
+
+    Files directly in root are grouped under '.', everything else under its
+    first directory (common, gemstone, dragonrealms, attributes, ...).
+
+    Args:
+        root: Directory to scan recursively
+        workers: Worker processes (default: one per CPU)
+        details: Also return every incomplete symbol
+
+    Returns:
+        {module: {'files', 'symbols', 'complete', 'undocumented', 'stale', <tag>...}}, or with
+        details a (modules, [(file, line, name, missing, stale)...]) pair in file and line order
+    """
+    root = Path(root)
+    paths = sorted(root.rglob('*.rb'))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_coverage_job, paths, chunksize=8))
+    modules = {}
+    gaps = []
+    for path, (counts, file_gaps) in zip(paths, results):
+        parts = path.relative_to(root).parts
+        totals = modules.setdefault(parts[0] if len(parts) > 1 else '.', {'files': 0})
+        totals['files'] += 1
+        for key, value in counts.items():
+            totals[key] = totals.get(key, 0) + value
+        gaps += [(path.relative_to(root).as_posix(), *gap) for gap in file_gaps]
+    return (modules, gaps) if details else modules
+
+
+def format_coverage_report(modules):
+    """Coverage table: one row per module plus a total, missing tags as counts"""
+    def pct(part, whole):
+        return f"{100 * part / whole:5.1f}%" if whole else '    -'
+
+    header = f"{'module':<14}{'files':>6}{'symbols':>9}{'complete':>10}{'no doc':>8}{'stale':>7}" + \
+             ''.join(f"{'-' + tag:>10}" for tag in COVERAGE_TAGS)
+    rows = [header, '-' * len(header)]
+    total = {}
+    for counts in modules.values():
+        for key, value in counts.items():
+            total[key] = total.get(key, 0) + value
+    for name, counts in sorted(modules.items(), key=lambda item: (item[0] == '.', item[0])) + [('total', total)]:
+        rows.append(f"{name:<14}{counts['files']:>6}{counts['symbols']:>9}"
+                    f"{pct(counts['complete'], counts['symbols']):>10}{counts['undocumented']:>8}{counts['stale']:>7}"
+                    + ''.join(f"{counts[tag]:>10}" for tag in COVERAGE_TAGS))
+    return '\n'.join(rows)
+
+
+def format_coverage_details(gaps):
+    """One line per incomplete symbol: 'file:line  name  missing: ...  stale: ...'"""
+    rows = []
+    for file, line, name, missing, stale in gaps:
+        tags = ([f"missing: {', '.join(missing)}"] if missing else []) + \
+               ([f"stale: {', '.join(stale)}"] if stale else [])
+        rows.append(f"{file}:{line}  {name}  {'  '.join(tags)}")
+    return '\n'.join(rows)
+
+
+# ----------------------------------------------------------------------
+#  HTML pages – pure functions so they can run in worker processes
+# ----------------------------------------------------------------------
+_HTML_STYLE = """body{font-family:sans-serif;max-width:60em;margin:2em auto;padding:0 1em;line-height:1.4}
+pre{background:#f6f6f6;padding:.6em;overflow:auto}code{background:#f6f6f6}
+table{border-collapse:collapse;margin:.5em 0}td,th{border:1px solid #ddd;padding:.2em .5em;text-align:left}
+.method{border-top:1px solid #ddd;margin-top:1.5em}.defined{color:#666;font-size:.9em}"""
+
+
+def html_page_path(namespace):
+    """Site-relative path of a namespace's page ('' is the top-level namespace)"""
+    return namespace.replace('::', '/') + '.html' if namespace else 'top-level-namespace.html'
+
+
+def _html_doc(lines):
+    """Render one YARD comment block (markers already stripped) as HTML"""
+    summary, tags = parse_yard_tags(lines)
+    out = []
+    text = '\n'.join(summary).strip()
+    if text:
+        out += [f"<p>{html.escape(paragraph)}</p>" for paragraph in re.split(r'\n\s*\n', text)]
+    by_tag = {}
+    for tag in tags:
+        by_tag.setdefault(tag.tag, []).append(tag)
+
+    def types(t):
+        return f"<code>{html.escape(t.types[1:-1])}</code>" if t.types else ''
+
+    for tag_name, heading, columns in (('param', 'Parameters', ('Name', 'Type', 'Description')),
+                                       ('option', 'Options', ('Hash', 'Type', 'Description')),
+                                       ('return', 'Returns', ('Type', 'Description')),
+                                       ('raise', 'Raises', ('Exception', 'When'))):
+        group = by_tag.get(tag_name)
+        if not group:
+            continue
+        out.append(f"<h4>{heading}</h4><table><tr>{''.join(f'<th>{c}</th>' for c in columns)}</tr>")
+        for t in group:
+            cells = ([f"<code>{html.escape(t.name or '')}</code>"] if len(columns) == 3 else []) + \
+                    [types(t), html.escape(t.text or '')]
+            out.append(f"<tr>{''.join(f'<td>{c}</td>' for c in cells)}</tr>")
+        out.append("</table>")
+    for t in by_tag.get('example', []):
+        body = '\n'.join(line[2:] if line.startswith('  ') else line for line in t.body)
+        title = f": {html.escape(t.text)}" if t.text else ''
+        out.append(f"<h4>Example{title}</h4><pre><code>{html.escape(body)}</code></pre>")
+    for t in by_tag.get('note', []):
+        out.append(f"<p><strong>Note:</strong> {html.escape(t.text)}</p>")
+    for tag_name, group in by_tag.items():
+        if tag_name in ('param', 'option', 'return', 'raise', 'example', 'note'):
+            continue
+        for t in group:
+            detail = ' '.join(x for x in (t.name, t.types, t.text) if x)
+            out.append(f"<p><strong>@{html.escape(tag_name)}</strong> {html.escape(detail)}</p>")
+    return '\n'.join(out)
+
+
+def render_html_page(namespace, items):
+    """
+    Render one class/module page from its items.
+
+    Args:
+        namespace: Full name such as 'Lich::Common::GameObj' ('' for top level)
+        items: [kind, name, declaration, comment lines, file, line] lists in source order
+    """
+    root = '../' * namespace.count('::')
+    kinds = sorted({kind for kind, *_ in items if kind != 'def'}) or ['namespace']
+    title = namespace or 'Top Level Namespace'
+    out = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\">",
+           f"<title>{html.escape(title)}</title><style>{_HTML_STYLE}</style></head><body>",
+           f"<p><a href=\"{root}index.html\">Index</a></p>",
+           f"<h1>{html.escape('/'.join(kinds).capitalize())}: {html.escape(title)}</h1>"]
+
+    files = sorted({file for *_, file, _line in items})
+    out.append(f"<p class=\"defined\">Defined in: {html.escape(', '.join(files))}</p>")
+    seen = []
+    for kind, name, declaration, lines, file, line in items:
+        if kind != 'def' and lines and lines not in seen:  # reopened namespaces often repeat their doc
+            seen.append(lines)
+            out.append(_html_doc(lines))
+
+    methods = [item for item in items if item[0] == 'def']
+    if methods:
+        out.append("<h2>Methods</h2><ul>")
+        for kind, name, declaration, lines, file, line in methods:
+            out.append(f"<li><a href=\"#{html.escape(file)}-L{line}\"><code>{html.escape(name)}</code></a></li>")
+        out.append("</ul>")
+    for kind, name, declaration, lines, file, line in methods:
+        out.append(f"<div class=\"method\" id=\"{html.escape(file)}-L{line}\">"
+                   f"<h3><code>{html.escape(declaration)}</code></h3>")
+        out.append(_html_doc(lines) if lines else "<p><em>Undocumented.</em></p>")
+        out.append(f"<p class=\"defined\">{html.escape(file)}:{line}</p></div>")
+    out.append("</body></html>")
+    return '\n'.join(out) + '\n'
+
+
+def render_html_index(namespaces):
+    """Alphabetical index page linking every namespace page"""
+    out = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\">",
+           f"<title>Lich5 API Documentation</title><style>{_HTML_STYLE}</style></head><body>",
+           "<h1>Lich5 API Documentation</h1><ul>"]
+    for namespace in sorted(namespaces, key=lambda n: (n != '', n.lower())):
+        out.append(f"<li><a href=\"{html.escape(html_page_path(namespace))}\">"
+                   f"{html.escape(namespace or 'Top Level Namespace')}</a></li>")
+    out.append("</ul></body></html>")
+    return '\n'.join(out) + '\n'
+
+
+def _render_html_job(job):
+    namespace, items = job
+    return html_page_path(namespace), render_html_page(namespace, items)
+
+
+CodeChunk = namedtuple('CodeChunk', 'text start end context')
+CodeChunk.__doc__ = """A contiguous slice of a source file (0-based, inclusive lines) plus its enclosing scope"""
+
+
+def _code_lines(text):
+    """(1-based line, tokens) for every line that is not blank or a whole-line comment"""
+    for line_no, line in enumerate(text.split('\n'), 1):
+        tokens = line.split()
+        if tokens and not tokens[0].startswith('#'):
+            yield line_no, tokens
+
+
+def code_mismatch(original, annotated):
+    """
+    Compare two versions of a file token for token, ignoring comment lines and whitespace.
+
+    Runs in one linear pass. Returns None when the code is unchanged,
+    otherwise (line in original, expected text, text found) for the first
+    difference; a missing or extra line is reported against '' on its side.
+    """
+    expected, found = _code_lines(original), _code_lines(annotated)
+    last = 0
+    while True:
+        want, got = next(expected, None), next(found, None)
+        if want is None and got is None:
+            return None
+        if want is None or got is None or want[1] != got[1]:
+            return (want[0] if want else last + 1,
+                    ' '.join(want[1]) if want else '',
+                    ' '.join(got[1]) if got else '')
+        last = want[0]
+
 class Lich5DocumentationGenerator:
-    def __init__(self, input_file=None, input_dir=None):
+    def __init__(self, input_file=None, input_dir=None, concurrency=1, use_cache=True,
+                 response_cache_mb=512, response_cache_days=30, chunk_tokens=2500,
+                 base_url=None, annotate_mode='anchored', output_formats=None, stream=False,
+                 profile=False, max_retries=6, resume=None, since=None, router=None,
+                 skip_documented=False, http_keepalive=None, backend=None, output_dir=None, cache_dir=None):
         """
         Initialize the Lich5 documentation generator
         
         Args:
             input_file: Single file to document
             input_dir: Directory of files to document
+            concurrency: Maximum number of files analyzed in parallel
+            use_cache: Reuse analysis results for files whose content is unchanged
+            response_cache_mb: Size limit of the on-disk model response cache
+            response_cache_days: Age after which cached responses expire
+            chunk_tokens: Token budget for each chunk of a large file
+            base_url: Alternative OpenAI-compatible endpoint (e.g. a local stand-in server)
+            annotate_mode: 'anchored' asks the model for comment blocks only and splices
+                them in locally; 'rewrite' has the model re-emit the whole source
+            output_formats: Formats to write for each file as soon as its analysis
+                finishes (e.g. ['yard', 'markdown']); finish_documentation completes them
+            stream: Stream completions, recording time-to-first-token and tokens/sec
+            profile: Record timed spans of the run for export with export_trace
+            max_retries: Attempts after the first for rate-limited or failed model calls
+            resume: Output directory of an interrupted run to continue; files and
+                chunks already checkpointed there are not sent to the model again
+            since: Git revision; only files changed since it are processed
+            router: ModelRouter choosing model and max_tokens per task and file size
+            skip_documented: Keep the source's own YARD comments where they are
+                complete and current; only the other symbols go to the model
+            http_keepalive: Seconds idle model connections stay open for reuse
+                (the client default of a few seconds suits batch runs, not a resident server)
+            backend: ModelBackend to call (default: OpenAI at base_url); nothing is
+                imported or connected until the first model call
+            output_dir: Existing directory to write into instead of a new timestamped one
+            cache_dir: Directory of the caches shared between runs (default: documentation/cache)
         """
         # Base directories
         self.input_file = Path(input_file) if input_file else None
         self.input_dir = Path(input_dir) if input_dir else None
+        self.concurrency = max(1, int(concurrency or 1))
+        self.chunk_tokens = chunk_tokens
+        self.annotate_mode = annotate_mode
+        self.output_formats = parse_output_formats(output_formats or [])
+        self._token_encoder = None
         self.script_dir = Path(__file__).parent
         self.timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         
-        # Create output directories
-        self.output_dir = self.script_dir / 'documentation' / self.timestamp
+        # Create output directories (or continue an interrupted run's)
+        self.resume = resume is not None
+        if self.resume:
+            self.output_dir = Path(resume)
+        elif output_dir:
+            self.output_dir = Path(output_dir)
+        else:
+            self.output_dir = self.script_dir / 'documentation' / self.timestamp
         self.output_dir.mkdir(parents=True, exist_ok=True)
         
-        # Set up file paths
-        self.raw_docs_path = self.output_dir / 'raw_documentation.json'
+        # Set up file paths (append-only JSONL store, one record per line)
+        self.raw_docs_path = self.output_dir / 'raw_documentation.jsonl'
+
+        # Persistent, content-addressed analysis cache shared by every run
+        self.use_cache = use_cache
+        self.cache_dir = Path(cache_dir) if cache_dir else self.script_dir / 'documentation' / 'cache'
+        self.analysis_cache_dir = self.cache_dir / 'analysis'
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Cache of individual model responses, shared by every _chat caller
+        self.response_cache = ResponseCache(
+            self.cache_dir / 'responses',
+            max_bytes=int(response_cache_mb * 1024 * 1024),
+            max_age_days=response_cache_days,
+        ) if use_cache else None
         
-        # Initialize anthropic client
-        # self.client = anthropic.Anthropic()
-        self.client = openai.OpenAI()
+        # Model backend; its SDK is imported and its client built on first use
+        self.backend = backend or OpenAIBackend(base_url=base_url, http_keepalive=http_keepalive)
+        self.max_retries = max_retries
+        self.limiter = AdaptiveLimiter(self.concurrency)
+        self.degraded_chunks = 0
+
+        # (text, finish_reason) downloaded from a batch job, keyed like the response cache
+        self.batch_results = {}
+
+        # Set by generate_documentation(offline=True): write only what the store holds
+        self.offline = False
+
+        # Streaming completions and their per-call timings
+        self.stream = stream
+        self.stream_metrics = []
+
+        # Per-call instrumentation (a no-op unless profiling)
+        self.trace = RunTrace(enabled=profile)
         
-        # Initialize documentation storage
-        self.documentation = {}
+        # Serializes appends to the documentation store during concurrent analysis
+        self._doc_lock = threading.Lock()
+
+        # Per-file model responses and finished outputs, for --resume
+        self._checkpoints = {}
+        self._completed_outputs = None
+        self._resumable = None
+
+        # Largest-first scheduling: observed seconds per token by file, and
+        # files whose analysis is fanned out as parallel chunk requests
+        self.cost_history_path = self.cache_dir / 'costs.json'
+        self._cost_history = None
+        self._split_files = set()
+        self._chunk_pool = None
+
+        # HTML site state (per-file items and per-page hashes), loaded on first use
+        self._html_state = None
+
+        # Model choice per task and size, with escalation on truncated or invalid answers
+        self.router = router or ModelRouter(self.backend.default_routes)
+
+        # Comment blocks by symbol fingerprint, so edits re-document only what changed
+        self.symbol_cache_dir = self.cache_dir / 'symbols'
+        self.since = since
+        self.skip_documented = skip_documented
         
         logging.info(f"Initialized Lich5DocumentationGenerator:")
         logging.info(f"- Input file: {self.input_file}")
         logging.info(f"- Input directory: {self.input_dir}")
         logging.info(f"- Output directory: {self.output_dir}")
+        logging.info(f"- Model backend: {self.backend.name}")
+        logging.info(f"- Concurrency: {self.concurrency}")
+        logging.info(f"- Analysis cache: {self.analysis_cache_dir if use_cache else 'disabled'}")
+
+    def _write_documentation(self, file_name, record):
+        """
+        Append one file's documentation record to the JSONL store.
 
-    def _write_documentation(self):
-        """Write documentation to JSON file"""
-        with open(self.raw_docs_path, 'w') as f:
-            json.dump(self.documentation, f, indent=4)
+        Records are never rewritten; when a file is analyzed twice the later
+        line wins on read. Callers running concurrently must hold _doc_lock.
+        """
+        line = json.dumps({'file': file_name, **record})
+        with open(self.raw_docs_path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def _index_documentation(self):
+        """Map each file name to the byte offset of its latest record, in first-seen order"""
+        offsets = {}
+        with open(self.raw_docs_path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    file_name = json.loads(line)['file']
+                except (ValueError, KeyError):
+                    logging.warning(f"Skipping malformed record at byte {offset} of {self.raw_docs_path}")
+                    continue
+                offsets[file_name] = offset
+        return offsets
+
+    def _stored_file_names(self):
+        """Names of every file with a record in the documentation store"""
+        if not self.raw_docs_path.exists():
+            return []
+        if self.raw_docs_path.suffix == '.json':
+            with open(self.raw_docs_path, 'r') as f:
+                return list(json.load(f))
+        return list(self._index_documentation())
 
     def _read_documentation(self):
-        """Read current documentation from JSON file"""
+        """
+        Lazily yield (file_name, record) pairs from the documentation store.
+
+        Only the offset index is held in memory; each record is loaded from
+        disk as it is consumed. Legacy raw_documentation.json files from older
+        runs are still accepted.
+        """
         if not self.raw_docs_path.exists():
-            return {}
-        with open(self.raw_docs_path, 'r') as f:
-            return json.load(f)
+            return
+        if self.raw_docs_path.suffix == '.json':
+            with open(self.raw_docs_path, 'r') as f:
+                yield from json.load(f).items()
+            return
+
+        offsets = self._index_documentation()
+        with open(self.raw_docs_path, 'rb') as f:
+            for file_name, offset in offsets.items():
+                f.seek(offset)
+                record = json.loads(f.readline())
+                record.pop('file', None)
+                yield file_name, record
+
+    def _compact_documentation(self, order):
+        """
+        Rewrite the store once with a single record per file, in the given order.
+
+        Used after concurrent runs so the on-disk layout matches a sequential run.
+        """
+        if not self.raw_docs_path.exists():
+            return
+        offsets = self._index_documentation()
+        names = [name for name in order if name in offsets]
+        names += [name for name in offsets if name not in set(names)]
+        tmp_path = self.raw_docs_path.with_suffix('.jsonl.tmp')
+        with open(self.raw_docs_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            for name in names:
+                src.seek(offsets[name])
+                dst.write(src.readline())
+        os.replace(tmp_path, self.raw_docs_path)
+
+    # ------------------------------------------------------------------
+    #  Checkpoints – what an interrupted run already finished
+    # ------------------------------------------------------------------
+    @property
+    def checkpoint_dir(self):
+        return self.output_dir / 'checkpoints'
+
+    def _checkpoint_path(self, file_name):
+        return self.checkpoint_dir / f"{file_name}.jsonl"
+
+    @staticmethod
+    def _read_jsonl(path):
+        """Records of a JSONL file, skipping a line torn by an interrupted write"""
+        if not path.exists():
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def _file_checkpoint(self, file_name):
+        """Responses already received for one file's requests, keyed like the response cache"""
+        with self._doc_lock:
+            if file_name not in self._checkpoints:
+                self._checkpoints[file_name] = {
+                    entry['key']: entry['text'] for entry in self._read_jsonl(self._checkpoint_path(file_name))
+                }
+            return self._checkpoints[file_name]
+
+    def _save_checkpoint(self, file_name, key, text):
+        """Append one response to the file's checkpoint as soon as it arrives"""
+        line = json.dumps({'key': key, 'text': text})
+        with self._doc_lock:
+            self.checkpoint_dir.mkdir(exist_ok=True)
+            with open(self._checkpoint_path(file_name), 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+            self._checkpoints.setdefault(file_name, {})[key] = text
+
+    def _resumed_record(self, file_name, content):
+        """The stored record of a file finished by the interrupted run, if its source is unchanged"""
+        with self._doc_lock:
+            if self._resumable is None:
+                self._resumable = {}
+                if self.raw_docs_path.exists():
+                    for name, offset in self._index_documentation().items():
+                        self._resumable[name] = offset
+            offset = self._resumable.get(file_name)
+        if offset is None:
+            return None
+        with open(self.raw_docs_path, 'rb') as f:
+            f.seek(offset)
+            record = json.loads(f.readline())
+        return record if record.get('original_code') == content else None
+
+    @staticmethod
+    def _record_digest(doc_data):
+        """Short hash of the source and documentation an output is built from"""
+        text = f"{doc_data.get('original_code', '')}\0{doc_data.get('raw_doc', '')}"
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+    def _output_done(self, file_name, fmt, doc_data):
+        """Whether an earlier run in this directory already wrote this output from the same record"""
+        if not self.resume:
+            return False
+        with self._doc_lock:
+            if self._completed_outputs is None:
+                self._completed_outputs = {
+                    (entry['file'], entry['format'], entry.get('digest'))
+                    for entry in self._read_jsonl(self.checkpoint_dir / 'outputs.jsonl')
+                }
+            return (file_name, fmt, self._record_digest(doc_data)) in self._completed_outputs
+
+    def _mark_output_done(self, file_name, fmt, doc_data):
+        entry = {'file': file_name, 'format': fmt, 'digest': self._record_digest(doc_data)}
+        with self._doc_lock:
+            self.checkpoint_dir.mkdir(exist_ok=True)
+            with open(self.checkpoint_dir / 'outputs.jsonl', 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def _write_atomic(self, path, text):
+        """Write text to path via a temp file so readers never see a partial file"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    # ------------------------------------------------------------------
+    #  Content-addressed analysis cache
+    # ------------------------------------------------------------------
+    def _analysis_cache_key(self, content, model, system_prompt, max_tokens):
+        """
+        Hash everything that can change the model's answer for a file.
+
+        The prompt template is hashed with empty placeholders so editing the
+        wording of _create_ruby_prompt invalidates every cached entry.
+        """
+        template = self._create_ruby_prompt('', '')
+        template_hash = hashlib.sha256(
+            f"{system_prompt}\0{max_tokens}\0{template}".encode('utf-8')
+        ).hexdigest()
+        content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        return hashlib.sha256(f"{content_hash}\0{model}\0{template_hash}".encode('utf-8')).hexdigest()
+
+    def _analysis_cache_path(self, key):
+        """Shard cache entries by the first two hex digits of their key"""
+        return self.analysis_cache_dir / key[:2] / f"{key}.json"
+
+    def _load_cached_analysis(self, key):
+        """Return the cached raw_doc for key, or None on a miss"""
+        if not self.use_cache:
+            return None
+        path = self._analysis_cache_path(key)
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)['raw_doc']
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def _store_cached_analysis(self, key, file_name, model, raw_doc):
+        """Persist raw_doc under key for later runs"""
+        if not self.use_cache:
+            return
+        entry = {'file': file_name, 'model': model, 'raw_doc': raw_doc}
+        self._write_atomic(self._analysis_cache_path(key), json.dumps(entry))
+
+    def _count_tokens(self, text):
+        """Count model tokens with tiktoken when available, else estimate ~4 chars/token"""
+        if tiktoken is not None and self._token_encoder is None:
+            self._token_encoder = tiktoken.get_encoding('o200k_base')
+        if self._token_encoder is not None:
+            return len(self._token_encoder.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
 
     def _get_language_from_extension(self, file_path):
         """Determine language based on file extension"""
@@ -69,6 +1969,7 @@ class Lich5DocumentationGenerator:
         else:
             return 'unknown'
 
+    @traced('analyze_file')
     def analyze_file(self, file_path, chunk_content=None):
         """
         Analyze a single file or chunk of code and generate YARD-compatible docs.
@@ -79,6 +1980,7 @@ class Lich5DocumentationGenerator:
         """
         rel_path = Path(file_path).name
         logging.info(f"Analyzing file: {rel_path}")
+        self.trace.note(file=rel_path)
 
         try:
             # Load code
@@ -87,39 +1989,377 @@ class Lich5DocumentationGenerator:
             else:
                 with open(file_path, 'r', encoding='utf-8') as f:
                     content = f.read()
+            self.trace.note(lines=content.count('\n') + 1)
+
+            if self.resume and chunk_content is None:
+                record = self._resumed_record(rel_path, content)
+                if record is not None:
+                    logging.info(f"Resuming: analysis of {rel_path} already complete")
+                    self.trace.note(resumed=True)
+                    if self.output_formats:
+                        self._emit_file_outputs(rel_path, record, self.output_formats)
+                    return record['raw_doc']
+
+            request = self._analysis_request(rel_path, content)
+            model = request['model']
+
+            # Reuse the previous answer when nothing that feeds the prompt changed
+            cache_key = self._analysis_cache_key(content, model, request['system_prompt'],
+                                                 request['max_tokens'])
+            raw_doc = self._load_cached_analysis(cache_key)
+
+            self.trace.note(cached=raw_doc is not None)
+            if raw_doc is not None:
+                with self._doc_lock:
+                    self.cache_hits += 1
+                logging.info(f"Reusing cached analysis for unchanged file: {rel_path}")
+            else:
+                with self._doc_lock:
+                    self.cache_misses += 1
+
+                # Send to OpenAI and merge the prose into the local tag skeletons
+                started = time.perf_counter()
+                index = RubySymbolIndex(content)
+                known = self._known_symbol_blocks(rel_path, index, model) if chunk_content is None else {}
+                existing = self._documented_blocks(index) if self.skip_documented else {}
+                known.update(existing)
+                if known:
+                    # Only new, edited or under-documented symbols go to the model
+                    logging.info(f"Re-documenting {len(index.symbols) - len(known)} of {len(index.symbols)} "
+                                 f"symbols in {rel_path}; the rest are unchanged or already documented")
+                    answers, accepted = self._chunked_analysis(rel_path, content, index, skip=known)
+                    response = ''
+                elif rel_path in self._split_files and chunk_content is None:
+                    answers, accepted = self._chunked_analysis(rel_path, content, index)
+                    response = ''
+                else:
+                    response, _, outcome = self._routed_chat(
+                        'analysis', rel_path, request, content,
+                        accept=lambda text: self._answers_enough(text, index.symbols),
+                        checkpoint=rel_path if chunk_content is None else None)
+                    answers = self._parse_anchored_comments(response)
+                    accepted = outcome == 'ok'
+                if not known:
+                    self._record_cost(rel_path, self._count_tokens(content), time.perf_counter() - started)
+                blocks = {**known, **self._render_anchored_blocks(index, answers)}
+                if blocks:
+                    raw_doc = self._assemble_raw_doc(index, blocks)
+                else:
+                    logging.warning(f"No anchored blocks in the response for {rel_path}; keeping it verbatim")
+                    raw_doc = response
+                if not accepted:
+                    # The top tier's answer is still truncated or incomplete; the next run asks again
+                    logging.warning(f"Not caching the analysis of {rel_path}: no model tier gave a usable answer")
+                elif not existing:
+                    # A result that kept source comments is not what a full run would produce
+                    self._store_cached_analysis(cache_key, rel_path, model, raw_doc)
+                if accepted and chunk_content is None:
+                    self._store_symbol_blocks(rel_path, index, model,
+                                              {start: block for start, block in blocks.items() if start not in existing})
+
+            # Persist to disk
+            record = {
+                'raw_doc': raw_doc,
+                'api_doc': self._extract_api_documentation(raw_doc, 'ruby'),
+                'original_code': content
+            }
+            with self._doc_lock:
+                self._write_documentation(rel_path, record)
+
+            logging.info(f"Completed analysis of file: {rel_path}")
+
+            # Write every requested format for this file right away
+            if self.output_formats:
+                self._emit_file_outputs(rel_path, record, self.output_formats)
+            return raw_doc
+
+        except Exception as e:
+            logging.error(f"Error analyzing file {file_path}: {e}", exc_info=True)
+            return None
+
+    def _chunked_analysis(self, file_name, content, index, skip=()):
+        """Analyze a file as parallel anchored chunk requests; returns (merged answers, every chunk accepted)"""
+        jobs = self._anchor_jobs(file_name, content, index, skip=skip, task='analysis')
+        logging.info(f"Analyzing {file_name} as {len(jobs)} parallel chunk requests")
+
+        def run(job):
+            request, symbols = job
+            response, _, outcome = self._routed_chat('analysis', file_name, request, self._request_code(request),
+                                                     accept=lambda text: self._answers_enough(text, symbols),
+                                                     checkpoint=file_name)
+            return self._parse_anchored_comments(response), outcome == 'ok'
+
+        results = self._chunk_pool.map(run, jobs) if self._chunk_pool else map(run, jobs)
+        answers = {}
+        accepted = True
+        for result, ok in results:
+            answers.update(result)
+            accepted = accepted and ok
+        return answers, accepted
+
+    # ------------------------------------------------------------------
+    #  Symbol cache – comment blocks of unchanged defs survive edits
+    # ------------------------------------------------------------------
+    def _symbol_cache_path(self, file_name):
+        return self.symbol_cache_dir / f"{file_name}.json"
+
+    def _known_symbol_blocks(self, file_name, index, model):
+        """Comment blocks from the file's last analysis, by start line, for symbols whose fingerprint is unchanged"""
+        if not self.use_cache:
+            return {}
+        try:
+            with open(self._symbol_cache_path(file_name), 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if cached.get('model') != model:
+            return {}
+        blocks = cached.get('blocks', {})
+        known = {}
+        for symbol in index.symbols:
+            block = blocks.get(index.fingerprint(symbol))
+            if block:
+                known[symbol.start] = block
+        return known
+
+    def _documented_blocks(self, index):
+        """The source's own comment blocks, by start line, for symbols whose YARD is complete and current"""
+        blocks = {}
+        for entry in yard_coverage(None, index):
+            if not entry.missing and not entry.stale:
+                symbol = entry.symbol
+                blocks[symbol.start] = [line.strip() for line in index.lines[index.comment_start(symbol):symbol.start]]
+        return blocks
+
+    def _store_symbol_blocks(self, file_name, index, model, blocks):
+        """Replace the file's symbol cache with the blocks of its current symbols"""
+        if not self.use_cache or not blocks:
+            return
+        by_fingerprint = {
+            index.fingerprint(symbol): blocks[symbol.start]
+            for symbol in index.symbols if symbol.start in blocks
+        }
+        self._write_atomic(self._symbol_cache_path(file_name),
+                           json.dumps({'model': model, 'blocks': by_fingerprint}))
+
+    # ------------------------------------------------------------------
+    #  Scheduling – estimated cost per file, largest first
+    # ------------------------------------------------------------------
+    def _load_cost_history(self):
+        with self._doc_lock:
+            if self._cost_history is None:
+                try:
+                    self._cost_history = json.loads(self.cost_history_path.read_text(encoding='utf-8'))
+                except (OSError, ValueError):
+                    self._cost_history = {}
+            return self._cost_history
+
+    def _record_cost(self, file_name, tokens, seconds):
+        """Remember how long a file's analysis took per token of source"""
+        history = self._load_cost_history()
+        with self._doc_lock:
+            history[file_name] = {'tokens': tokens, 'seconds': round(seconds, 3)}
+
+    def _save_cost_history(self):
+        history = self._load_cost_history()
+        with self._doc_lock:
+            text = json.dumps(history, indent=1, sort_keys=True)
+        self._write_atomic(self.cost_history_path, text)
+
+    def _estimate_costs(self, files):
+        """
+        Estimated analysis seconds (or tokens, with no history) for each file.
+
+        A file's own past seconds-per-token rate is used when known, otherwise
+        the median rate of every file seen so far.
+        """
+        history = self._load_cost_history()
+        rates = sorted(h['seconds'] / h['tokens'] for h in history.values() if h.get('tokens'))
+        default_rate = rates[len(rates) // 2] if rates else 1.0
+        costs = []
+        for file_path in files:
+            try:
+                tokens = self._count_tokens(Path(file_path).read_text(encoding='utf-8'))
+            except (OSError, UnicodeDecodeError):
+                tokens = 0
+            past = history.get(Path(file_path).name)
+            rate = past['seconds'] / past['tokens'] if past and past.get('tokens') else default_rate
+            costs.append((tokens * rate, tokens))
+        return costs
+
+    def _schedule(self, files):
+        """
+        Order files longest-first and pick the ones to split into chunk jobs.
+
+        Longest-processing-time-first keeps one huge file from starting last.
+        Any file costing more than an even share of the total (total / workers)
+        would still bound the makespan on its own, so its analysis is fanned
+        out as parallel chunk requests – unless its whole-file answer is
+        already at hand (from a batch or the response cache), which splitting
+        would throw away.
+        """
+        costs = self._estimate_costs(files)
+        order = sorted(range(len(files)), key=lambda i: -costs[i][0])
+        share = sum(cost for cost, _ in costs) / self.concurrency
+        self._split_files = {
+            Path(files[i]).name for i in order
+            if costs[i][0] > share and costs[i][1] > self.chunk_tokens
+            and not self._analysis_answered(files[i])
+        }
+        if self._split_files:
+            logging.info(f"Splitting analysis of {', '.join(sorted(self._split_files))} into chunk jobs")
+        return [files[i] for i in order]
+
+    def _analysis_answered(self, file_path):
+        """Whether a file's whole-file analysis request can be answered without a live call"""
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        key = ResponseCache.key(**self._analysis_request(Path(file_path).name, content))
+        if key in self.batch_results:
+            return self.batch_results[key][1] != 'length'      # a truncated answer escalates to a live call
+        return self.response_cache is not None and key in self.response_cache
 
-            # Build prompt
-            prompt = self._create_ruby_prompt(rel_path, content)
+    # ------------------------------------------------------------------
+    #  Request builders – every prompt the pipeline sends, as _chat kwargs
+    # ------------------------------------------------------------------
+    def _first_route(self, task, code):
+        """The cheapest route for a request, as _chat kwargs"""
+        return self.router.ladder(task, self._count_tokens(code))[0]._asdict()
+
+    def _analysis_request(self, file_name, content):
+        """Build the _chat arguments for the YARD analysis of one file"""
+        return {
+            **self._first_route('analysis', content),
+            'temperature': 0,
+            'system_prompt': "You are an expert code documentation specialist …",
+            'messages': [{ "role": "user", "content": self._create_ruby_prompt(file_name, content) }],
+        }
+
+    def _small_file_request(self, original_code):
+        """Build the _chat arguments for annotating a file in one request"""
+        return {
+            **self._first_route('annotation', original_code),
+            'temperature': 0,
+            'system_prompt': "You are an expert code documentation specialist. Your task is to insert appropriate documentation comments into existing code.",
+            'messages': [{
+                "role": "user",
+                "content": f"""
+Insert YARD-format comments into the Ruby code below.
+
+Original code:
+```
+{original_code}
+```
+
+Rules - apply to each method / class / module
+• Include these tags whenever they contain real information 
+• @param    - list every parameter
+• @return   - return type + meaning
+• @raise    - every possible exception
+• @example  - one concise code snippet, always include an example.
+• @note     - hidden caveat / side-effect
+
+• Place every comment block **immediately above** the class / module / method
+  it documents (same indentation as the `def`, *never* inside the body).
+• Do NOT change, delete, reorder, or re-format any executable code.
+• Preserve original indentation and blank lines.
+• Wrap the entire annotated file in a single ```ruby block and output nothing else.
+ABSOLUTELY DO NOT delete, rename, reorder, or modify ANY existing code lines, even if they appear duplicated or redundant.
+"""
+            }],
+        }
+
+    def _chunk_request(self, chunk, index, total):
+        """Build the _chat arguments for annotating chunk *index* (0-based) of *total*"""
+        scope_note = (f"\nThe chunk sits inside `{chunk.context}`; its indentation is relative to that scope. "
+                      f"Do not add the enclosing declarations.\n") if chunk.context else ""
+        return {
+            **self._first_route('annotation', chunk.text),
+            'temperature': 0,
+            'system_prompt': "You are an expert documentation specialist. Your task is to insert appropriate documentation comments into existing code.",
+            'messages': [{
+                "role": "user",
+                "content": f"""
+I have a chunk of a larger Ruby file and documentation for the entire file.
+Your task is to identify which parts of the documentation apply to this code chunk
+and insert those comments at the appropriate places.
+
+Code chunk {index+1}/{total}:{scope_note}
+```ruby
+{chunk.text}
+```
 
-            # Send to OpenAI
-            raw_doc = self._chat(
-              model="gpt-4o-mini",                # or gpt‑4o if you have access
-              max_tokens=4096,
-              temperature=0,
-              system_prompt="You are an expert code documentation specialist …",
-              messages=[{ "role": "user", "content": prompt }],
-            )
+Rules - apply to each method / class / module
+• Include these tags whenever they contain real information 
+• @param    - list every parameter
+• @return   - return type + meaning
+• @raise    - every possible exception
+• @example  - one concise code snippet, always include an example.
+• @note     - hidden caveat / side-effect.
 
-            # Store into our dict
-            self.documentation[rel_path] = {
-                'raw_doc': raw_doc,
-                'api_doc': self._extract_api_documentation(raw_doc, 'ruby'),
-                'original_code': content
-            }
+• Place every comment block **immediately above** the class / module / method
+  it documents (same indentation as the `def`, *never* inside the body).
+• Do NOT change, delete, reorder, or re-format any executable code.
+• Preserve original indentation and blank lines.
+• Wrap the entire annotated file in a single ```ruby block and output nothing else.
+ABSOLUTELY DO NOT delete, rename, reorder, or modify ANY existing code lines, even if they appear duplicated or redundant.
+"""
+            }],
+        }
 
-            # Persist to disk
-            self._write_documentation()
+    def _anchor_request(self, file_name, chunk, symbols, index, task='annotation'):
+        """
+        Build the _chat arguments asking only for comment blocks, keyed by line anchors.
 
-            logging.info(f"Completed analysis of file: {rel_path}")
-            return raw_doc
+        The model sees the code once and answers with ``@@ L<line>`` headers
+        followed by prose and tag descriptions, which are merged into the
+        local YARD skeletons and spliced in by _splice_comments.
+        """
+        scope_note = f" (inside `{chunk.context}`)" if chunk.context else ""
+        return {
+            **self._first_route(task, chunk.text),
+            'temperature': 0,
+            'system_prompt': "You are an expert code documentation specialist. You write YARD comment blocks for existing Ruby code.",
+            'messages': [{
+                "role": "user",
+                "content": self._create_ruby_prompt(file_name, chunk.text, index=index,
+                                                    symbols=symbols, scope_note=scope_note),
+            }],
+        }
 
-        except Exception as e:
-            logging.error(f"Error analyzing file {file_path}: {e}", exc_info=True)
-            return None
+    def _anchor_jobs(self, file_name, original_code, index, skip=(), task='annotation'):
+        """Pair each anchored request with the symbols it covers, leaving out start lines in skip"""
+        if self._needs_chunking(original_code):
+            chunks = self._split_code_into_chunks(original_code)
+        else:
+            chunks = [CodeChunk(original_code, 0, max(len(index.lines) - 1, 0), '')]
+
+        jobs = []
+        for chunk in chunks:
+            symbols = [symbol for symbol in index.symbols
+                       if chunk.start <= symbol.start <= chunk.end and symbol.start not in skip]
+            if symbols:
+                jobs.append((self._anchor_request(file_name, chunk, symbols, index, task), symbols))
+        return jobs
+
+    def _annotation_requests(self, file_name, original_code):
+        """All _chat requests needed to annotate one file, in the order they are sent"""
+        if self.annotate_mode == 'anchored':
+            index = RubySymbolIndex(original_code)
+            return [request for request, _ in self._anchor_jobs(file_name, original_code, index)]
+        if not self._needs_chunking(original_code):
+            return [self._small_file_request(original_code)]
+        chunks = self._split_code_into_chunks(original_code)
+        return [self._chunk_request(chunk, i, len(chunks)) for i, chunk in enumerate(chunks)]
+
+    def _needs_chunking(self, original_code):
+        """True when a file does not fit one request's token budget"""
+        return self._count_tokens(original_code) > self.chunk_tokens
 
     # ------------------------------------------------------------------
     #  Unified chat helper
     # ------------------------------------------------------------------
+    @traced('chat')
     def _chat(
         self,
         messages,
@@ -127,69 +2367,456 @@ class Lich5DocumentationGenerator:
         max_tokens=4096,
         temperature=0.0,
         system_prompt=None,
+        stop_at_fence=False,
+        checkpoint=None,
+        with_finish_reason=False,
+        accept=None,
     ):
         """
-        Thin wrapper around OpenAI ChatCompletions.create.
+        Thin wrapper around the model backend's completion call.
 
         * Accepts the same args your previous Anthropic calls used.
         * Returns assistant text (string), not the whole response object.
+        * Deterministic (temperature 0) calls are served from the response
+          cache when the identical request has been seen before.
+        * Answers already fetched by a batch job are returned without a call.
+        * With streaming on, stop_at_fence ends the request as soon as the
+          first fenced code block closes instead of waiting for the rest.
+        * checkpoint names the file the request belongs to; its answer is
+          saved with the run so --resume never asks for it again.
+        * with_finish_reason returns (text, finish_reason); the reason is None
+          for cached and checkpointed answers, which were complete. Truncated answers
+          (finish_reason 'length') and answers accept(text) rejects are
+          neither cached nor checkpointed.
         """
+        def done(text, finish_reason=None):
+            return (text, finish_reason) if with_finish_reason else text
+
+        self.trace.note(model=model)
+        request_key = ResponseCache.key(model, system_prompt, messages, max_tokens, temperature)
+        if request_key in self.batch_results:
+            self.trace.note(source='batch')
+            return done(*self.batch_results[request_key])
+
+        if checkpoint is not None:
+            saved = self._file_checkpoint(checkpoint).get(request_key)
+            if saved is not None:
+                self.trace.note(source='checkpoint')
+                return done(saved)
+
+        cache_key = None
+        if self.response_cache is not None and temperature == 0:
+            cache_key = request_key
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                self.trace.note(source='cache')
+                if checkpoint is not None:
+                    self._save_checkpoint(checkpoint, request_key, cached)
+                return done(cached)
+
+        messages = self._build_messages(system_prompt, messages)
+
+        def call():
+            if self.stream:
+                return self._stream_chat(model, messages, max_tokens, temperature, stop_at_fence)
+            return self.backend.complete(model, messages, max_tokens, temperature)
+
+        text, usage, finish_reason = self._with_retries(call)
+        self.trace.note(
+            source='model',
+            finish_reason=finish_reason,
+            prompt_tokens=getattr(usage, 'prompt_tokens', None),
+            completion_tokens=getattr(usage, 'completion_tokens', None) or self._count_tokens(text or ''),
+        )
+
+        if text is not None and finish_reason != 'length' and (accept is None or accept(text)):
+            if cache_key is not None:
+                self.response_cache.put(cache_key, text)
+            if checkpoint is not None:
+                self._save_checkpoint(checkpoint, request_key, text)
+        return done(text, finish_reason)
+
+    def _routed_chat(self, task, file_name, request, code, accept=None, **kwargs):
+        """
+        Send request on the router's ladder for task, escalating while the answer is unusable.
+
+        An answer is unusable when it was cut off at max_tokens or when
+        accept(text) is false. Every attempt is recorded in routing.jsonl.
+        Returns (text, request actually used, outcome); the last answer is
+        returned even if it is still unusable, with outcome 'truncated' or
+        'invalid' instead of 'ok', and callers must not cache it.
+        """
+        tokens = self._count_tokens(code)
+        ladder = self.router.ladder(task, tokens)
+        for tier, route in enumerate(ladder):
+            attempt = {**request, **route._asdict()}
+            text, finish_reason = self._chat(**attempt, with_finish_reason=True, accept=accept, **kwargs)
+            if finish_reason == 'length':
+                outcome = 'truncated'
+            elif accept is not None and not accept(text):
+                outcome = 'invalid'
+            else:
+                outcome = 'ok'
+            self._record_route(file_name, task, tokens, tier, route, outcome)
+            if outcome == 'ok' or tier == len(ladder) - 1:
+                return text, attempt, outcome
+            logging.warning(f"{file_name}: {task} answer from {route.model} ({route.max_tokens} tokens) "
+                            f"was {outcome}; escalating to {ladder[tier + 1].model} "
+                            f"({ladder[tier + 1].max_tokens} tokens)")
+
+    def _record_route(self, file_name, task, tokens, tier, route, outcome):
+        """Append one routing decision to routing.jsonl in the output directory"""
+        self.router.count(task, tier, outcome)
+        entry = {'file': file_name, 'task': task, 'source_tokens': tokens, 'tier': tier,
+                 'model': route.model, 'max_tokens': route.max_tokens, 'outcome': outcome}
+        with self._doc_lock:
+            with open(self.output_dir / 'routing.jsonl', 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def log_routing_stats(self):
+        """Summarize routing decisions: attempts per task, tier and outcome"""
+        for (task, tier, outcome), count in sorted(self.router.counts.items()):
+            logging.info(f"Routing: {task} tier {tier}: {count} {outcome}")
+
+    def _with_retries(self, call):
+        """
+        Run one model call under the adaptive limiter, retrying transient failures.
+
+        Waits honor Retry-After when the server sends it and otherwise back off
+        exponentially with full jitter (capped at 60s). 429s shrink the
+        limiter; successes grow it back.
+        """
+        attempt = 0
+        retryable = self.backend.retryable_errors()
+        while True:
+            with self.limiter.slot():
+                started = time.perf_counter()
+                try:
+                    result = call()
+                except retryable as e:
+                    error = e
+                else:
+                    self.limiter.on_success(time.perf_counter() - started)
+                    self.trace.note(retries=attempt)
+                    return result
+
+            if self.backend.is_throttle(error):
+                self.limiter.on_throttle()
+            if attempt >= self.max_retries:
+                self.trace.note(retries=attempt, error=type(error).__name__)
+                raise error
+            delay = retry_after_seconds(error)
+            if delay is None:
+                delay = random.uniform(0, min(60.0, 2.0 ** attempt))
+            attempt += 1
+            logging.warning(f"{type(error).__name__} from model call; retry {attempt}/{self.max_retries} "
+                            f"in {delay:.1f}s")
+            time.sleep(delay)
+
+    def _stream_chat(self, model, messages, max_tokens, temperature, stop_at_fence):
+        """Consume a streamed completion, recording TTFT and throughput; returns (text, usage, finish_reason)"""
+        started = time.perf_counter()
+        first_token = None
+        usage = None
+        finish_reason = None
+        watcher = FenceWatcher()
+
+        stream = self.backend.stream(model, messages, max_tokens, temperature)
+        try:
+            for delta, event_usage, event_finish in stream:
+                usage = event_usage or usage
+                finish_reason = event_finish or finish_reason
+                if not delta:
+                    continue
+                if first_token is None:
+                    first_token = time.perf_counter()
+                if watcher.feed(delta) and stop_at_fence:
+                    break
+        finally:
+            stream.close()
+
+        elapsed = time.perf_counter() - started
+        text = watcher.text
+        completion_tokens = usage.completion_tokens if usage else self._count_tokens(text)
+        generating = elapsed - (first_token - started) if first_token else 0
+        metric = {
+            'model': model,
+            'ttft': (first_token - started) if first_token else None,
+            'duration': elapsed,
+            'completion_tokens': completion_tokens,
+            'tokens_per_sec': completion_tokens / generating if generating > 0 else None,
+            'stopped_early': watcher.closed and stop_at_fence,
+        }
+        with self._doc_lock:
+            self.stream_metrics.append(metric)
+        ttft = f"{metric['ttft']:.2f}s" if metric['ttft'] is not None else "n/a"
+        rate = f"{metric['tokens_per_sec']:.0f} tok/s" if metric['tokens_per_sec'] else "n/a"
+        logging.info(f"Streamed {completion_tokens} tokens in {elapsed:.2f}s (TTFT {ttft}, {rate}"
+                     f"{', stopped at closing fence' if metric['stopped_early'] else ''})")
+        self.trace.note(ttft=metric['ttft'], stopped_early=metric['stopped_early'])
+        return text, usage, finish_reason
+
+    def export_trace(self, path=None):
+        """Write the run's spans as a Chrome trace and log where the time went"""
+        if not self.trace.enabled:
+            return None
+        path = Path(path) if path else self.output_dir / 'trace.json'
+        self.trace.export(path)
+        for name, (count, seconds) in self.trace.summary():
+            logging.info(f"Profile: {name}: {count} spans, {seconds:.2f}s total")
+        files = [e for e in self.trace.events if e['name'] == 'analyze_file']
+        for event in sorted(files, key=lambda e: -e['dur'])[:5]:
+            logging.info(f"Profile: slowest file {event['args'].get('file')}: {event['dur'] / 1e6:.2f}s")
+        logging.info(f"Wrote run trace: {path}")
+        return path
+
+    def log_stream_stats(self):
+        """Summarize time-to-first-token and throughput of streamed calls"""
+        with self._doc_lock:
+            metrics = list(self.stream_metrics)
+        if not metrics:
+            return
+        ttfts = sorted(m['ttft'] for m in metrics if m['ttft'] is not None)
+        tokens = sum(m['completion_tokens'] for m in metrics)
+        generating = sum(m['duration'] - (m['ttft'] or 0) for m in metrics)
+        median = f"{ttfts[len(ttfts) // 2]:.2f}s" if ttfts else "n/a"
+        early = sum(1 for m in metrics if m['stopped_early'])
+        logging.info(f"Streaming: {len(metrics)} calls, median TTFT {median}, "
+                     f"{tokens / generating if generating > 0 else 0:.0f} tok/s overall, {early} stopped early")
+
+    def _build_messages(self, system_prompt, messages):
+        """Prepend the system prompt in the OpenAI message format"""
         if system_prompt:
-            messages = [{"role": "system", "content": system_prompt}] + messages
+            return [{"role": "system", "content": system_prompt}] + messages
+        return messages
 
-        resp = self.client.chat.completions.create(
-            model=model,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature,
+    # ------------------------------------------------------------------
+    #  Offline batch submission
+    # ------------------------------------------------------------------
+    def process_batch(self, output_format='yard', batch_id=None, poll_interval=60):
+        """
+        Push the whole run through the provider's Batch API instead of live calls.
+
+        Every request analyze_file and the annotators would send is written to
+        batch_input.jsonl under its response-cache key, submitted as one batch
+        and polled until it finishes. The normal pipeline then runs and finds
+        each answer under the same key, so no live calls are made for them.
+
+        Args:
+            output_format: Format(s) that will be generated afterwards; annotation
+                prompts are only batched for 'annotated' in rewrite mode
+            batch_id: Attach to an already submitted batch instead of creating one
+            poll_interval: Seconds between status checks
+        """
+        if not self.backend.supports_batch:
+            logging.error(f"The {self.backend.name} backend does not support the Batch API")
+            return
+
+        files = [self.input_file] if self.input_file else self._collect_files()
+
+        if batch_id is None:
+            requests = self._collect_batch_requests(files, output_format)
+            if requests:
+                batch_id = self._submit_batch(requests)
+            else:
+                logging.info("Nothing to submit: every request is already cached")
+
+        if batch_id:
+            batch = self._wait_for_batch(batch_id, poll_interval)
+            self._load_batch_results(batch)
+
+        if self.input_file:
+            self.process_file()
+        else:
+            self.process_directory()
+
+    def _collect_batch_requests(self, files, output_format):
+        """Map response-cache key -> _chat request for everything not cached yet"""
+        requests = {}
+        for file_path in files:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+
+            file_requests = []
+            analysis = self._analysis_request(Path(file_path).name, content)
+            analysis_key = self._analysis_cache_key(content, analysis['model'],
+                                                    analysis['system_prompt'], analysis['max_tokens'])
+            if self._load_cached_analysis(analysis_key) is None:
+                file_requests.append(analysis)
+            # Anchored annotation reuses the analysis blocks, so only rewrite mode
+            # needs annotation prompts of its own
+            if 'annotated' in parse_output_formats(output_format) and self.annotate_mode == 'rewrite':
+                file_requests.extend(self._annotation_requests(Path(file_path).name, content))
+
+            for request in file_requests:
+                key = ResponseCache.key(**request)
+                if self.response_cache is not None and key in self.response_cache:
+                    continue
+                requests[key] = request
+
+        logging.info(f"Collected {len(requests)} requests from {len(files)} files for batch submission")
+        return requests
+
+    def _submit_batch(self, requests):
+        """Write the batch JSONL file, upload it and start the batch job"""
+        batch_path = self.output_dir / 'batch_input.jsonl'
+        with open(batch_path, 'w', encoding='utf-8') as f:
+            for key, request in requests.items():
+                f.write(json.dumps({
+                    'custom_id': key,
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': {
+                        'model': request['model'],
+                        'messages': self._build_messages(request['system_prompt'], request['messages']),
+                        'max_tokens': request['max_tokens'],
+                        'temperature': request['temperature'],
+                    },
+                }) + '\n')
+
+        with open(batch_path, 'rb') as f:
+            batch_file = self.backend.client.files.create(file=f, purpose='batch')
+        batch = self.backend.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h',
         )
-        return resp.choices[0].message.content
+        (self.output_dir / 'batch_id.txt').write_text(batch.id)
+        logging.info(f"Submitted batch {batch.id} with {len(requests)} requests "
+                     f"(re-attach later with --batch-id {batch.id})")
+        return batch.id
+
+    def _wait_for_batch(self, batch_id, poll_interval):
+        """Poll a batch until it reaches a terminal state and return it"""
+        while True:
+            batch = self.backend.client.batches.retrieve(batch_id)
+            counts = getattr(batch, 'request_counts', None)
+            progress = f" ({counts.completed}/{counts.total} done)" if counts else ""
+            if batch.status == 'completed':
+                logging.info(f"Batch {batch_id} completed{progress}")
+                return batch
+            if batch.status == 'expired' and batch.output_file_id:
+                logging.warning(f"Batch {batch_id} expired{progress}; using its partial results")
+                return batch
+            if batch.status in ('failed', 'expired', 'cancelled'):
+                raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+            logging.info(f"Batch {batch_id} is {batch.status}{progress}; checking again in {poll_interval}s")
+            time.sleep(poll_interval)
+
+    def _load_batch_results(self, batch):
+        """Download batch output into batch_results (and complete answers into the response cache)"""
+        if not batch.output_file_id:
+            logging.error(f"Batch {batch.id} produced no output file")
+            return
+
+        failed = truncated = 0
+        output = self.backend.client.files.content(batch.output_file_id).text
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            response = record.get('response') or {}
+            if record.get('error') or response.get('status_code') != 200:
+                failed += 1
+                continue
+            choice = response['body']['choices'][0]
+            text, finish_reason = choice['message']['content'], choice.get('finish_reason')
+            self.batch_results[record['custom_id']] = (text, finish_reason)
+            if finish_reason == 'length':
+                truncated += 1             # escalated like a live answer, so never cached
+            elif self.response_cache is not None:
+                self.response_cache.put(record['custom_id'], text)
+
+        logging.info(f"Loaded {len(self.batch_results)} batch results")
+        if truncated:
+            logging.warning(f"{truncated} batch answers hit max_tokens; they will be escalated live")
+        if failed:
+            logging.warning(f"{failed} batch requests failed; they will be retried live")
+
+    def log_cache_stats(self):
+        """Report how many model calls were avoided by the caches and how often calls were throttled"""
+        if self.limiter.throttled or self.degraded_chunks:
+            logging.info(f"Rate limiting: {self.limiter.throttled} throttled calls, final concurrency "
+                         f"{int(self.limiter.limit)}, {self.degraded_chunks} chunks left unannotated")
+        if self.response_cache is None:
+            return
+        stats = self.response_cache.stats()
+        logging.info(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, "
+                     f"{stats['bytes'] / (1024 * 1024):.1f} MB on disk")
 
-    def _create_ruby_prompt(self, file_name: str, content: str) -> str:
+    def _create_ruby_prompt(self, file_name: str, content: str, index=None, symbols=None,
+                            scope_note: str = '') -> str:
         """
-        Build a prompt that forces complete YARD tags on every method.
+        Build a prompt that asks only for prose, keyed to declaration anchors.
+
+        Tag names and parameter lists come from the local YARD skeleton of each
+        class / module / def, so the model never has to rediscover them and
+        its answer can be merged back with render_yard_block.
+
+        Args:
+            index: RubySymbolIndex of the whole file (built from content if omitted)
+            symbols: Subset of the index to document (all symbols if omitted)
+            scope_note: Extra context line, e.g. the enclosing scope of a chunk
         """
-        return f"""Analyze this Ruby file from the Lich5 project: **{file_name}**
+        index = index or RubySymbolIndex(content)
+        symbols = index.symbols if symbols is None else symbols
+        anchors = []
+        for symbol in symbols:
+            anchors.append(f"L{symbol.start + 1}  {index.lines[symbol.start].strip()[:120]}")
+            anchors.extend(f"      {tag}" for tag in format_yard_skeleton(self._yard_skeleton(index, symbol)))
+        anchors = '\n'.join(anchors)
+
+        return f"""Document this Ruby code from the Lich5 project: **{file_name}**{scope_note}
 
-    \\```ruby
-    {content}
-    \\```
+```ruby
+{content}
+```
 
-    Generate **YARD-compatible** documentation for every public class, module,
-    method, and constant.
+Each declaration below has an anchor and a fixed YARD tag skeleton taken from its signature:
 
-    Rules - apply to *each* method / function
-    ----------------------------------------
-    • Include these tags whenever they contain real information 
+{anchors}
 
-    @param    - list every parameter
-    @return   - state return type + meaning
-    @raise    - brief description for each possible exception
-    @example  - one concise code example, always include an example
-    @note     - caveat, side-effect.
+Reply with one block per anchor and nothing else:
 
-    • Place every comment block **immediately above** the class / module / method
-  it documents (same indentation as the `def`, *never* inside the body).
-    • **Do NOT** alter, delete, reorder, or re-format any executable code.  
-    • Preserve original indentation and blank lines.  
-    • Return the *entire* documentation block only - **no Ruby source**.
+@@ L<line>
+<One to three sentences on what it does and when to use it.>
+@param <name> <description>      (one per skeleton @param; add a [Type] only to correct the skeleton)
+@return <description>
+@raise [ErrorClass] <when>       (only if it can raise)
+@note <caveat or side effect>    (only if there is one)
+@example
+  <one concise usage example - always include one>
 
-    Output template
-    ---------------
+Do not repeat any code, do not write '#' comment markers, and do not add @param names
+that are not in the skeleton.
+"""
 
-    \\```ruby
-    # <Class/Module description>
-    #
-    # @param <name> [Type] …
-    # @return [Type] …
-    # @raise [ErrorClass] …
-    # @example
-    #   # example code here
-    # @note …
-    \\```
+    def _yard_skeleton(self, index, symbol):
+        """Fixed YARD tags for a symbol, derived from its signature"""
+        if symbol.kind != 'def':
+            return []
+        return yard_skeleton(symbol, parse_ruby_params(index.signature(symbol)))
 
-    Ensure you cover **all** public methods and attributes.
-    """
+    def _render_anchored_blocks(self, index, answers):
+        """Turn parsed model answers {line: [lines]} into YARD comment blocks per symbol"""
+        by_start = {symbol.start: symbol for symbol in index.symbols}
+        return {
+            line_no: render_yard_block(self._yard_skeleton(index, by_start[line_no]), answer)
+            for line_no, answer in answers.items() if line_no in by_start
+        }
+
+    def _assemble_raw_doc(self, index, blocks):
+        """Lay out rendered comment blocks above their declarations as a ruby block"""
+        out = []
+        for symbol in index.symbols:
+            block = blocks.get(symbol.start)
+            if not block:
+                continue
+            declaration = index.lines[symbol.start]
+            indent = declaration[:len(declaration) - len(declaration.lstrip())]
+            out.extend(indent + line for line in block)
+            out.extend([declaration, ''])
+        return "```ruby\n" + '\n'.join(out).rstrip() + "\n```"
 
     def _create_generic_prompt(self, file_name, content, language):
         """Create a prompt for other programming languages"""
@@ -233,10 +2860,76 @@ Ensure completeness - document ALL public methods and attributes.
 
         logging.info(f"Processing directory: {self.input_dir}")
         
-        # Get all files in directory recursively
-        for file_path in sorted(Path(self.input_dir).glob('**/*')):
-            if file_path.is_file() and file_path.suffix.lower() in ['.rb', '.py', '.js', '.mjs']:
-                self.analyze_file(file_path)
+        files = self._collect_files()
+
+        if self.concurrency <= 1:
+            results = [self.analyze_file(file_path) for file_path in files]
+        else:
+            logging.info(f"Analyzing {len(files)} files with up to {self.concurrency} in flight")
+            ordered = self._schedule(files)
+            # Chunk jobs of split files run here; the limiter still caps calls in flight
+            self._chunk_pool = ThreadPoolExecutor(max_workers=self.concurrency) if self._split_files else None
+            # analyze_file swallows its own errors, so one bad file never
+            # cancels the rest of the pool
+            try:
+                with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                    done = dict(zip(ordered, pool.map(self.analyze_file, ordered)))
+            finally:
+                if self._chunk_pool:
+                    self._chunk_pool.shutdown()
+                    self._chunk_pool = None
+            results = [done[file_path] for file_path in files]
+
+        # Give files that failed even after _chat's retries one more pass,
+        # now that the limiter has settled, rather than leaving holes
+        retry = [i for i, r in enumerate(results) if r is None]
+        if retry:
+            logging.info(f"Retrying {len(retry)} failed files")
+            for i in retry:
+                results[i] = self.analyze_file(files[i])
+
+        if self.concurrency > 1 or retry:
+            # Files finish in arbitrary order; rewrite the store once in input
+            # order so the output is identical to a sequential run
+            with self._doc_lock:
+                self._compact_documentation([Path(file_path).name for file_path in files])
+
+        self._save_cost_history()
+
+        failed = [str(f) for f, r in zip(files, results) if r is None]
+        if failed:
+            logging.warning(f"{len(failed)} of {len(files)} files failed analysis: {', '.join(failed)}")
+        logging.info(f"Analysis cache: {self.cache_hits} reused, {self.cache_misses} sent to the model")
+
+    def _collect_files(self):
+        """Get all source files in the input directory recursively, sorted (only changed ones with since)"""
+        files = [
+            file_path for file_path in sorted(Path(self.input_dir).glob('**/*'))
+            if file_path.is_file() and file_path.suffix.lower() in ['.rb', '.py', '.js', '.mjs']
+        ]
+        if self.since:
+            changed = self._changed_since(self.since)
+            if changed is not None:
+                logging.info(f"{len([f for f in files if f.resolve() in changed])} of {len(files)} files "
+                             f"changed since {self.since}")
+                files = [f for f in files if f.resolve() in changed]
+        return files
+
+    def _changed_since(self, revision):
+        """Absolute paths under input_dir that differ from revision (including untracked files), or None"""
+        import subprocess
+        root = Path(self.input_dir)
+        try:
+            top = subprocess.run(['git', 'rev-parse', '--show-toplevel'], cwd=root, check=True,
+                                 capture_output=True, text=True).stdout.strip()
+            diff = subprocess.run(['git', 'diff', '--name-only', revision, '--', '.'], cwd=root, check=True,
+                                  capture_output=True, text=True).stdout
+            untracked = subprocess.run(['git', 'ls-files', '--others', '--exclude-standard', '--full-name', '.'],
+                                       cwd=root, check=True, capture_output=True, text=True).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(f"Could not list changes since {revision} ({e}); processing every file")
+            return None
+        return {(Path(top) / name).resolve() for name in (diff + untracked).splitlines() if name}
 
     def process_file(self):
         """Process the single input file"""
@@ -263,51 +2956,100 @@ Ensure completeness - document ALL public methods and attributes.
         logging.info(f"Processing code chunk as: {file_name}")
         return self.analyze_file(file_name, chunk_content)
 
-    def generate_documentation(self, output_format='yard'):
-        """Generate final documentation in desired format"""
-        logging.info(f"Generating documentation in {output_format} format...")
-        
-        # Read the collected documentation
-        self.documentation = self._read_documentation()
-        
-        if output_format.lower() == 'yard':
-            return self._generate_yard_docs()
-        elif output_format.lower() == 'markdown':
-            return self._generate_markdown_docs()
-        elif output_format.lower() == 'annotated':
-            return self._generate_annotated_code()
-        else:
+    def generate_documentation(self, output_format='yard', offline=False):
+        """
+        Generate final documentation in the desired format(s) from the store.
+
+        output_format may be a single format, a comma-separated list such as
+        'yard,markdown,annotated', or 'all'. The store is read once and every
+        format is written per record. Returns the format's directory for a
+        single format, otherwise the run's output directory.
+
+        Args:
+            output_format: Format name, comma-separated list, or 'all'
+            offline: Make no model calls; annotated files get only the comment
+                blocks already in the store, whatever the annotate mode
+        """
+        self.offline = offline
+        formats = parse_output_formats(output_format)
+        unsupported = [fmt for fmt in formats if fmt not in OUTPUT_FORMATS]
+        if unsupported or not formats:
             logging.error(f"Unsupported output format: {output_format}")
             return None
 
+        logging.info(f"Generating documentation in {', '.join(formats)} format...")
+        for file_name, doc_data in self._read_documentation():
+            self._emit_file_outputs(file_name, doc_data, formats, track=False)
+        self._finish_outputs(formats)
+
+        return self.output_dir / formats[0] if len(formats) == 1 else self.output_dir
+
+    def finish_documentation(self):
+        """Complete formats that were streamed during analysis (e.g. the Markdown index)"""
+        self._finish_outputs(self.output_formats)
+        if len(self.output_formats) == 1:
+            return self.output_dir / self.output_formats[0]
+        return self.output_dir
+
+    def _format_dir(self, fmt):
+        path = self.output_dir / fmt
+        path.mkdir(exist_ok=True)
+        return path
+
+    def _emit_file_outputs(self, file_name, doc_data, formats, track=True):
+        """Write one file's documentation in every requested format"""
+        writers = {
+            'yard': self._write_yard_file,
+            'markdown': self._write_markdown_file,
+            'annotated': self._write_annotated_file,
+            'html': self._write_html_file,
+        }
+        for fmt in formats:
+            if track and self._output_done(file_name, fmt, doc_data):
+                logging.info(f"Resuming: {fmt} output for {file_name} already written")
+                continue
+            try:
+                writers[fmt](self._format_dir(fmt), file_name, doc_data)
+                if track:
+                    self._mark_output_done(file_name, fmt, doc_data)
+            except Exception as e:
+                logging.error(f"Error writing {fmt} output for {file_name}: {e}", exc_info=True)
+
+    def _finish_outputs(self, formats):
+        """Write the per-format files that depend on the whole corpus (every file in the store)"""
+        if 'markdown' in formats:
+            self._write_markdown_index(self._format_dir('markdown'), self._stored_file_names())
+        if 'html' in formats:
+            self._write_html_site(self._format_dir('html'))
+
     def _generate_yard_docs(self):
         """Generate YARD documentation files"""
-        yard_dir = self.output_dir / 'yard'
-        yard_dir.mkdir(exist_ok=True)
-        
-        for file_name, doc_data in self.documentation.items():
-            # For YARD, we want to generate documentation comments only
-            if doc_data.get('api_doc', {}).get('language') == 'ruby':
-                output_path = yard_dir / f"{file_name}.yard"
-                
-                # Extract yard documentation - strip any code blocks and just keep comments
-                doc_content = doc_data['raw_doc']
-                
-                # Clean up the documentation to remove any actual Ruby code
-                # This keeps just the comments for YARD
-                clean_doc = self._clean_yard_documentation(doc_content)
-                
-                with open(output_path, 'w') as f:
-                    f.write(clean_doc)
-                
-                logging.info(f"Generated YARD documentation: {output_path}")
-        
-        return yard_dir
+        return self.generate_documentation('yard')
+
+    @traced('write_yard')
+    def _write_yard_file(self, yard_dir, file_name, doc_data):
+        """Write the YARD comments of one file"""
+        # For YARD, we want to generate documentation comments only
+        if doc_data.get('api_doc', {}).get('language') == 'ruby':
+            output_path = yard_dir / f"{file_name}.yard"
+            
+            # Extract yard documentation - strip any code blocks and just keep comments
+            doc_content = doc_data['raw_doc']
+            
+            # Clean up the documentation to remove any actual Ruby code
+            # This keeps just the comments for YARD
+            clean_doc = self._clean_yard_documentation(doc_content)
+            
+            with open(output_path, 'w') as f:
+                f.write(clean_doc)
+            self.trace.note(file=file_name, bytes=len(clean_doc.encode('utf-8')))
+            
+            logging.info(f"Generated YARD documentation: {output_path}")
 
     def _clean_yard_documentation(self, doc_content):
         """Remove Ruby code and keep only YARD comments"""
-        # Use regex to find code blocks and remove them
-        doc_content = re.sub(r'```ruby.*?```', '', doc_content, flags=re.DOTALL)
+        # Drop code fence markers; the comments are usually inside the fence
+        doc_content = re.sub(r'^\s*```.*$', '', doc_content, flags=re.M)
         
         # Remove any line that doesn't start with a comment
         lines = doc_content.split('\n')
@@ -331,85 +3073,225 @@ Ensure completeness - document ALL public methods and attributes.
 
     def _generate_annotated_code(self):
         """Generate annotated code files with documentation inserted as comments"""
-        annotated_dir = self.output_dir / 'annotated'
-        annotated_dir.mkdir(exist_ok=True)
+        return self.generate_documentation('annotated')
+
+    @traced('write_annotated')
+    def _write_annotated_file(self, annotated_dir, file_name, doc_data):
+        """Write one file's source with its documentation inserted as comments"""
+        original_code = doc_data.get('original_code', '')
         
-        for file_name, doc_data in self.documentation.items():
-            original_code = doc_data.get('original_code', '')
-            
-            if not original_code:
-                continue
-            
-            # Count lines to estimate size
-            code_line_count = len(original_code.split('\n'))
-            logging.info(f"Processing {file_name} with {code_line_count} lines")
-            
-            # For large files, process in chunks
-            if code_line_count > 600:  # Lower threshold for chunking
-                logging.info(f"File {file_name} is large ({code_line_count} lines). Processing in chunks.")
-                annotated_code = self._process_large_file(file_name, original_code, doc_data['raw_doc'])
-                annotated_code = self._restore_missing_defs(original_code, annotated_code)
-            else:
-                # Process normally for smaller files
-                annotated_code = self._process_small_file(file_name, original_code, doc_data['raw_doc'])
-                annotated_code = self._restore_missing_defs(original_code, annotated_code)
-            
-            output_path = annotated_dir / file_name
-            
-            # Ensure we have content to write
-            if not annotated_code or len(annotated_code.strip()) < 10:
-                logging.error(f"Generated empty or very small annotated code for {file_name}. Using original code instead.")
-                annotated_code = original_code  # Fallback to original if something went wrong
-            
-            # Write the file
-            with open(output_path, 'w') as f:
-                f.write(annotated_code)
-            
-            logging.info(f"Generated annotated code: {output_path} with {len(annotated_code.split('\\n'))} lines")
-            
-            # Verify content length against original
-            percent = (len(annotated_code.split('\\n')) / code_line_count) * 100
-            if percent < 90:
-                logging.warning(f"WARNING: Annotated code for {file_name} is only {percent:.1f}% of the original line count!")
-            
-        return annotated_dir
+        if not original_code:
+            return
         
+        # Count lines to estimate size
+        code_line_count = len(original_code.split('\n'))
+        logging.info(f"Processing {file_name} with {code_line_count} lines")
+        
+        if self.annotate_mode == 'anchored' or self.offline:
+            # Reuse the analysis comment blocks; only symbols it missed go to the model
+            annotated_code = self._annotate_with_anchors(file_name, original_code, doc_data.get('raw_doc'))
+        # For files that do not fit one request's token budget, process in chunks
+        elif self._needs_chunking(original_code):
+            logging.info(f"File {file_name} is large ({code_line_count} lines). Processing in chunks.")
+            annotated_code = self._process_large_file(file_name, original_code, doc_data['raw_doc'])
+            annotated_code = self._restore_missing_defs(original_code, annotated_code)
+        else:
+            # Process normally for smaller files
+            annotated_code = self._process_small_file(file_name, original_code, doc_data['raw_doc'])
+            annotated_code = self._restore_missing_defs(original_code, annotated_code)
+        
+        output_path = annotated_dir / file_name
+        
+        # Never write altered code: the splice path cannot change it, so fall back to that
+        mismatch = code_mismatch(original_code, annotated_code or '')
+        if mismatch:
+            logging.error(f"Annotated code for {file_name} differs from the original at line {mismatch[0]}; "
+                          f"splicing comments into the original instead")
+            annotated_code = self._annotate_with_anchors(file_name, original_code, doc_data.get('raw_doc'))
+        
+        # Write the file
+        with open(output_path, 'w') as f:
+            f.write(annotated_code)
+        self.trace.note(file=file_name, bytes=len(annotated_code.encode('utf-8')))
+        
+        annotated_line_count = len(annotated_code.split('\n'))
+        logging.info(f"Generated annotated code: {output_path} with {annotated_line_count} lines")
+        
+    # ------------------------------------------------------------------
+    #  Anchored annotation – the model writes comments, we place them
+    # ------------------------------------------------------------------
+    def _annotate_with_anchors(self, file_name, original_code, raw_doc=None):
+        """
+        Annotate a file by splicing in comment blocks per symbol.
+
+        Blocks already present in the analysis raw_doc are reused as-is; only
+        symbols it does not cover are requested from the model, and none are
+        when the generator is offline.
+        """
+        index = RubySymbolIndex(original_code)
+        comments = self._comments_from_raw_doc(index, raw_doc)
+        if comments:
+            logging.info(f"Reusing {len(comments)} analysis blocks for {file_name}")
+        if self.offline:
+            jobs = []
+            if len(comments) < len(index.symbols):
+                logging.info(f"Leaving {len(index.symbols) - len(comments)} symbols in {file_name} without new "
+                             f"comments (no model calls in --build-only)")
+        else:
+            jobs = self._anchor_jobs(file_name, original_code, index, skip=comments)
+
+        for i, (request, symbols) in enumerate(jobs):
+            logging.info(f"Requesting comments {i+1}/{len(jobs)} for {file_name} ({len(symbols)} anchors)")
+            try:
+                response, _, _ = self._routed_chat('annotation', file_name, request, self._request_code(request),
+                                                   accept=lambda text: self._answers_enough(text, symbols),
+                                                   checkpoint=file_name)
+            except Exception as e:
+                logging.error(f"Error requesting comments {i+1} for {file_name}: {e}")
+                continue
+            wanted = {symbol.start for symbol in symbols}
+            answers = self._parse_anchored_comments(response)
+            for line_no, block in self._render_anchored_blocks(index, answers).items():
+                if line_no in wanted:
+                    comments[line_no] = block
+                else:
+                    logging.warning(f"Ignoring comment block for unknown anchor L{line_no + 1} in {file_name}")
+
+        logging.info(f"Received comments for {len(comments)}/{len(index.symbols)} symbols in {file_name}")
+        return self._splice_comments(index, comments)
+
+    def _comments_from_raw_doc(self, index, raw_doc):
+        """Map analysis comment blocks back to symbol start lines by their declaration text"""
+        comments = {}
+        position = 0
+        for declaration, block in yard_entries(raw_doc):
+            if declaration is None:
+                continue
+            for i in range(position, len(index.symbols)):
+                symbol = index.symbols[i]
+                if index.lines[symbol.start].strip() == declaration:
+                    comments[symbol.start] = [line.strip() for line in block if line.strip()]
+                    position = i + 1
+                    break
+        return comments
+
+    def _parse_anchored_comments(self, response):
+        """Parse '@@ L<line>' blocks into {0-based line: [answer lines]}"""
+        blocks = {}
+        current = None
+        for line in (response or '').splitlines():
+            header = re.match(r'^\s*@@\s*L?(\d+)\b', line)
+            if header:
+                current = blocks.setdefault(int(header.group(1)) - 1, [])
+                continue
+            if current is None or line.strip().startswith('```'):
+                continue
+            current.append(line.rstrip())
+        for block in blocks.values():
+            while block and block[-1].strip() in ('', '#'):
+                block.pop()
+        return {line_no: block for line_no, block in blocks.items() if block}
+
+    # Comment lines that carry meaning for Ruby or tooling, kept when a block is replaced
+    _PROTECTED_COMMENT = re.compile(r'^\s*#\s*(?:!|-\*-|frozen_string_literal:|encoding:|coding:|rubocop:|typed:)')
+
+    def _splice_comments(self, index, comments):
+        """
+        Insert comment blocks above their symbols in one pass over the source.
+
+        Each new block replaces the comments directly above the symbol and is
+        indented like the declaration. Executable lines are copied verbatim.
+        """
+        replacements = {}                  # first replaced line -> (symbol start, new lines)
+        for symbol in index.symbols:
+            block = comments.get(symbol.start)
+            if not block:
+                continue
+            start = index.comment_start(symbol)
+            declaration = index.lines[symbol.start]
+            indent = declaration[:len(declaration) - len(declaration.lstrip())]
+            kept = [line for line in index.lines[start:symbol.start] if self._PROTECTED_COMMENT.match(line)]
+            replacements[start] = (symbol.start, kept + [indent + line for line in block])
+
+        out = []
+        i = 0
+        while i < len(index.lines):
+            if i in replacements:
+                symbol_start, new_lines = replacements[i]
+                out.extend(new_lines)
+                i = symbol_start
+            out.append(index.lines[i])
+            i += 1
+        return '\n'.join(out)
+
     def _process_small_file(self, file_name, original_code, documentation):
         """Process a small file normally"""
-        raw_doc = self._chat(
-          model="gpt-4o-mini",
-          max_tokens=4096,
-          temperature=0,
-          system_prompt="You are an expert code documentation specialist. Your task is to insert appropriate documentation comments into existing code.",
-          messages=[{
-                "role": "user",
-                "content": f"""
-Insert YARD-format comments into the Ruby code below.
+        request = self._small_file_request(original_code)
+        raw_doc, request, _ = self._routed_chat('annotation', file_name, request, original_code,
+                                                accept=self._code_preserved(original_code),
+                                                stop_at_fence=True, checkpoint=file_name)
+        
+        return self._validated_chunk(file_name, request, raw_doc, original_code, file_name)
 
-Original code:
-```
-{original_code}
-```
+    def _code_preserved(self, original):
+        """Validation for rewrite answers: the extracted code must match original"""
+        return lambda text: code_mismatch(original, self._extract_code_from_response(text or '')) is None
 
-Rules - apply to each method / class / module
-• Include these tags whenever they contain real information 
-• @param    - list every parameter
-• @return   - return type + meaning
-• @raise    - every possible exception
-• @example  - one concise code snippet, always include an example.
-• @note     - hidden caveat / side-effect
+    def _answers_enough(self, text, symbols):
+        """Validation for anchored answers: at least half of the requested symbols got a block"""
+        return len(self._parse_anchored_comments(text)) * 2 >= len(symbols)
 
-• Place every comment block **immediately above** the class / module / method
-  it documents (same indentation as the `def`, *never* inside the body).
-• Do NOT change, delete, reorder, or re-format any executable code.
-• Preserve original indentation and blank lines.
-• Wrap the entire annotated file in a single ```ruby block and output nothing else.
-ABSOLUTELY DO NOT delete, rename, reorder, or modify ANY existing code lines, even if they appear duplicated or redundant.
-"""
-            }]
-        )
-        
-        return self._extract_code_from_response(raw_doc)
+    @staticmethod
+    def _request_code(request):
+        """The ruby block a request's prompt documents, for sizing it"""
+        match = re.search(r'```ruby\n(.*?)\n```', request['messages'][-1]['content'], re.S)
+        return match.group(1) if match else ''
+
+    # Follow-up requests allowed per chunk whose code came back altered
+    REPAIR_ATTEMPTS = 2
+
+    def _validated_chunk(self, file_name, request, response, original, label):
+        """
+        Extract the annotated code from response, re-requesting it while its code differs from original.
+
+        Each retry points the model at the first altered line. A chunk that
+        still differs after REPAIR_ATTEMPTS is replaced by its original text,
+        so only that chunk loses its comments.
+        """
+        annotated = self._extract_code_from_response(response)
+        for attempt in range(self.REPAIR_ATTEMPTS):
+            mismatch = code_mismatch(original, annotated)
+            if mismatch is None:
+                return annotated
+            line_no, expected, found = mismatch
+            logging.warning(f"{label}: code changed at line {line_no} (expected `{expected[:80]}`, "
+                            f"got `{found[:80]}`); re-requesting ({attempt + 1}/{self.REPAIR_ATTEMPTS})")
+            request = self._repair_request(request, response, mismatch)
+            response = self._chat(**request, stop_at_fence=True, checkpoint=file_name)
+            annotated = self._extract_code_from_response(response)
+
+        if code_mismatch(original, annotated) is None:
+            return annotated
+        logging.error(f"{label}: code still altered after {self.REPAIR_ATTEMPTS} repairs; keeping it unannotated")
+        with self._doc_lock:
+            self.degraded_chunks += 1
+        return original
+
+    def _repair_request(self, request, response, mismatch):
+        """Continue a request's conversation, pointing out the first line whose code was changed"""
+        line_no, expected, found = mismatch
+        problem = (f"Line {line_no} of the code must read `{expected}` but your version has `{found}`."
+                   if expected and found else
+                   f"Line {line_no} of the code (`{expected}`) is missing from your version." if expected else
+                   f"Your version adds code that is not in the original: `{found}`.")
+        return {
+            **request,
+            'messages': request['messages'] + [
+                {"role": "assistant", "content": response},
+                {"role": "user", "content": f"{problem} Reply again with the complete annotated chunk in a "
+                                            f"single ```ruby block, changing nothing but comments."},
+            ],
+        }
         
     def _process_large_file(self, file_name, original_code, documentation):
         """Process a large file by breaking it into chunks and reassembling"""
@@ -420,114 +3302,117 @@ ABSOLUTELY DO NOT delete, rename, reorder, or modify ANY existing code lines, ev
         annotated_chunks = []
         
         for i, chunk in enumerate(code_chunks):
-            logging.info(f"Processing chunk {i+1}/{len(code_chunks)} of {file_name} ({len(chunk.split('\\n'))} lines)")
+            logging.info(f"Processing chunk {i+1}/{len(code_chunks)} of {file_name} "
+                         f"(lines {chunk.start + 1}-{chunk.end + 1})")
             
             try:
                 # Create a prompt focused on this chunk
-                raw_doc = self._chat(
-                    model="gpt-4o-mini",
-                    max_tokens=4096,
-                    temperature=0,
-                    system_prompt="You are an expert documentation specialist. Your task is to insert appropriate documentation comments into existing code.",
-                    messages=[{
-                        "role": "user",
-                        "content": f"""
-I have a chunk of a larger Ruby file and documentation for the entire file.
-Your task is to identify which parts of the documentation apply to this code chunk
-and insert those comments at the appropriate places.
-
-Code chunk {i+1}/{len(code_chunks)}:
-```ruby
-{chunk}
-```
-
-Rules - apply to each method / class / module
-• Include these tags whenever they contain real information 
-• @param    - list every parameter
-• @return   - return type + meaning
-• @raise    - every possible exception
-• @example  - one concise code snippet, always include an example.
-• @note     - hidden caveat / side-effect.
-
-• Place every comment block **immediately above** the class / module / method
-  it documents (same indentation as the `def`, *never* inside the body).
-• Do NOT change, delete, reorder, or re-format any executable code.
-• Preserve original indentation and blank lines.
-• Wrap the entire annotated file in a single ```ruby block and output nothing else.
-ABSOLUTELY DO NOT delete, rename, reorder, or modify ANY existing code lines, even if they appear duplicated or redundant.
-"""
-                    }]
-                )
+                request = self._chunk_request(chunk, i, len(code_chunks))
+                raw_doc, request, _ = self._routed_chat('annotation', file_name, request, chunk.text,
+                                                        accept=self._code_preserved(chunk.text),
+                                                        stop_at_fence=True, checkpoint=file_name)
                 
-                annotated_chunk = self._extract_code_from_response(raw_doc)
+                annotated_chunk = self._validated_chunk(file_name, request, raw_doc, chunk.text,
+                                                        f"{file_name} chunk {i+1}/{len(code_chunks)}")
                 logging.info(f"Successfully processed chunk {i+1}/{len(code_chunks)}")
                 annotated_chunks.append(annotated_chunk)
             except Exception as e:
-                logging.error(f"Error processing chunk {i+1}: {e}")
+                logging.error(f"Error processing chunk {i+1} of {file_name} after retries: {e}")
                 # In case of error, include the original chunk to avoid data loss
-                annotated_chunks.append(chunk)
+                with self._doc_lock:
+                    self.degraded_chunks += 1
+                annotated_chunks.append(chunk.text)
         
-        # Combine the annotated chunks
-        full_annotated_code = '\n\n'.join(annotated_chunks)
+        # Chunks are contiguous line ranges, so a plain newline restores the file
+        full_annotated_code = '\n'.join(annotated_chunks)
         logging.info(f"Completed annotating all {len(code_chunks)} chunks with total length {len(full_annotated_code)}")
         return full_annotated_code
     
     # ------------------------------------------------------------------
-    #  Very robust Ruby chunker – splits only *between* top‑level methods
+    #  Token-budgeted Ruby chunker – packs whole methods / classes
     # ------------------------------------------------------------------
-    def _split_code_into_chunks(self, code: str, chunk_size: int = 200):
+    @traced('split_chunks')
+    def _split_code_into_chunks(self, code: str, max_tokens: int = None):
         """
-        Split Ruby *code* into chunks that never break a method in half.
+        Split Ruby *code* into CodeChunks of at most *max_tokens* model tokens.
 
         Strategy
         --------
-        1. Scan line‑by‑line.
-        2. When we hit a *top‑level* `def`, remember its line number.
-        3. If the current chunk length >= chunk_size **and**
-        we’re *at* a top‑level `def` (not the first),
-        cut the chunk *before* that `def`.
-        4. At EOF emit whatever is left.
-
-        This deliberately ignores `end` – so nested `if … end` blocks can’t
-        confuse the counter.
+        1. Index the file once with RubySymbolIndex to find every
+           class / module / def and where each construct opens and closes.
+        2. Turn the file into atoms: a def (with the comments directly above
+           it) is always one atom; a class or module is one atom when it fits
+           the budget, otherwise it is opened up and its members become atoms.
+           Loose code between members is cut only where no block is open.
+        3. Greedily pack consecutive atoms into chunks up to the budget.
+
+        A single def larger than the budget becomes a chunk of its own rather
+        than being cut in half. Every chunk records the class/module chain it
+        sits in so the prompt can name the scope without resending it.
         """
-        lines          = code.splitlines()
-        chunks         = []
-        current_chunk  = []
-        current_length = 0
-        pending_comments = []
-
-        # Regex for *top‑level* method: starts with optional spaces then 'def'
-        re_toplevel_def = re.compile(r'^\s*def\b')
+        budget = max_tokens or self.chunk_tokens
+        index = RubySymbolIndex(code)
+        lines, line_depths, children = index.lines, index.line_depths, index.children
+        if not lines:
+            return [CodeChunk(code, 0, 0, '')]
 
+        prefix = [0]
         for line in lines:
-            if re_toplevel_def.match(line):
-                lookback = len(current_chunk) - 1
-                while lookback >= 0 and current_chunk[lookback].lstrip().startswith('#'):
-                    lookback -= 1
-                pending_comments = current_chunk[lookback + 1 :]
-                current_chunk = current_chunk[: lookback + 1]
-                current_length = len(current_chunk)
-                
-            # Should we start a new chunk *before* this line?
-            if (
-                re_toplevel_def.match(line)          # we’re at a new method
-                and current_length >= chunk_size     # current chunk is “full”
-            ):
-                chunks.append('\n'.join(current_chunk).rstrip('\n'))
-                current_chunk = pending_comments + [line]
-                current_length = len(current_chunk)
-                pending_comments = []
+            prefix.append(prefix[-1] + self._count_tokens(line + '\n'))
+
+        def cost(a, b):
+            return prefix[b] - prefix[a]
+
+        atoms = []  # half-open line ranges
+
+        def split_loose(a, b, depth):
+            if cost(a, b) <= budget:
+                atoms.append((a, b))
+                return
+            piece_start, last_safe = a, None
+            for i in range(a + 1, b):
+                if line_depths[i] <= depth:
+                    last_safe = i
+                if cost(piece_start, i + 1) > budget and last_safe and last_safe > piece_start:
+                    atoms.append((piece_start, last_safe))
+                    piece_start = last_safe
+            atoms.append((piece_start, b))
+
+        def add_members(a, b, members, depth):
+            cursor = a
+            for member in members:
+                start = index.comment_start(member, floor=cursor)
+                if start > cursor:
+                    split_loose(cursor, start, depth)
+                end = member.end + 1
+                if cost(start, end) <= budget or member.kind == 'def' or not children[member]:
+                    atoms.append((start, end))
+                else:
+                    add_members(start, end, children[member], line_depths[member.start] + 1)
+                cursor = end
+            if cursor < b:
+                split_loose(cursor, b, depth)
+
+        add_members(0, len(lines), children[None], 0)
+
+        chunks = []
+        current = None
+        for a, b in atoms:
+            blank = not any(lines[i].strip() for i in range(a, b))
+            if current and (blank or cost(current[0], b) <= budget):
+                current[1] = b
                 continue
-
-            current_chunk.append(line)
-            current_length += 1
-
-        # flush the tail
-        if current_chunk:
-            chunks.append('\n'.join(current_chunk).rstrip('\n'))
-
-        return chunks or [code]
+            if current:
+                chunks.append(current)
+            current = [a, b]
+        if current:
+            chunks.append(current)
+        self.trace.note(lines=len(lines), tokens=prefix[-1], chunks=len(chunks))
+
+        return [
+            CodeChunk('\n'.join(lines[a:b]), a, b - 1, index.scope_of(a))
+            for a, b in chunks
+        ]
 
     def _extract_code_from_response(self, response):
         """Extract clean code from an LLM response"""
@@ -556,69 +3441,390 @@ ABSOLUTELY DO NOT delete, rename, reorder, or modify ANY existing code lines, ev
         return '\n'.join(clean_lines).strip()
 
     # ------------------------------------------------------------------
-    #   Verify that all original top‑level defs are still present
-    #   If any are missing, splice them back in.
+    #   Verify that all original defs are still present.
+    #   If any are missing, splice them back in where they belong.
     # ------------------------------------------------------------------
     def _restore_missing_defs(self, original: str, annotated: str) -> str:
-        def_names = re.findall(r'^\s*def\s+([A-Za-z0-9_\.!?]+)', original, re.M)
-        out = annotated.splitlines()
-
-        for name in def_names:
-            pattern = rf'^\s*def\s+{re.escape(name)}\b'
-            if not re.search(pattern, annotated, re.M):
-                # grab the entire original def … end block
-                block_re = re.compile(rf'^\s*def\s+{re.escape(name)}\b.*?^\s*end\b',
-                                    re.M | re.S)
-                block = re.search(block_re, original)
-                if block:
-                    out.append("\n\n" + block.group(0))  # append at end
+        """
+        Re-insert defs the model dropped, at their original position.
+
+        Both texts are indexed once. Original defs are matched to annotated
+        defs by name, in order; each unmatched def is copied (with its comment
+        block) after the annotated copy of the closest preceding matched def,
+        or before the closest following one. Defs nested inside a dropped def
+        travel with it. Runs in time linear in the size of both files.
+        """
+        original_index = RubySymbolIndex(original)
+        annotated_index = RubySymbolIndex(annotated)
+
+        available = {}
+        for symbol in annotated_index.defs():
+            available.setdefault(symbol.name, []).append(symbol)
+        for occurrences in available.values():
+            occurrences.reverse()          # pop() hands them out in source order
+
+        original_defs = original_index.defs()
+        matches = []                       # annotated def for each original def, or None
+        missing = set()
+        for symbol in original_defs:
+            occurrences = available.get(symbol.name)
+            match = occurrences.pop() if occurrences else None
+            matches.append(match)
+            if match is None:
+                missing.add(symbol)
+
+        if not missing:
+            return annotated
+
+        insert_after = {}                  # annotated line -> lines to add after it
+        insert_before = {}
+        appended = []
+        previous_match = None
+        pending = []                       # dropped defs waiting for a following match
+        for symbol, match in zip(original_defs, matches):
+            if match is not None:
+                if pending:
+                    at = annotated_index.comment_start(match)
+                    insert_before.setdefault(at, []).extend(pending)
+                    pending = []
+                previous_match = match
+                continue
 
+            owner = original_index.parent[symbol]
+            if owner in missing:
+                continue                   # restored as part of its enclosing def
+            logging.warning(f"Restoring dropped method '{symbol.name}' at its original position")
+            block = [''] + original_index.source(symbol)
+            if previous_match is not None:
+                insert_after.setdefault(previous_match.end, []).extend(block)
+            else:
+                pending.extend(block)
+        appended.extend(pending)
+
+        out = []
+        for i, line in enumerate(annotated_index.lines):
+            if i in insert_before:
+                out.extend(insert_before[i][1:] + [''])
+            out.append(line)
+            if i in insert_after:
+                out.extend(insert_after[i])
+        out.extend(appended)
         return "\n".join(out)
 
     def _generate_markdown_docs(self):
-        """Generate Markdown documentation files"""
-        md_dir = self.output_dir / 'markdown'
-        md_dir.mkdir(exist_ok=True)
+        """Generate Markdown documentation files, rendered locally from the YARD text"""
+        return self.generate_documentation('markdown')
+
+    @traced('write_markdown')
+    def _write_markdown_file(self, md_dir, file_name, doc_data):
+        """Write one file's Markdown documentation"""
+        output_path = md_dir / f"{file_name}.md"
+        markdown = self._render_markdown(file_name, doc_data['raw_doc'])
         
-        # Generate individual MD files
-        for file_name, doc_data in self.documentation.items():
-            output_path = md_dir / f"{file_name}.md"
-            
-            raw_doc = self._chat(
-                model="gpt-4o-mini",
-                max_tokens=4096,
-                temperature=0,
-                system_prompt="You are a technical writer who creates clear, well-organized API documentation.",
-                messages=[{
-                    "role": "user",
-                    "content": f"""
-Convert the following raw API documentation into clean, well-formatted Markdown:
-
-{doc_data['raw_doc']}
-
-Format it as a proper Markdown document with:
-1. Clear headings and structure
-2. Code blocks with syntax highlighting 
-3. Tables for parameters and return values where appropriate
-4. Consistent formatting throughout
-"""
-                }]
-            )
-            
-            with open(output_path, 'w') as f:
-                f.write(raw_doc)
-            
-            logging.info(f"Generated Markdown documentation: {output_path}")
+        with open(output_path, 'w') as f:
+            f.write(markdown)
+        self.trace.note(file=file_name, bytes=len(markdown.encode('utf-8')))
         
-        # Generate index file
+        logging.info(f"Generated Markdown documentation: {output_path}")
+
+    def _write_markdown_index(self, md_dir, file_names):
+        """Generate index file"""
         index_path = md_dir / "index.md"
         with open(index_path, 'w') as f:
             f.write("# Lich5 API Documentation\n\n")
             f.write("## Files\n\n")
-            for file_name in sorted(self.documentation.keys()):
+            for file_name in sorted(set(file_names)):
                 f.write(f"* [{file_name}]({file_name}.md)\n")
-        
-        return md_dir
+
+    # ------------------------------------------------------------------
+    #  HTML site – class/module pages re-rendered only when their content changes
+    # ------------------------------------------------------------------
+    def _load_html_state(self, html_dir):
+        with self._doc_lock:
+            if self._html_state is None:
+                try:
+                    with open(html_dir / '.state.json', 'r', encoding='utf-8') as f:
+                        self._html_state = json.load(f)
+                except (OSError, ValueError):
+                    self._html_state = {'files': {}, 'pages': {}}
+            return self._html_state
+
+    def _write_html_file(self, html_dir, file_name, doc_data):
+        """Extract one file's page items; the pages themselves are written by _write_html_site"""
+        state = self._load_html_state(html_dir)
+        digest = self._record_digest(doc_data)
+        with self._doc_lock:
+            if state['files'].get(file_name, {}).get('digest') == digest:
+                return
+        items = self._html_items(file_name, doc_data)
+        with self._doc_lock:
+            state['files'][file_name] = {'digest': digest, 'items': items}
+
+    def _html_items(self, file_name, doc_data):
+        """(namespace, item) pairs for every class, module and def of one file"""
+        code = doc_data.get('original_code', '')
+        index = RubySymbolIndex(code)
+        comments = self._comments_from_raw_doc(index, doc_data.get('raw_doc', ''))
+        items = []
+        for symbol in index.symbols:
+            if symbol.kind != 'def' and symbol.name.startswith('<<'):
+                continue  # `class << self` has no page; its defs are class methods of the outer namespace
+            if symbol.kind == 'def' and index.parent[symbol] is not None and index.parent[symbol].kind == 'def':
+                continue  # defs nested inside defs are not part of the API
+            namespace, name = index.qualified_name(symbol)
+            lines = strip_comment_markers(comments.get(symbol.start, []))
+            items.append([namespace, [symbol.kind, name, index.lines[symbol.start].strip(), lines,
+                                      file_name, symbol.start + 1]])
+        return items
+
+    def _write_html_site(self, html_dir):
+        """
+        Write the pages whose content changed since the last build, then the index.
+
+        The site covers every file in the documentation store, not just the
+        files of this run, so a --file, --since or --resume refresh keeps the
+        other pages. Each page's hash covers the items it is built from, so
+        editing one file re-renders only the namespaces that file contributes
+        to. Large rebuilds are rendered in a process pool.
+        """
+        state = self._load_html_state(html_dir)
+        stored = set(self._stored_file_names())
+        with self._doc_lock:
+            unseen = stored - set(state['files'])
+        if unseen:
+            # Stored files this directory has no pages for yet (e.g. html added on --resume)
+            for file_name, doc_data in self._read_documentation():
+                if file_name in unseen:
+                    self._write_html_file(html_dir, file_name, doc_data)
+        with self._doc_lock:
+            for stale in [name for name in state['files'] if name not in stored]:
+                del state['files'][stale]
+            pages = {}
+            for file_name in sorted(state['files']):
+                for namespace, item in state['files'][file_name]['items']:
+                    pages.setdefault(namespace, []).append(item)
+
+        hashes = {
+            namespace: hashlib.sha256(json.dumps(items).encode('utf-8')).hexdigest()
+            for namespace, items in pages.items()
+        }
+        changed = [
+            namespace for namespace in pages
+            if state['pages'].get(html_page_path(namespace)) != hashes[namespace]
+            or not (html_dir / html_page_path(namespace)).exists()
+        ]
+        jobs = [(namespace, pages[namespace]) for namespace in changed]
+        if len(jobs) >= 16:
+            with ProcessPoolExecutor() as pool:
+                rendered = list(pool.map(_render_html_job, jobs, chunksize=8))
+        else:
+            rendered = [_render_html_job(job) for job in jobs]
+        for path, text in rendered:
+            (html_dir / path).parent.mkdir(parents=True, exist_ok=True)
+            (html_dir / path).write_text(text, encoding='utf-8')
+
+        current = {html_page_path(namespace): hashes[namespace] for namespace in pages}
+        for path in set(state['pages']) - set(current):
+            (html_dir / path).unlink(missing_ok=True)
+        if set(current) != set(state['pages']) or not (html_dir / 'index.html').exists():
+            (html_dir / 'index.html').write_text(render_html_index(pages), encoding='utf-8')
+
+        with self._doc_lock:
+            state['pages'] = current
+            text = json.dumps(state)
+        self._write_atomic(html_dir / '.state.json', text)
+        logging.info(f"Rendered {len(rendered)} of {len(pages)} HTML pages ({len(pages) - len(rendered)} unchanged)")
+
+    def _render_markdown(self, file_name, raw_doc):
+        """
+        Render one file's YARD text as Markdown without calling the model.
+
+        Classes and modules become ``##`` sections and methods ``###``
+        sections; @param/@return/@raise become tables, @example becomes a
+        ruby code block and @note a quote.
+        """
+        def cell(text):
+            return (text or '').replace('|', '\\|').strip()
+
+        def type_cell(types):
+            return f"`{cell(types[1:-1])}`" if types else ''
+
+        out = [f"# {file_name}", ""]
+        for declaration, block in yard_entries(raw_doc):
+            summary, tags = parse_yard_tags(strip_comment_markers(block))
+            if declaration:
+                level = '###' if declaration.startswith('def ') else '##'
+                out += [f"{level} `{declaration}`", ""]
+
+            summary_text = '\n'.join(summary).strip()
+            if summary_text:
+                out += [summary_text, ""]
+
+            by_tag = {}
+            for tag in tags:
+                by_tag.setdefault(tag.tag, []).append(tag)
+
+            if by_tag.get('param'):
+                out += ["**Parameters**", "", "| Name | Type | Description |", "|------|------|-------------|"]
+                out += [f"| `{cell(t.name)}` | {type_cell(t.types)} | {cell(t.text)} |" for t in by_tag['param']]
+                out.append("")
+            if by_tag.get('option'):
+                out += ["**Options**", "", "| Hash | Type | Description |", "|------|------|-------------|"]
+                out += [f"| `{cell(t.name)}` | {type_cell(t.types)} | {cell(t.text)} |" for t in by_tag['option']]
+                out.append("")
+            if by_tag.get('return'):
+                out += ["**Returns**", "", "| Type | Description |", "|------|-------------|"]
+                out += [f"| {type_cell(t.types)} | {cell(t.text)} |" for t in by_tag['return']]
+                out.append("")
+            if by_tag.get('raise'):
+                out += ["**Raises**", "", "| Exception | When |", "|-----------|------|"]
+                out += [f"| {type_cell(t.types)} | {cell(t.text)} |" for t in by_tag['raise']]
+                out.append("")
+            for t in by_tag.get('example', []):
+                body = [line[2:] if line.startswith('  ') else line for line in t.body]
+                out += [f"**Example{': ' + t.text if t.text else ''}**", "", "```ruby", *body, "```", ""]
+            for t in by_tag.get('note', []):
+                out += [f"> **Note:** {t.text}", ""]
+            for tag_name, group in by_tag.items():
+                if tag_name in ('param', 'option', 'return', 'raise', 'example', 'note'):
+                    continue
+                for t in group:
+                    out.append(f"- **@{tag_name}** {' '.join(x for x in (t.name, t.types, t.text) if x)}")
+                out.append("")
+
+        return '\n'.join(out).rstrip() + '\n'
+
+# ----------------------------------------------------------------------
+#  Resident --chunk server
+# ----------------------------------------------------------------------
+class ChunkServer:
+    """
+    Serve --chunk requests from one warm generator over a Unix socket.
+
+    The generator, its HTTP connection pool, output directory and caches are
+    built once, so a request costs one model call (or none when repeated).
+    Requests and replies are one JSON line each:
+
+        {"code": "...", "file": "name.rb"}  ->  {"doc": "...", "cached": false, "seconds": 1.2}
+        {"op": "stats"}                     ->  {"requests": 3, "memory_hits": 1, ...}
+
+    Args:
+        generator: Lich5DocumentationGenerator that answers every request
+        path: Socket path (a stale socket file left by a dead server is replaced)
+        memory_entries: Answers kept in the in-memory LRU cache
+    """
+
+    def __init__(self, generator, path=DEFAULT_CHUNK_SOCKET, memory_entries=256):
+        self.generator = generator
+        self.path = Path(path)
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.memory_hits = 0
+        self.errors = 0
+        self.started = time.time()
+        self._server = None
+
+    def answer(self, request):
+        """Reply to one decoded request"""
+        if request.get('op') == 'stats':
+            with self._lock:
+                return {'requests': self.requests, 'memory_hits': self.memory_hits, 'errors': self.errors,
+                        'memory_entries': len(self._memory), 'uptime': round(time.time() - self.started, 1)}
+        code = request.get('code')
+        if not code:
+            return {'error': 'no code in request'}
+
+        started = time.perf_counter()
+        # Name chunks by content so the documentation store keeps one record per snippet
+        key = hashlib.sha256(code.encode('utf-8')).hexdigest()
+        file_name = request.get('file') or f"chunk_{key[:12]}.rb"
+        with self._lock:
+            self.requests += 1
+            doc = self._memory.get((file_name, key))
+            if doc is not None:
+                self._memory.move_to_end((file_name, key))
+                self.memory_hits += 1
+        if doc is None:
+            doc = self.generator.process_chunk(code, file_name=file_name)
+            if doc is None:
+                with self._lock:
+                    self.errors += 1
+                return {'error': f"analysis of {file_name} failed; see the server log"}
+            with self._lock:
+                self._memory[(file_name, key)] = doc
+                while len(self._memory) > self.memory_entries:
+                    self._memory.popitem(last=False)
+            cached = False
+        else:
+            cached = True
+        return {'doc': doc, 'file': file_name, 'cached': cached,
+                'seconds': round(time.perf_counter() - started, 4)}
+
+    def _replace_stale_socket(self):
+        if not self.path.exists():
+            return
+        import socket
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(self.path))
+        except OSError:
+            self.path.unlink()        # nobody is listening
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(f"A server is already listening on {self.path}")
+
+    def shutdown(self):
+        """Stop serve_forever from another thread"""
+        if self._server is not None:
+            self._server.shutdown()
+
+    def serve_forever(self):
+        """Listen until interrupted or shut down; the socket file is removed on exit"""
+        if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+            raise RuntimeError("--serve needs Unix domain sockets, which this platform does not support")
+        self._replace_stale_socket()
+        chunk_server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        reply = chunk_server.answer(json.loads(line))
+                    except ValueError as e:
+                        reply = {'error': f"bad request: {e}"}
+                    except Exception as e:
+                        logging.error(f"Chunk request failed: {e}", exc_info=True)
+                        reply = {'error': str(e)}
+                    self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+
+        import signal
+        server = self._server = socketserver.ThreadingUnixStreamServer(str(self.path), Handler)
+        server.daemon_threads = True
+        previous_handler = None
+        try:
+            os.chmod(self.path, 0o600)
+            if threading.current_thread() is threading.main_thread():
+                # Stop cleanly on SIGTERM too (shutdown() must not run on the serving thread);
+                # only the main thread may install handlers, so an embedded server skips this
+                previous_handler = signal.signal(
+                    signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+            logging.info(f"Serving --chunk requests on {self.path} (Ctrl+C to stop)")
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if previous_handler is not None:
+                signal.signal(signal.SIGTERM, previous_handler)
+            server.server_close()
+            self.path.unlink(missing_ok=True)
+            logging.info(f"Served {self.requests} requests ({self.memory_hits} from memory, {self.errors} failed)")
+
 
 def main():
     import argparse
@@ -627,25 +3833,127 @@ def main():
     parser.add_argument('--file', help='Single file to document', default=None)
     parser.add_argument('--dir', help='Directory of files to document', default=None)
     parser.add_argument('--chunk', help='Document a code chunk from stdin', action='store_true')
-    parser.add_argument('--format', help='Output format (yard, markdown, or annotated)', default='yard')
-    parser.add_argument('--build-only', help='Skip analysis; rebuild docs from existing raw_documentation.json', action='store_true')
-    parser.add_argument('--cache-dir', help='Directory containing raw_documentation.json from a previous run', default=None)
+    parser.add_argument('--format', help='Output format(s): yard, markdown, annotated, html, a comma-separated list, or all',
+                        default='yard')
+    parser.add_argument('--build-only', help='Skip analysis; rebuild docs from --cache-dir (default: the latest run)', action='store_true')
+    parser.add_argument('--cache-dir', help='Directory containing raw_documentation.jsonl (or legacy .json) from a previous run', default=None)
+    parser.add_argument('--concurrency', help='Number of files to analyze in parallel', type=int, default=1)
+    parser.add_argument('--no-cache', help='Disable the analysis and response caches', action='store_true')
+    parser.add_argument('--chunk-tokens', help='Token budget per chunk when annotating large files', type=int, default=2500)
+    parser.add_argument('--batch', help='Send all prompts as one offline Batch API job', action='store_true')
+    parser.add_argument('--batch-id', help='Resume waiting on a previously submitted batch', default=None)
+    parser.add_argument('--batch-poll', help='Seconds between batch status checks', type=float, default=60)
+    parser.add_argument('--base-url', help='OpenAI-compatible endpoint to use instead of the default', default=None)
+    parser.add_argument('--backend', help='Model backend: openai (default), anthropic (default routes use Claude '
+                                          'models), local (OpenAI-compatible server, see --base-url) or replay '
+                                          '(answers from --fixture, no network)',
+                        choices=sorted(MODEL_BACKENDS) + ['replay'], default='openai')
+    parser.add_argument('--fixture', help='Recorded answers for --backend replay', default=None, metavar='FILE')
+    parser.add_argument('--record', help='Append every model answer to FILE for later --backend replay',
+                        default=None, metavar='FILE')
+    parser.add_argument('--annotate-mode', help='anchored: model returns comment blocks only (default); '
+                                                'rewrite: model re-emits the whole annotated source',
+                        choices=['anchored', 'rewrite'], default='anchored')
+    parser.add_argument('--stream', help='Stream completions and report time-to-first-token and tokens/sec',
+                        action='store_true')
+    parser.add_argument('--profile', help='Record per-call timings and write a Chrome trace '
+                                          '(default: trace.json in the output directory)',
+                        nargs='?', const='', default=None, metavar='PATH')
+    parser.add_argument('--max-retries', help='Retries for rate-limited or failed model calls', type=int, default=6)
+    parser.add_argument('--resume', help='Continue an interrupted run in this output directory, skipping '
+                                         'files and chunks it already finished', default=None, metavar='DIR')
+    parser.add_argument('--since', help='Only process files changed since this git revision '
+                                        '(use with --resume to refresh an existing output directory)',
+                        default=None, metavar='REV')
+    parser.add_argument('--routing', help='JSON file overriding the model routes per task and file size',
+                        default=None, metavar='FILE')
+    parser.add_argument('--skip-documented', help='Keep complete, current YARD comments from the source '
+                                                  'and send only under-documented symbols to the model',
+                        action='store_true')
+    parser.add_argument('--coverage', help='Report YARD coverage per module of DIR (default: src/lib) and exit',
+                        nargs='?', const=str(Path(__file__).parent.parent / 'src' / 'lib'), default=None,
+                        metavar='DIR')
+    parser.add_argument('--coverage-details', help='With --coverage, also list every incomplete symbol '
+                                                   '(file:line, name, missing and stale tags)',
+                        action='store_true')
+    parser.add_argument('--serve', help='Run a resident --chunk server on a Unix socket (see chunk_client.py)',
+                        action='store_true')
+    parser.add_argument('--socket', help='Socket path for --serve', default=str(DEFAULT_CHUNK_SOCKET))
+    parser.add_argument('--response-cache-mb', help='Size limit of the response cache in MB', type=float, default=512)
+    parser.add_argument('--response-cache-days', help='Expire cached responses after this many days', type=float, default=30)
     
     args = parser.parse_args()
 
-    generator = Lich5DocumentationGenerator(input_file=args.file, input_dir=args.dir)
+    unsupported = [fmt for fmt in parse_output_formats(args.format) if fmt not in OUTPUT_FORMATS]
+    if unsupported:
+        parser.error(f"unsupported --format value(s): {', '.join(unsupported)}")
+
+    if args.coverage:
+        # Local scan only; no output directory or model client needed
+        started = time.perf_counter()
+        if args.coverage_details:
+            modules, gaps = scan_coverage(args.coverage, details=True)
+            print(format_coverage_details(gaps))
+            print()
+        else:
+            modules = scan_coverage(args.coverage)
+        print(format_coverage_report(modules))
+        logging.info(f"Scanned {args.coverage} in {time.perf_counter() - started:.2f}s")
+        return
+
+    if args.backend == 'replay' and not args.fixture:
+        parser.error("--backend replay needs --fixture FILE")
+
+    store_names = ('raw_documentation.jsonl', 'raw_documentation.json')
+    if args.build_only and not args.cache_dir:
+        # Rebuild the latest run instead of creating a new, empty one
+        runs = [path for path in sorted((Path(__file__).parent / 'documentation').glob('*'))
+                if any((path / name).exists() for name in store_names)]
+        if not runs:
+            parser.error("--build-only needs --cache-dir DIR; no previous run was found under documentation/")
+        args.cache_dir = str(runs[-1])
+        logging.info(f"Rebuilding the latest run: {args.cache_dir}")
 
+    store = None
     if args.cache_dir:
         cache = Path(args.cache_dir)
-        if not cache.exists() or not (cache / 'raw_documentation.json').exists():
-            logging.error(f"Cache directory {cache} does not contain raw_documentation.json")
+        store = next((cache / name for name in store_names if (cache / name).exists()), None)
+        if store is None:
+            logging.error(f"Cache directory {cache} does not contain raw_documentation.jsonl")
             return
-        generator.output_dir    = cache
-        generator.raw_docs_path = cache / 'raw_documentation.json'
+
+    generator = Lich5DocumentationGenerator(input_file=args.file, input_dir=args.dir,
+                                            concurrency=args.concurrency,
+                                            use_cache=not args.no_cache,
+                                            response_cache_mb=args.response_cache_mb,
+                                            response_cache_days=args.response_cache_days,
+                                            chunk_tokens=args.chunk_tokens,
+                                            base_url=args.base_url,
+                                            annotate_mode=args.annotate_mode,
+                                            output_formats=args.format if (args.file or args.dir) else None,
+                                            stream=args.stream,
+                                            profile=args.profile is not None,
+                                            max_retries=args.max_retries,
+                                            resume=args.resume,
+                                            since=args.since,
+                                            router=ModelRouter.from_file(args.routing) if args.routing else None,
+                                            skip_documented=args.skip_documented,
+                                            backend=make_backend(args.backend, base_url=args.base_url,
+                                                                 http_keepalive=300 if args.serve else None,
+                                                                 fixture=args.fixture, record=args.record),
+                                            output_dir=args.cache_dir)
+    if store is not None:
+        generator.raw_docs_path = store
+
+    if args.serve:
+        ChunkServer(generator, args.socket).serve_forever()
+        return
 
     if args.build_only:
         # Rebuild documentation files from existing cache
-        output_dir = generator.generate_documentation(args.format)
+        # Offline: annotated files get only stored blocks, so no backend is ever loaded
+        output_dir = generator.generate_documentation(args.format, offline=True)
+        generator.export_trace(args.profile or None)
         logging.info(f"Documentation rebuilt from cache at: {output_dir}")
         return
     
@@ -653,19 +3961,25 @@ def main():
         import sys
         print("Enter or paste code chunk (Ctrl+D to finish on Unix, Ctrl+Z followed by Enter on Windows):")
         chunk_content = sys.stdin.read()
-        generator = Lich5DocumentationGenerator()
         doc = generator.process_chunk(chunk_content)
         print("\nGenerated Documentation:")
         print(doc)
     
     elif args.file or args.dir:
         
-        if args.file:
+        if args.batch or args.batch_id:
+            generator.process_batch(args.format, batch_id=args.batch_id, poll_interval=args.batch_poll)
+        elif args.file:
             generator.process_file()
         elif args.dir:
             generator.process_directory()
             
-        output_dir = generator.generate_documentation(args.format)
+        # Every format was written per file as analysis finished
+        output_dir = generator.finish_documentation()
+        generator.log_cache_stats()
+        generator.log_stream_stats()
+        generator.log_routing_stats()
+        generator.export_trace(args.profile or None)
         logging.info(f"Documentation generated in: {output_dir}")
     
     else:
@@ -0,0 +1,306 @@
+"""
+Focused tests for the Ruby lexer, the signature parser, the code comparison,
+the analysis caches and the --serve chunk server in guide.py.
+
+    python -m pytest project-guide/test_guide.py
+"""
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import chunk_client
+from benchmark import FakeOpenAIServer
+from guide import (ChunkServer, Lich5DocumentationGenerator, ModelBackend, ResponseCache, RubyParam,
+                   RubySymbolIndex, code_mismatch, parse_ruby_params, scan_ruby_blocks)
+
+
+def blocks(code):
+    """(kind, name, start, end) of every class/module/def, 0-based lines"""
+    return [(b.kind, b.name, b.start, b.end) for b in scan_ruby_blocks(code)[0]]
+
+
+# ----------------------------------------------------------------------
+#  scan_ruby_blocks / _scan_ruby_line
+# ----------------------------------------------------------------------
+def test_heredoc_bodies_are_not_code():
+    code = '''module M
+  SQL = <<~SQL
+    def not_a_method
+    end
+  SQL
+  def a
+    x = <<-EOS.strip + <<B
+  end
+    EOS
+class Nope
+B
+    x
+  end
+end
+'''
+    assert blocks(code) == [('module', 'M', 0, 13), ('def', 'a', 5, 12)]
+
+
+def test_percent_literals_hide_keywords():
+    code = '''class C
+  WORDS = %w[end def class]
+  Q = %q{ def x; end }
+  R = %r{\\bend\\b}
+  L = %w(
+    end
+  )
+  def b; end
+end
+'''
+    assert blocks(code) == [('class', 'C', 0, 8), ('def', 'b', 7, 7)]
+
+
+def test_strings_regexps_and_embedded_docs_hide_keywords():
+    code = '''=begin
+def hidden
+end
+=end
+def s
+  "#{ 'end' } def" + 'end' + /end/.source
+end
+'''
+    assert blocks(code) == [('def', 's', 4, 6)]
+
+
+def test_modifier_keywords_do_not_open_blocks():
+    code = '''def a(x)
+  return nil unless x
+  y = 1 if x
+  z = if x then 1 else 2 end
+  w = if x
+    1
+  end
+  y += 1 while y < 3
+  while y < 5 do
+    y += 1
+  end
+  [1].each do |i|
+    i
+  end
+end
+def b
+end
+'''
+    found, depths = scan_ruby_blocks(code)
+    assert [(b.name, b.start, b.end) for b in found] == [('a', 0, 14), ('b', 15, 16)]
+    assert depths[:10] == [0, 1, 1, 1, 1, 2, 2, 1, 1, 2]
+
+
+def test_endless_defs_do_not_open_blocks():
+    code = '''class C
+  def square(x) = x * x
+  def name = @name
+  def ok? = true
+  def <=>(other) = id <=> other.id
+  def c
+    1
+  end
+end
+'''
+    assert blocks(code) == [('class', 'C', 0, 8), ('def', 'c', 5, 7)]
+
+
+def test_setter_and_operator_defs_are_not_endless():
+    code = '''class C
+  def name=(value)
+    @name = value
+  end
+  def []=(key, value)
+    @h[key] = value
+  end
+  def ==(other)
+    id == other.id
+  end
+  def C.auto=(_val); return @auto = _val; end
+end
+'''
+    assert blocks(code) == [('class', 'C', 0, 11), ('def', 'name=', 1, 3), ('def', '[]=', 4, 6),
+                            ('def', '==', 7, 9), ('def', 'C.auto=', 10, 10)]
+
+
+def test_class_self_defs_are_class_methods():
+    code = '''module M
+  class C
+    class << self
+      def make; end
+    end
+    def self.b; end
+    def c; end
+  end
+end
+'''
+    assert blocks(code) == [('module', 'M', 0, 8), ('class', 'C', 1, 7), ('class', '<< self', 2, 4),
+                            ('def', 'make', 3, 3), ('def', 'self.b', 5, 5), ('def', 'c', 6, 6)]
+    index = RubySymbolIndex(code)
+    assert [index.qualified_name(symbol) for symbol in index.defs()] == \
+        [('M::C', '.make'), ('M::C', '.b'), ('M::C', '#c')]
+
+
+# ----------------------------------------------------------------------
+#  parse_ruby_params
+# ----------------------------------------------------------------------
+def test_params_of_every_kind():
+    assert parse_ruby_params('def a(x, y = 1, *rest, z:, w: 2, **opts, &blk)') == [
+        RubyParam('x', 'req', None), RubyParam('y', 'opt', '1'), RubyParam('rest', 'rest', None),
+        RubyParam('z', 'keyreq', None), RubyParam('w', 'key', '2'), RubyParam('opts', 'keyrest', None),
+        RubyParam('blk', 'block', None)]
+
+
+def test_anonymous_splats_and_forwarding():
+    assert parse_ruby_params('def self.b(*, **, &)') == [
+        RubyParam('args', 'rest', None), RubyParam('options', 'keyrest', None), RubyParam('block', 'block', None)]
+    assert parse_ruby_params('def c(...)') == [RubyParam('...', 'forward', None)]
+
+
+def test_params_without_parentheses():
+    assert parse_ruby_params('def a x, y = 2 # (not a param)') == [RubyParam('x', 'req', None),
+                                                                   RubyParam('y', 'opt', '2')]
+    assert parse_ruby_params('def g') == []
+
+
+def test_multiline_signature_with_nested_defaults():
+    signature = 'def m(a,\n      b = {x: 1, y: [1, 2]},\n      c: "a, b")'
+    assert parse_ruby_params(signature) == [RubyParam('a', 'req', None),
+                                            RubyParam('b', 'opt', '{x: 1, y: [1, 2]}'),
+                                            RubyParam('c', 'key', '"a, b"')]
+
+
+def test_endless_and_operator_signatures():
+    assert parse_ruby_params('def e = 1') == []
+    assert parse_ruby_params('def f(x) = x * 2') == [RubyParam('x', 'req', None)]
+    assert parse_ruby_params('def []=(k, v)') == [RubyParam('k', 'req', None), RubyParam('v', 'req', None)]
+    assert parse_ruby_params('def setter=(v)') == [RubyParam('v', 'req', None)]
+
+
+# ----------------------------------------------------------------------
+#  code_mismatch
+# ----------------------------------------------------------------------
+ORIGINAL = 'a = 1\nb = 2\nc(3)\n'
+
+
+def test_added_comments_and_whitespace_are_not_mismatches():
+    assert code_mismatch(ORIGINAL, '# doc\na = 1\n\n  # more\nb  =  2\nc(3)\n') is None
+
+
+def test_changed_line_is_reported_against_the_original():
+    assert code_mismatch(ORIGINAL, '# doc\n# more\na = 1\nb = 3\nc(3)\n') == (2, 'b = 2', 'b = 3')
+
+
+def test_missing_and_extra_lines():
+    assert code_mismatch(ORIGINAL, 'a = 1\nb = 2\n') == (3, 'c(3)', '')
+    assert code_mismatch(ORIGINAL, ORIGINAL + 'd\n') == (4, '', 'd')
+
+
+def test_trailing_comments_are_code():
+    assert code_mismatch('x = 1 # note\n', 'x = 1 # changed\n') == (1, 'x = 1 # note', 'x = 1 # changed')
+
+
+# ----------------------------------------------------------------------
+#  Escalation ladder and the analysis caches
+# ----------------------------------------------------------------------
+class StubBackend(ModelBackend):
+    """Answers like the benchmark server; with truncate, every answer stops after its first line"""
+    name = 'stub'
+
+    def __init__(self, truncate=False, batch_output=''):
+        self.truncate = truncate
+        self.batch_output = batch_output
+        self.calls = 0
+
+    @property
+    def client(self):
+        """Just enough of the OpenAI client to download a batch's output file"""
+        return SimpleNamespace(files=SimpleNamespace(content=lambda file_id: SimpleNamespace(text=self.batch_output)))
+
+    def complete(self, model, messages, max_tokens, temperature):
+        self.calls += 1
+        text = FakeOpenAIServer.answer(messages[-1]['content'])
+        if self.truncate:
+            return '\n'.join(text.split('\n')[:2]), None, 'length'
+        return text, None, 'stop'
+
+
+MODULE = '''module M
+  def a(x)
+    x
+  end
+
+  def b
+  end
+end
+'''
+
+
+def test_exhausted_ladder_is_not_cached(tmp_path):
+    source = tmp_path / 'm.rb'
+    source.write_text(MODULE)
+
+    def analyze(backend, run):
+        generator = Lich5DocumentationGenerator(input_file=source, backend=backend, output_dir=tmp_path / run,
+                                                cache_dir=tmp_path / 'cache')
+        return generator.analyze_file(source)
+
+    truncating = StubBackend(truncate=True)
+    analyze(truncating, 'first')
+    assert truncating.calls == 3                   # every tier of the small-file ladder was tried
+
+    healthy = StubBackend()
+    raw_doc = analyze(healthy, 'second')
+    assert healthy.calls == 1
+    assert raw_doc.count('@return') == 3           # M, #a and #b are all documented now
+
+
+def test_truncated_batch_answers_are_escalated(tmp_path):
+    source = tmp_path / 'm.rb'
+    source.write_text(MODULE)
+    backend = StubBackend()
+    generator = Lich5DocumentationGenerator(input_file=source, backend=backend, output_dir=tmp_path / 'out',
+                                            cache_dir=tmp_path / 'cache')
+    key = ResponseCache.key(**generator._analysis_request('m.rb', MODULE))
+    backend.batch_output = json.dumps({'custom_id': key, 'response': {'status_code': 200, 'body': {
+        'choices': [{'finish_reason': 'length', 'message': {'content': '@@ L1\nModule M'}}]}}})
+
+    generator._load_batch_results(SimpleNamespace(id='batch_1', output_file_id='file_1'))
+    assert key not in generator.response_cache
+    assert not generator._analysis_answered(source)
+
+    raw_doc = generator.analyze_file(source)
+    assert backend.calls == 1                      # the second tier, asked live
+    assert raw_doc.count('@return') == 3
+
+
+# ----------------------------------------------------------------------
+#  ChunkServer
+# ----------------------------------------------------------------------
+def _run(call):
+    """Exceptions raised by call(), as a list"""
+    try:
+        call()
+    except Exception as e:
+        return [e]
+    return []
+
+
+def test_chunk_server_runs_off_the_main_thread(tmp_path):
+    path = tmp_path / 'guide.sock'
+    generator = SimpleNamespace(process_chunk=lambda code, file_name: f"# Documented {file_name}")
+    server = ChunkServer(generator, path)
+    errors = []
+    thread = threading.Thread(target=lambda: errors.extend(_run(server.serve_forever)))
+    thread.start()
+    deadline = time.time() + 5
+    while not path.exists() and time.time() < deadline:
+        time.sleep(0.01)
+
+    reply = chunk_client.request({'code': 'def a; end', 'file': 'a.rb'}, path, timeout=5)
+    server.shutdown()
+    thread.join(5)
+    assert reply['doc'] == '# Documented a.rb'
+    assert errors == [] and not thread.is_alive() and not path.exists()
+